@@ -0,0 +1,3 @@
+"""
+Benchmarks and engine parity checks for EagleEye.
+"""
@@ -0,0 +1,112 @@
+"""
+Reading compressed spectra files: shell extraction to disk, as jobs did
+before, vs. in-process streaming with spectra_io.read_spectra().
+
+    $ python -m benchmarks.bench_archives [--nquery 20000] [--peaks 100]
+
+Writes one synthetic MGF in each supported container (.mgf, .mgf.gz,
+.mgf.zip, a .tar.gz member, and the .dta files as .zip and .tgz), reads
+it both ways and reports throughput in MB/s of uncompressed MGF. The
+records read both ways are checked to be identical.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from benchmarks.synthetic import random_spectra, write_mgf
+from spectra_io import read_dta_records, read_mgf, read_spectra, write_dta_directory
+
+
+def extract_and_read(path: str) -> tuple:
+    """
+    The former process_spectra() input handling: extract with unzip, gunzip
+    or tar into the working directory or a temporary directory, parse, delete.
+    """
+    directory, name = os.path.split(path)
+    if ':' in name:
+        archive, name = name.split(':', 1)
+        subprocess.run(f"tar xzf {os.path.join(directory, archive)} --transform='s,^.*/,,' "
+                       f"--no-anchored {name}", shell=True, check=True)
+        path = name
+    if name.endswith('.mgf.gz'):
+        subprocess.run(f"gunzip -q -c {path} > {name[:-3]}", shell=True, check=True)
+        result = read_mgf(name[:-3])
+        os.remove(name[:-3])
+    elif name.endswith('.mgf.zip'):
+        subprocess.run(f"unzip -qq -j -o {path}", shell=True, check=True)
+        result = read_mgf(name[:-4])
+        os.remove(name[:-4])
+    elif name.endswith('.mgf'):
+        result = read_mgf(path)
+    else:
+        tmp = tempfile.mkdtemp()
+        if name.endswith('.zip'):
+            subprocess.run(f"unzip -qq -j -o {path} -d {tmp}/", shell=True, check=True)
+        else:
+            subprocess.run(f"tar -xzf {path} -C {tmp}/", shell=True, check=True)
+        result = read_dta_records(tmp)
+        shutil.rmtree(tmp)
+    if path != os.path.join(directory, name) and os.path.exists(name):
+        os.remove(name)
+    return result
+
+
+def same_records(a: list, b: list) -> bool:
+    key = lambda r: (r.name, r.header, r.peaks, r.meta)
+    return sorted(map(key, a)) == sorted(map(key, b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reading compressed spectra files")
+    parser.add_argument("--nquery", type=int, default=20000, help="Spectra in the MGF file")
+    parser.add_argument("--peaks", type=int, default=100, help="Mean number of peaks per spectrum")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            os.makedirs('src')
+            write_mgf(random_spectra(args.nquery, seed=args.seed, peaks=args.peaks), 'src/spectra.mgf')
+            mb = os.path.getsize('src/spectra.mgf') / 1e6
+            subprocess.run("gzip -c src/spectra.mgf > spectra.mgf.gz", shell=True, check=True)
+            with zipfile.ZipFile('spectra.mgf.zip', 'w', zipfile.ZIP_DEFLATED) as zf:
+                zf.write('src/spectra.mgf', 'spectra.mgf')
+            with tarfile.open('bundle.tar.gz', 'w:gz') as tf:
+                tf.add('src/spectra.mgf', 'run/spectra.mgf')
+            records, globals_meta = read_mgf('src/spectra.mgf')
+            write_dta_directory(records, globals_meta, 'dta')
+            with zipfile.ZipFile('spectra.zip', 'w', zipfile.ZIP_DEFLATED) as zf:
+                for name in sorted(os.listdir('dta')):
+                    zf.write(os.path.join('dta', name), name)
+            with tarfile.open('spectra.tgz', 'w:gz') as tf:
+                for name in sorted(os.listdir('dta')):
+                    tf.add(os.path.join('dta', name), name)
+
+            print(f"{args.nquery} spectra, {mb:.1f} MB of MGF")
+            print(f"{'input':<26} {'MB':>7} {'extract_s':>10} {'stream_s':>9} {'extract_MB/s':>13} {'stream_MB/s':>12}")
+            for path in ('src/spectra.mgf', 'spectra.mgf.gz', 'spectra.mgf.zip', 'bundle.tar.gz:spectra.mgf',
+                         'spectra.zip', 'spectra.tgz'):
+                t0 = time.perf_counter()
+                old, _ = extract_and_read(os.path.join(tmp, path))
+                t_old = time.perf_counter() - t0
+                t0 = time.perf_counter()
+                new, _, _ = read_spectra(os.path.join(tmp, path))
+                t_new = time.perf_counter() - t0
+                if not same_records(old, new):
+                    raise Exception(f"Records read from {path} differ")
+                size = os.path.getsize(os.path.join(tmp, path.split(':')[0])) / 1e6
+                print(f"{path:<26} {size:>7.1f} {t_old:>10.2f} {t_new:>9.2f} {mb / t_old:>13.1f} {mb / t_new:>12.1f}")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Batch mode vs. one run_eagleeye.py invocation per spectra file.
+
+    $ python -m benchmarks.bench_batch [--files 12] [--nquery 300] [--nlib 20000] [-e python]
+
+Generates a user-supplied library (.mgf.gz) and several query MGF files,
+filters them once per file and once as a batch sharing a single library
+load, and checks that every output file is byte-identical.
+"""
+
+import argparse
+import filecmp
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import perturbed, random_spectra, write_mgf
+
+RUN_EAGLEEYE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run_eagleeye.py')
+
+
+def run(args: list, cwd: str) -> float:
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, RUN_EAGLEEYE] + args, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batch filtering against one library load")
+    parser.add_argument("--files", type=int, default=12, help="Number of spectra files")
+    parser.add_argument("--nquery", type=int, default=300, help="Spectra per file")
+    parser.add_argument("--nlib", type=int, default=20000, help="Library size")
+    parser.add_argument("-e", "--engine", choices=("python", "msfilter"), default="python")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        library = random_spectra(args.nlib, seed=args.seed, prefix='lib')
+        write_mgf(library, os.path.join(tmp, 'library.mgf'))
+        with open(os.path.join(tmp, 'library.mgf'), 'rb') as fin, \
+                gzip.open(os.path.join(tmp, 'library.mgf.gz'), 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+        os.remove(os.path.join(tmp, 'library.mgf'))
+        inputs = []
+        for k in range(args.files):
+            half = args.nquery // 2
+            start = (k * half) % max(1, args.nlib - half)
+            queries = perturbed(library[start:start + half], seed=args.seed + k, prefix=f'dup{k}_') + \
+                random_spectra(args.nquery - half, seed=args.seed + 1000 + k, prefix=f'rnd{k}_')
+            name = f"run{k:03d}.mgf"
+            write_mgf(queries, os.path.join(tmp, name))
+            inputs.append(os.path.join('..', name))
+
+        common = ['../library.mgf.gz', '-p', '2', '-f', '0.6', '-a', '0.05', '-e', args.engine]
+        separate, batch = os.path.join(tmp, 'separate'), os.path.join(tmp, 'batch')
+        os.makedirs(separate)
+        os.makedirs(batch)
+        t_separate = sum(run([f] + common, separate) for f in inputs)
+        with open(os.path.join(batch, 'manifest.txt'), 'w') as fout:
+            fout.write(''.join(f"{f}\n" for f in inputs))
+        t_batch = run(['@manifest.txt'] + common, batch)
+
+        # Timings differ from run to run
+        names = sorted(n for n in os.listdir(separate) if not n.endswith('-stats.json'))
+        match, mismatch, errors = filecmp.cmpfiles(separate, batch, names, shallow=False)
+        if mismatch or errors:
+            raise Exception(f"Batch outputs differ: {mismatch + errors}")
+        print(f"{args.files} files x {args.nquery} spectra, library {args.nlib}, engine {args.engine}")
+        print(f"separate runs: {t_separate:8.2f} s")
+        print(f"batch run:     {t_batch:8.2f} s  ({t_separate / t_batch:.1f}x), {len(match)} identical outputs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Candidate selection benchmark: all-pairs precursor scan vs. MassIndex.
+
+    $ python -m benchmarks.bench_index [--sizes 1000,10000,100000,267000] [--tolerances 0.01,0.5,2,10]
+
+Only the precursor mass/charge columns are generated, so full library
+sizes are cheap to set up. Every query's candidate list is checked to be
+identical between the two methods.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from msfilter import MassIndex
+
+
+def scan(pm: np.ndarray, ch: np.ndarray, qpm: np.ndarray, qch: np.ndarray, tolerance: float) -> list:
+    return [np.flatnonzero((np.abs(m - pm) < tolerance) & (c == ch)) for m, c in zip(qpm, qch)]
+
+
+def indexed(index: MassIndex, qpm: np.ndarray, qch: np.ndarray, tolerance: float) -> list:
+    return [index.candidates(m, c, tolerance) for m, c in zip(qpm.tolist(), qch.tolist())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark precursor candidate selection")
+    parser.add_argument("--sizes", default="1000,10000,100000,267000", help="Library sizes")
+    parser.add_argument("--tolerances", default="0.01,0.5,2,10", help="Precursor mass tolerances, Da")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of query spectra")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    qpm = np.round(rng.uniform(800.0, 3500.0, args.queries), 4)
+    qch = rng.choice([2, 3], args.queries)
+    print(f"{'library':>8} {'pmt':>6} {'pairs/query':>11} {'scan_s':>8} {'index_s':>8} {'build_s':>8} {'speedup':>8}")
+    for size in (int(x) for x in args.sizes.split(',')):
+        pm = np.round(rng.uniform(800.0, 3500.0, size), 4)
+        ch = rng.choice([1, 2, 3, 4], size, p=[0.05, 0.6, 0.3, 0.05])
+        t0 = time.perf_counter()
+        index = MassIndex(pm, ch)
+        build = time.perf_counter() - t0
+        for tolerance in (float(x) for x in args.tolerances.split(',')):
+            t0 = time.perf_counter()
+            expected = scan(pm, ch, qpm, qch, tolerance)
+            t_scan = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            actual = indexed(index, qpm, qch, tolerance)
+            t_index = time.perf_counter() - t0
+            if not all(np.array_equal(a, b) for a, b in zip(expected, actual)):
+                raise Exception(f"Candidate mismatch: library={size} pmt={tolerance}")
+            pairs = sum(len(a) for a in actual) / len(actual)
+            print(f"{size:>8} {tolerance:>6} {pairs:>11.1f} {t_scan:>8.3f} {t_index:>8.3f} "
+                  f"{build:>8.3f} {t_scan / t_index:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Memory held by a loaded library: one Spectrum object per file vs. the
+columnar SpectrumStore.
+
+    $ python -m benchmarks.bench_memory [--nlib 20000] [--peaks 100] [--msfilter old new]
+
+Python allocations are measured with tracemalloc after loading a synthetic
+.dta directory. With --msfilter, each given binary also loads the library
+(against an empty query directory) and its peak resident set size is
+reported, e.g. to compare builds before and after a loader change.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.synthetic import random_spectra, write_dta_directory
+from msfilter import read_directory, read_dta
+
+
+def per_object(directory: str) -> list:
+    # The loader before SpectrumStore
+    return [read_dta(directory + '/' + name) for name in sorted(os.listdir(directory))
+            if len(name) >= 4 and name[-4:].lower() == '.dta']
+
+
+def measure(load, *args) -> tuple:
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = load(*args)
+    elapsed = time.perf_counter() - t0
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, elapsed
+
+
+# ru_maxrss survives fork and exec, so the binary is started from a fresh
+# interpreter that has not loaded numpy or the library
+_LAUNCHER = """
+import os, sys
+pid = os.fork()
+if pid == 0:
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    os.execv(sys.argv[1], sys.argv[1:])
+_, status, usage = os.wait4(pid, 0)
+print(status, usage.ru_maxrss)
+"""
+
+
+def binary_rss(binary: str, queries: str, library: str) -> int:
+    """
+    Peak resident set size of one msfilter run, in bytes.
+    """
+    out = subprocess.run([sys.executable, '-S', '-c', _LAUNCHER, binary, queries, library, '0.05', '2', '0.6'],
+                         check=True, capture_output=True, text=True).stdout
+    status, maxrss = (int(x) for x in out.split())
+    if status:
+        raise Exception(f"{binary} failed with status {status}")
+    return maxrss * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark library memory footprint")
+    parser.add_argument("--nlib", type=int, default=20000, help="Library size")
+    parser.add_argument("--peaks", type=int, default=100, help="Mean number of peaks per spectrum")
+    parser.add_argument("--msfilter", nargs='*', default=[], help="msfilter binaries to measure")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        libdir, qdir = os.path.join(tmp, 'library'), os.path.join(tmp, 'queries')
+        write_dta_directory(random_spectra(args.nlib, seed=args.seed, peaks=args.peaks), libdir)
+        os.makedirs(qdir)
+        print(f"{args.nlib} spectra, {args.peaks} peaks on average")
+        print(f"{'loader':<24} {'MB':>8} {'bytes/spec':>10} {'load_s':>8}")
+        base = None
+        for label, load, extra in (('Spectrum objects', per_object, ()),
+                                   ('SpectrumStore float64', read_directory, (np.float64,)),
+                                   ('SpectrumStore float32', read_directory, (np.float32,))):
+            nbytes, elapsed = measure(load, libdir, *extra)
+            base = base or nbytes
+            print(f"{label:<24} {nbytes / 2**20:>8.1f} {nbytes / args.nlib:>10.0f} {elapsed:>8.2f}"
+                  f"  {base / nbytes:.1f}x")
+        for binary in args.msfilter:
+            rss = binary_rss(binary, qdir, libdir)
+            print(f"{binary:<24} {rss / 2**20:>8.1f} {rss / args.nlib:>10.0f}        -  (peak RSS)")
+
+
+if __name__ == "__main__":
+    main()
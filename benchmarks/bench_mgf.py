@@ -0,0 +1,98 @@
+"""
+MGF parsing throughput: line-by-line MgfReader vs. the chunked reader
+(read_mgf / read_mgf_stream) with 1..N processes.
+
+    $ python -m benchmarks.bench_mgf [--size-mb 200] [--workers 1,2,4,8] [--chunk-mb 16] [--mgf FILE]
+
+Writes a synthetic MGF of about --size-mb (or uses --mgf), parses it both
+ways and reports MB/s; records, global blocks and spectra must be
+identical. Edge cases are covered by tests/test_mgf.py.
+"""
+
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import spectra_io
+from benchmarks import synthetic
+from spectra_io import MgfReader, read_mgf, read_mgf_stream
+
+
+def records_key(records: list) -> list:
+    return [(r.name, r.header, r.peaks, r.meta, r.checked) for r in records]
+
+
+def same_spectra(expected: list, actual: list) -> bool:
+    for a, b in zip(expected, actual):
+        try:
+            s = a.spectrum()
+        except Exception:
+            continue
+        t = b.spectrum()
+        if (s.precursor_mass, s.charge) != (t.precursor_mass, t.charge) or \
+                not np.array_equal(s.mass, t.mass) or not np.array_equal(s.intensity, t.intensity):
+            return False
+    return True
+
+
+def sequential(path: str) -> tuple:
+    reader = MgfReader.open(path)
+    with reader.fin:
+        records = list(reader)
+    return records, reader.globals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chunked MGF parsing")
+    parser.add_argument("--mgf", help="MGF file to parse (default: synthetic)")
+    parser.add_argument("--size-mb", type=float, default=200, help="Size of the synthetic MGF")
+    parser.add_argument("--workers", default="1,2,4,8", help="Parser process counts")
+    parser.add_argument("--chunk-mb", type=float, default=spectra_io.MGF_CHUNK_BYTES / 2**20, help="Chunk size")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.mgf
+        if not path:
+            # About 1.6 kB per spectrum of 100 peaks
+            n = max(1, int(args.size_mb * 2**20 / 1600))
+            path = os.path.join(tmp, 'spectra.mgf')
+            synthetic.write_mgf(synthetic.random_spectra(n, seed=args.seed), path)
+        size = os.path.getsize(path) / 2**20
+        spectra_io.MGF_CHUNK_BYTES = int(args.chunk_mb * 2**20)
+
+        t0 = time.perf_counter()
+        expected, gexpected = sequential(path)
+        t_seq = time.perf_counter() - t0
+        print(f"{path}: {size:.1f} MB, {len(expected)} records, {os.cpu_count()} CPUs")
+        print(f"MgfReader:           {t_seq:8.2f} s  {size / t_seq:8.1f} MB/s")
+        failed = False
+        for workers in (int(x) for x in args.workers.split(',')):
+            t0 = time.perf_counter()
+            records, gtext = read_mgf(path, workers=workers)
+            elapsed = time.perf_counter() - t0
+            ok = records_key(records) == records_key(expected) and gtext == gexpected and \
+                same_spectra(expected, records)
+            failed |= not ok
+            print(f"read_mgf, {workers:2d} workers: {elapsed:8.2f} s  {size / elapsed:8.1f} MB/s  "
+                  f"{'identical' if ok else 'DIFFERENT'}")
+        gz = path + '.gz'
+        with open(path, 'rb') as fin, gzip.open(gz, 'wb', compresslevel=1) as fout:
+            fout.write(fin.read())
+        for workers in (1, max(int(x) for x in args.workers.split(','))):
+            t0 = time.perf_counter()
+            with gzip.open(gz, 'rb') as fin:
+                records, _ = read_mgf_stream(fin, os.path.basename(path), workers=workers)
+            elapsed = time.perf_counter() - t0
+            print(f".mgf.gz, {workers:2d} workers:  {elapsed:8.2f} s  {size / elapsed:8.1f} MB/s (uncompressed)")
+        os.remove(gz)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
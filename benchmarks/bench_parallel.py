@@ -0,0 +1,52 @@
+"""
+Scaling of the scoring engine with the number of worker processes.
+
+    $ python -m benchmarks.bench_parallel [--nlib 20000] [--nquery 2000] [--max-workers 8]
+
+Each run's table is compared byte for byte with the serial one.
+"""
+
+import argparse
+import io
+import os
+import time
+
+from benchmarks.synthetic import perturbed, random_spectra
+from msfilter import msfilter, write_table
+
+
+def table_text(queries, library, table) -> str:
+    out = io.StringIO()
+    write_table(out, queries, library, table)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark multi-process scoring")
+    parser.add_argument("--nlib", type=int, default=20000, help="Library size")
+    parser.add_argument("--nquery", type=int, default=2000, help="Number of query spectra")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count(), help="Largest worker count")
+    parser.add_argument("-p", type=float, default=2.0, help="Precursor mass tolerance")
+    parser.add_argument("-f", type=float, default=0.6, help="Fragment mass tolerance")
+    args = parser.parse_args()
+
+    library = random_spectra(args.nlib, seed=0, prefix='lib')
+    queries = perturbed(library[:args.nquery // 2]) + random_spectra(args.nquery - args.nquery // 2, seed=2)
+
+    counts = sorted({1, args.max_workers} | {w for w in (2, 4, 8, 16, 32) if w < args.max_workers})
+    print(f"{'workers':>7} {'pairs':>8} {'seconds':>8} {'speedup':>8}")
+    serial = None
+    for workers in counts:
+        t0 = time.perf_counter()
+        table = msfilter(queries, library, 0.05, args.p, args.f, workers=workers)
+        elapsed = time.perf_counter() - t0
+        text = table_text(queries, library, table)
+        if serial is None:
+            serial = (elapsed, text)
+        elif text != serial[1]:
+            raise Exception(f"Table with {workers} workers differs from the serial run")
+        print(f"{workers:>7} {len(table.dscore):>8} {elapsed:>8.2f} {serial[0] / elapsed:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
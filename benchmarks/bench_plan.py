@@ -0,0 +1,80 @@
+"""
+Accuracy of the execution planner (run_eagleeye.py --plan) and the
+constants it uses.
+
+    $ python -m benchmarks.bench_plan [--sizes 3000,15000] [--pmt 0.5,2,5] [--engines python,sparse]
+          [dataset options, see benchmarks.synthetic]
+
+Writes a synthetic library and query files of each of --sizes (files
+larger than planner.SAMPLE_SPECTRA are planned from a sample), runs a
+planned Filter job for each tolerance and engine and reports estimated
+vs. actual candidate pairs and scoring time. The scoring time per pair
+measured here is what planner.PAIR_SECONDS should hold on this machine.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import planner
+from benchmarks import synthetic
+
+RUN_EAGLEEYE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run_eagleeye.py')
+
+
+def run(args: list, cwd: str) -> dict:
+    """
+    :return: Statistics of the job
+    """
+    os.makedirs(cwd, exist_ok=True)
+    subprocess.run([sys.executable, RUN_EAGLEEYE] + args, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    stats = [f for f in os.listdir(cwd) if f.endswith('-stats.json')]
+    with open(os.path.join(cwd, stats[0])) as fin:
+        return json.load(fin)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the execution planner's estimates")
+    synthetic.add_arguments(parser)
+    parser.add_argument("--sizes", default="3000,15000", help="Query file sizes, spectra")
+    parser.add_argument("--pmt", default="0.5,2,5", help="Precursor mass tolerances, Da")
+    parser.add_argument("--engines", default="python,sparse", help="Scoring engines")
+    args = parser.parse_args()
+    if args.library_format == 'dir':
+        parser.error("the library must be a file")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        queries, library = synthetic.dataset_from_args(args)
+        library_file = synthetic.write_library(library, tmp, args.library_format)
+        print(f"library {len(library)}, planner.PAIR_SECONDS {planner.PAIR_SECONDS}")
+        print(f"{'queries':>8s} {'pmt':>5s} {'engine':7s} {'pairs est.':>11s} {'actual':>9s} {'error':>7s} "
+              f"{'scoring est.':>12s} {'actual':>8s} {'us/pair':>8s}  plan")
+        per_pair = {}
+        for size in (int(x) for x in args.sizes.split(',')):
+            more = synthetic.random_spectra(max(0, size - len(queries)), seed=args.seed + 7, prefix='more')
+            spectra = os.path.join(tmp, f'queries{size}.mgf')
+            synthetic.write_mgf((queries + more)[:size], spectra)
+            for pmt in args.pmt.split(','):
+                for engine in args.engines.split(','):
+                    stats = run([spectra, library_file, '-p', pmt, '-f', '0.6', '-a', '0.05', '-e', engine, '--plan'],
+                                os.path.join(tmp, f'{size}-{pmt}-{engine}'))
+                    plan = stats['counters']['plan']
+                    scoring = stats['stages']['scoring']['wall_s']
+                    actual = plan['actual_pairs']
+                    error = (plan['pairs'] - actual) / actual if actual else 0.0
+                    per_pair.setdefault(engine, []).append((scoring, actual))
+                    mode = f"{plan['workers']} proc, " + (f"{plan['memory_budget_mb']} MB budget"
+                                                          if plan['memory_budget_mb'] else "in memory")
+                    print(f"{size:8d} {pmt:>5s} {engine:7s} {plan['pairs']:11d} {actual:9d} {error:+7.1%} "
+                          f"{plan['scoring_s']:11.2f}s {scoring:7.2f}s {scoring / max(1, actual) * 1e6:8.1f}  "
+                          f"{mode}{'' if plan['exact'] else ' (sampled)'}")
+        for engine, runs in per_pair.items():
+            seconds, pairs = (sum(x) for x in zip(*runs))
+            print(f"{engine}: {seconds / max(1, pairs) * 1e6:.1f} us per candidate pair over all runs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Reading Filter results back: the fixed-width <name>-table.csv vs. the
+--results-db SQLite database.
+
+    $ python -m benchmarks.bench_results [--nquery 200000] [--candidates 5] [--lookups 1000] [--cutoff 0.05]
+
+Writes a synthetic sorted score table with --candidates rows per query,
+the table CSV as processtable() writes it and the results database with
+all pairs, then times what downstream analysis does with them: looking up
+the result of single spectra, counting Good/Background, and counting the
+background queries per matched library spectrum. Both must give the same
+answers.
+"""
+
+import argparse
+import collections
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import msfilter
+import resultsdb
+from eagleeye_cgi import TABLE_HEADER, TABLE_ROW, best_matches
+from spectra_io import url_encode
+
+
+def score_table(nquery: int, candidates: int, seed: int) -> list:
+    """
+    Sorted score table lines, a few queries without candidates.
+    """
+    rng = random.Random(seed)
+    lines = []
+    for i in range(nquery):
+        mass, charge = round(rng.uniform(400, 4000), 2), rng.choice((1, 2, 3))
+        # Scan ids are URL-encoded in the table, as in the .dta file names
+        name = url_encode(f"Scan q{i:07d} (file.raw)") + f".{charge}.dta"
+        if i % 50 == 0:
+            lines.append(f"{name}\tno_bckgr_spectra_with_same_precursor_mass\t\t\t{mass:g}\tnot_found\t\t"
+                         f"{charge}\tnot_found\t\t1.00\n")
+            continue
+        for _ in range(candidates):
+            ds = rng.uniform(0.005, 0.9)
+            lines.append(f"{name}\tlib{rng.randrange(nquery // 10 + 1):07d}.{charge}.dta\t{mass:g}\t"
+                         f"{mass + rng.uniform(-2, 2):g}\t{charge}\t{charge}\t{ds:g}\n")
+    lines.sort(key=lambda line: (msfilter.sort_key(float(line.split()[-1])), line))
+    return lines
+
+
+def read_csv(path: str) -> list:
+    """
+    The rows of a table CSV, as a downstream tool parses them.
+    """
+    rows = []
+    with open(path) as fin:
+        next(fin)
+        for line in fin:
+            query, match, ds, pvalue, prediction = (field.strip() for field in line.split('\t'))
+            rows.append((query, match, float(ds), float(pvalue), prediction))
+    return rows
+
+
+def timed(function, *args):
+    t0 = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - t0, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reading the results table vs. the results database")
+    parser.add_argument("--nquery", type=int, default=200000, help="Query spectra")
+    parser.add_argument("--candidates", type=int, default=5, help="Score rows per query")
+    parser.add_argument("--lookups", type=int, default=1000, help="Spectra looked up one by one")
+    parser.add_argument("--cutoff", type=float, default=0.05, help="p-Value cutoff")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        t_table, lines = timed(score_table, args.nquery, args.candidates, args.seed)
+        print(f"{args.nquery} queries, {len(lines)} score rows (generated in {t_table:.1f} s)")
+
+        csv = os.path.join(tmp, 'spectra-table.csv')
+        t0 = time.perf_counter()
+        matches, _, _ = best_matches(lines)
+        with open(csv, 'w', newline='') as fout:
+            fout.write(TABLE_HEADER)
+            for _, sname, lname, ds, pvalue in matches:
+                fout.write(TABLE_ROW.format(sname, lname, ds, pvalue, 'Background' if pvalue < args.cutoff else 'Good'))
+        t_csv = time.perf_counter() - t0
+        db_path = os.path.join(tmp, 'spectra' + resultsdb.RESULTS_EXT)
+        t_db, count = timed(resultsdb.write_results, db_path, lines, [args.cutoff], True)
+        print(f"write:     CSV {t_csv:7.2f} s {os.path.getsize(csv) / 2**20:7.1f} MB   "
+              f"database {t_db:7.2f} s {os.path.getsize(db_path) / 2**20:7.1f} MB (all pairs)")
+
+        names = random.Random(args.seed + 1).sample([m[1] for m in matches], min(args.lookups, len(matches)))
+        # Each lookup of a downstream tool opens and parses the table again;
+        # timing a few and scaling keeps the benchmark short
+        few = names[:10]
+        t0 = time.perf_counter()
+        expected = {}
+        for name in few:
+            expected[name] = next(row for row in read_csv(csv) if row[0] == name)
+        t_csv = (time.perf_counter() - t0) / len(few) * len(names)
+        db = sqlite3.connect(db_path)
+        t0 = time.perf_counter()
+        found = {}
+        for name in names:
+            found[name] = db.execute("SELECT query, match, dscore, pvalue, prediction FROM results WHERE query = ?",
+                                     (name,)).fetchone()
+        t_lookup = time.perf_counter() - t0
+        for name in few:
+            query, match, ds, pvalue, prediction = found[name]
+            if (query, match or 'no_bckgr_spectra_with_same_precursor_mass', prediction) != \
+                    (expected[name][0], expected[name][1], expected[name][4]) or \
+                    round(ds, 4) != expected[name][2]:
+                raise Exception(f"Database and table differ for {name}")
+        print(f"{len(names)} lookups: CSV {t_csv:7.2f} s (parsed each time, estimated from {len(few)})   "
+              f"database {t_lookup:7.4f} s")
+
+        t_csv, rows = timed(read_csv, csv)
+        predictions = collections.Counter(row[4] for row in rows)
+        per_match = collections.Counter(row[1] for row in rows if row[4] == 'Background')
+        t_agg, counts = timed(lambda: dict(db.execute(
+            "SELECT prediction, COUNT(*) FROM results WHERE cutoff = ? GROUP BY prediction", (args.cutoff,))))
+        t_match, matched = timed(lambda: dict(db.execute(
+            "SELECT match, COUNT(*) FROM queries WHERE pvalue < ? GROUP BY match", (args.cutoff,))))
+        if counts != dict(predictions) or matched != dict(per_match) or count != len(rows):
+            raise Exception("Database and table aggregates differ")
+        print(f"aggregate: CSV {t_csv:7.2f} s (one parse, both counts)   database {t_agg:7.4f} s predictions, "
+              f"{t_match:7.4f} s background per library spectrum")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Sharded execution with local worker processes standing in for nodes, vs.
+a single-node run of the same job.
+
+    $ python -m benchmarks.bench_shards [--nodes 4] [--units 16] [--nquery 2000] [--nlib 20000] [-e python]
+          [dataset options, see benchmarks.synthetic]
+
+Writes a synthetic dataset, runs it with run_eagleeye.py, then shards it
+with eagleeye_shard.py, starts --nodes worker processes on the job
+directory at once and merges. The merged table and good/background files
+must be byte-identical to the single-node ones; every unit must have been
+processed by exactly one worker.
+"""
+
+import argparse
+import filecmp
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import synthetic
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUN_EAGLEEYE = os.path.join(PROJECT_PATH, 'run_eagleeye.py')
+EAGLEEYE_SHARD = os.path.join(PROJECT_PATH, 'eagleeye_shard.py')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sharded execution against a single-node run")
+    synthetic.add_arguments(parser)
+    parser.add_argument("--nodes", type=int, default=4, help="Worker processes")
+    parser.add_argument("--units", type=int, default=16, help="Work units")
+    parser.add_argument("-e", "--engine", choices=("python", "sparse", "msfilter"), default="python")
+    args = parser.parse_args()
+    if args.library_format == 'dir':
+        parser.error("the library must be a file")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        queries, library = synthetic.dataset_from_args(args)
+        query_file = os.path.join(tmp, 'queries.mgf')
+        synthetic.write_mgf(queries, query_file)
+        library_file = synthetic.write_library(library, tmp, args.library_format)
+        job = [query_file, library_file, '-p', '2', '-f', '0.6', '-a', '0.05', '-e', args.engine]
+        single, merged = os.path.join(tmp, 'single'), os.path.join(tmp, 'merged')
+        os.makedirs(single)
+        os.makedirs(merged)
+
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, RUN_EAGLEEYE] + job, cwd=single, check=True, stdout=subprocess.DEVNULL)
+        t_single = time.perf_counter() - t0
+
+        shared = os.path.join(tmp, 'shared')
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, EAGLEEYE_SHARD, 'shard'] + job + ['--units', str(args.units), '-o', shared],
+                       check=True, stdout=subprocess.DEVNULL)
+        t_shard = time.perf_counter() - t0
+        nodes = [subprocess.Popen([sys.executable, EAGLEEYE_SHARD, 'worker', shared], stdout=subprocess.PIPE,
+                                  text=True) for _ in range(args.nodes)]
+        logs = [p.communicate()[0] for p in nodes]
+        if any(p.returncode for p in nodes):
+            raise Exception("A worker failed")
+        t_workers = time.perf_counter() - t0 - t_shard
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, EAGLEEYE_SHARD, 'merge', shared], cwd=merged, check=True,
+                       stdout=subprocess.DEVNULL)
+        t_merge = time.perf_counter() - t0
+
+        processed = [int(re.search(r"Processed (\d+) units", log).group(1)) for log in logs]
+        claimed = [line.split(':')[0] for log in logs for line in log.splitlines() if line.startswith('u')]
+        if len(claimed) != len(set(claimed)):
+            raise Exception("A unit was processed by several workers")
+        names = sorted(n for n in os.listdir(merged) if not n.endswith('-params.csv'))
+        match, mismatch, errors = filecmp.cmpfiles(single, merged, names, shallow=False)
+        if mismatch or errors:
+            raise Exception(f"Merged outputs differ from the single-node run: {mismatch + errors}")
+
+    print(f"{args.nquery} queries, library {args.nlib}, engine {args.engine}, {len(claimed)} units")
+    print(f"single node:      {t_single:8.2f} s")
+    print(f"shard:            {t_shard:8.2f} s")
+    print(f"{args.nodes} workers:       {t_workers:8.2f} s  (units per worker: {processed})")
+    print(f"merge:            {t_merge:8.2f} s")
+    print(f"{len(match)} outputs identical to the single-node run: {', '.join(match)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Sparse-matrix batch engine vs. the exact NumPy engine.
+
+    $ python -m benchmarks.bench_sparse [--nquery 2000] [--nlib 20000] [-p 2] [-f 0.6] [--workers 1]
+          [dataset options, see benchmarks.synthetic]
+    $ python -m benchmarks.bench_sparse --library data/redundant-library-1.11v [--queries spectra.mgf]
+
+Scores one dataset with msfilter.msfilter() and msfilter_sparse.msfilter_sparse()
+and compares every (query, match) DScore. For a full-size background
+library use --library with the bundled .dta directory, or --nlib 267000;
+without --queries, queries are near-duplicates of library spectra and
+unrelated spectra as in benchmarks.synthetic. Exits non-zero if the pairs
+differ, a sparse DScore is above the exact one, the largest deviation
+exceeds --max-deviation, or a Good/Background call at -a differs once the
+pairs below the cutoff are rescored, as in a job.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from benchmarks import synthetic
+import msfilter_sparse
+import spectra_io
+from msfilter import PeakLists, SpectrumStore, msfilter, pvalue, read_directory
+from preprocessLibrary import preprocess_store
+
+EYE_CATCHING_HEIGHT = 0.05
+
+
+def load_dataset(args: argparse.Namespace) -> tuple:
+    """
+    :return: (queries, library) SpectrumStores
+    """
+    if not args.library:
+        queries, library = synthetic.dataset_from_args(args)
+        return SpectrumStore.from_spectra(queries), SpectrumStore.from_spectra(library)
+    if os.path.isdir(args.library):
+        library = read_directory(args.library)
+    else:
+        # Thresholded as a job does with a user-supplied library
+        records = sorted(spectra_io.by_name(spectra_io.read_library(args.library)).items())
+        library = preprocess_store(SpectrumStore.from_spectra(r.spectrum() for _, r in records), EYE_CATCHING_HEIGHT)
+    if args.queries:
+        records, _, _ = spectra_io.read_spectra(args.queries)
+        return SpectrumStore.from_spectra(r.spectrum() for r in records), library
+    rng = np.random.default_rng(args.seed)
+    ndup = min(len(library), int(round(args.nquery * args.background)))
+    picked = sorted(rng.choice(len(library), ndup, replace=False).tolist())
+    queries = synthetic.perturbed([library[k] for k in picked], seed=args.seed + 2) + \
+        synthetic.random_spectra(args.nquery - ndup, seed=args.seed + 3, prefix='rnd')
+    return SpectrumStore.from_spectra(queries), library
+
+
+def best_calls(table, cutoff: float) -> np.ndarray:
+    """
+    Background call of each query from its lowest DScore.
+    """
+    best = {}
+    for i, ds in zip(table.query.tolist(), table.dscore.tolist()):
+        if not np.isnan(ds) and ds < best.get(i, np.inf):
+            best[i] = ds
+    return np.array([pvalue(best[i]) < cutoff if i in best else False for i in sorted(set(table.query.tolist()))])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the sparse batch engine with the exact engine")
+    synthetic.add_arguments(parser)
+    parser.add_argument("--library", help="Library .dta directory or file (default: synthetic)")
+    parser.add_argument("--queries", help="Query spectra file (default: derived from the library)")
+    parser.add_argument("-p", type=float, default=2.0, help="Precursor mass tolerance, Da")
+    parser.add_argument("-f", type=float, default=0.6, help="Fragment mass tolerance, Da")
+    parser.add_argument("-a", type=float, default=0.05, help="p-value cutoff for the Background calls")
+    parser.add_argument("--workers", type=int, default=1, help="Processes for the exact engine")
+    parser.add_argument("--max-deviation", type=float, default=msfilter_sparse.MAX_DEVIATION,
+                        help="Largest allowed DScore deviation")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    queries, library = load_dataset(args)
+    t_load = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    peaks = PeakLists(library, EYE_CATCHING_HEIGHT)
+    t_peaks = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    bins = msfilter_sparse.library_bins(library, peaks, args.f)
+    t_bins = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    exact = msfilter(queries, library, EYE_CATCHING_HEIGHT, args.p, args.f, workers=args.workers,
+                     library_peaks=peaks)
+    t_exact = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    approx = msfilter_sparse.msfilter_sparse(queries, library, EYE_CATCHING_HEIGHT, args.p, args.f,
+                                             library_peaks=peaks, library_bins=bins)
+    t_sparse = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    counters = {}
+    rescored = msfilter_sparse.msfilter_sparse(queries, library, EYE_CATCHING_HEIGHT, args.p, args.f,
+                                               library_peaks=peaks, library_bins=bins, stats=counters,
+                                               cutoffs=[args.a])
+    t_rescored = time.perf_counter() - t0
+
+    if not (np.array_equal(exact.query, approx.query) and np.array_equal(exact.match, approx.match)):
+        print("FAIL: the engines scored different pairs")
+        sys.exit(1)
+    scored = ~np.isnan(exact.dscore)
+    if not np.array_equal(scored, ~np.isnan(approx.dscore)):
+        print("FAIL: the engines disagree on undefined DScores")
+        sys.exit(1)
+    deviation = exact.dscore[scored] - approx.dscore[scored]
+    worst = float(deviation.max(initial=0.0))
+    above = float(-deviation.min(initial=0.0))
+    calls = best_calls(exact, args.a)
+    agree = float(np.mean(calls == best_calls(approx, args.a))) if len(calls) else 1.0
+    changed = int(np.count_nonzero(calls != best_calls(approx, args.a)))
+    changed_rescored = int(np.count_nonzero(calls != best_calls(rescored, args.a)))
+
+    print(f"{len(queries)} queries, library {len(library)}, pmt {args.p}, fmt {args.f}, "
+          f"{int(np.count_nonzero(exact.match >= 0))} pairs")
+    print(f"load:              {t_load:8.2f} s")
+    print(f"library peaks:     {t_peaks:8.2f} s")
+    print(f"library bins:      {t_bins:8.2f} s  ({msfilter_sparse.SUBDIVISIONS} cells per fmt)")
+    print(f"exact:             {t_exact:8.2f} s  ({args.workers} workers)")
+    print(f"sparse:            {t_sparse:8.2f} s  ({t_exact / t_sparse:.1f}x)")
+    print(f"DScore deviation:  max {worst:.4f}  mean {float(deviation.mean()) if len(deviation) else 0.0:.5f}  "
+          f"99.9th percentile {float(np.percentile(deviation, 99.9)) if len(deviation) else 0.0:.4f}")
+    print(f"rescored at -a:    {t_rescored:8.2f} s  ({counters['pairs_rescored']} pairs rescored)")
+    print(f"Background calls at -a {args.a}: {agree:.2%} identical ({changed} queries differ), "
+          f"{changed_rescored} differ once rescored")
+    # Rounding of the two summation orders aside, the sparse DScore is never higher
+    ok = worst <= args.max_deviation and above <= 1e-9 and changed_rescored == 0
+    print(f"{'OK' if ok else 'FAIL'} (max deviation {args.max_deviation}, sparse above exact by {above:.1e})")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Per-stage timings of complete EagleEye jobs on a synthetic dataset.
+
+    $ python -m benchmarks.bench_stages [--nquery 2000] [--nlib 20000] [--types Filter,Nonred]
+          [-e python] [--repeat 3] [--output results.json] [dataset options, see benchmarks.synthetic]
+
+Each job runs eagleeye_cgi.main() in this process. The functions behind
+each stage are wrapped to record their wall time:
+
+    conversion  reading the spectra file, building the spectra to score
+    library     reading and preprocessing the library (Filter only); with
+                --library-format dir, the library stands in for the bundled one
+    scoring     msfilter() or the msfilter binary
+    sort        sorting the score table
+    table       classification table (Filter) or redundancy graph and
+                selection (Nonred)
+    output      writing good/background or non-redundant spectra
+
+Time spent in a stage nested inside another one counts only for the
+inner stage; other time, such as the params file, is reported as
+'other'. Results are written as JSON, with the dataset and job settings
+and the code version, so that runs can be compared across versions.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict
+
+import eagleeye_cgi
+import msfilter
+import spectra_io
+from benchmarks import synthetic
+
+STAGES = ('conversion', 'library', 'scoring', 'sort', 'table', 'output', 'other')
+
+
+class StageTimer:
+    """
+    Exclusive wall time per stage, for stages entered through wrapped functions.
+    """
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self._stack = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        # Spectra parsed while loading the library are library time
+        if self._stack and self._stack[-1][0] == 'library':
+            yield
+            return
+        t0 = time.perf_counter()
+        self._stack.append([name, 0.0])
+        try:
+            yield
+        finally:
+            _, nested = self._stack.pop()
+            elapsed = time.perf_counter() - t0
+            self.times[name] += elapsed - nested
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def wrap(self, name: str, fn):
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                result = fn(*args, **kwargs)
+            if hasattr(result, '__next__'):
+                return self._timed_iter(name, result)
+            return result
+        return wrapper
+
+    def _timed_iter(self, name: str, it):
+        # Generators do their work as they are consumed
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def command_stage(self, run):
+        # The msfilter engine shells out to the binary and to sort(1)
+        def wrapper(cmd, *args, **kwargs):
+            name = cmd.split()[0] if isinstance(cmd, str) else cmd[0]
+            with self.stage('scoring' if name == 'msfilter' else 'sort' if name == 'sort' else 'other'):
+                return run(cmd, *args, **kwargs)
+        return wrapper
+
+
+@contextlib.contextmanager
+def instrumented(timer: StageTimer):
+    """
+    Wraps the stage functions for the duration of the block.
+    """
+    targets = [
+        (spectra_io, 'read_spectra', 'conversion'),
+        (spectra_io, 'write_dta_directory', 'conversion'),
+        (msfilter.SpectrumStore, 'from_spectra', 'conversion'),
+        (eagleeye_cgi, 'load_library', 'library'),
+        (msfilter, 'msfilter', 'scoring'),
+        (msfilter, 'sort_table', 'sort'),
+        (msfilter, 'table_lines', 'table'),
+        (eagleeye_cgi, 'processtable', 'table'),
+        (eagleeye_cgi, 'read_graph', 'table'),
+        (eagleeye_cgi, 'select_nonredundant', 'table'),
+        (spectra_io, 'write_mgf', 'output'),
+        (spectra_io, 'write_dta_zip', 'output'),
+    ]
+    saved = [(owner, attr, owner.__dict__[attr]) for owner, attr, _ in targets]
+    run = subprocess.run
+    try:
+        for owner, attr, name in targets:
+            setattr(owner, attr, timer.wrap(name, getattr(owner, attr)))
+        subprocess.run = timer.command_stage(run)
+        yield
+    finally:
+        for owner, attr, original in saved:
+            setattr(owner, attr, original)
+        subprocess.run = run
+
+
+def run_job(workdir: str, params: Dict[str, str]) -> Dict[str, float]:
+    """
+    Runs one job in workdir and returns its stage times.
+    """
+    qfile = os.path.join(workdir, 'job.query')
+    with open(qfile, 'w') as fout:
+        fout.write(''.join(f"{k}={v}\n" for k, v in params.items()))
+    timer = StageTimer()
+    cwd, pwd = os.getcwd(), os.environ.get('PWD')
+    os.chdir(workdir)
+    os.environ['PWD'] = workdir
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), instrumented(timer):
+            t0 = time.perf_counter()
+            eagleeye_cgi.main(qfile)
+            total = time.perf_counter() - t0
+    finally:
+        os.chdir(cwd)
+        if pwd is None:
+            os.environ.pop('PWD', None)
+        else:
+            os.environ['PWD'] = pwd
+    times = {stage: timer.times.get(stage, 0.0) for stage in STAGES[:-1]}
+    times['other'] = max(0.0, total - sum(times.values()))
+    times['total'] = total
+    return times
+
+
+def version() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(eagleeye_cgi.__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of EagleEye jobs")
+    synthetic.add_arguments(parser)
+    parser.add_argument("--types", default="Filter,Nonred", help="Job types to run")
+    parser.add_argument("-e", "--engine", choices=("python", "msfilter"), default="python")
+    parser.add_argument("--pmt", type=float, default=2.0, help="Precursor mass tolerance")
+    parser.add_argument("--fmt", type=float, default=0.6, help="Fragment mass tolerance")
+    parser.add_argument("--smj", type=float, default=0.05, help="p-Value cutoff")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each job type")
+    parser.add_argument("--output", default=None, help="JSON results file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        queries, library = synthetic.dataset_from_args(args)
+        query_file = os.path.join(tmp, 'queries.mgf')
+        synthetic.write_mgf(queries, query_file)
+        library_file = synthetic.write_library(library, tmp, args.library_format)
+        prjpath = os.path.dirname(os.path.abspath(eagleeye_cgi.__file__))
+        if args.library_format == 'dir':
+            # Stands in for the bundled background library
+            os.makedirs(os.path.join(tmp, 'data'))
+            os.rename(library_file, os.path.join(tmp, 'data', eagleeye_cgi.IONTRAP_LIBRARY))
+            library_file, prjpath = None, tmp
+
+        runs = []
+        for request_type in args.types.split(','):
+            params = {'type': request_type, 'uploaded_spectra': query_file, 'pmt': args.pmt, 'fmt': args.fmt,
+                      'smj': args.smj, 'engine': args.engine, 'workers': args.workers,
+                      'prjpath': prjpath}
+            if request_type == 'Filter' and library_file:
+                params['uploaded_background_library'] = library_file
+            for k in range(args.repeat):
+                workdir = os.path.join(tmp, f"{request_type}-{k}")
+                os.makedirs(workdir)
+                runs.append({'type': request_type, 'run': k, 'stages': run_job(workdir, params)})
+
+    summary = {}
+    for request_type in args.types.split(','):
+        rows = [r['stages'] for r in runs if r['type'] == request_type]
+        summary[request_type] = {stage: statistics.median(r[stage] for r in rows) for stage in STAGES + ('total',)}
+
+    results = {
+        'benchmark': 'stages',
+        'version': version(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'dataset': {k: getattr(args, k) for k in ('nquery', 'nlib', 'peaks', 'charges', 'precursor', 'mass_range',
+                                                  'background', 'library_format', 'seed')},
+        'job': {'engine': args.engine, 'pmt': args.pmt, 'fmt': args.fmt, 'smj': args.smj, 'workers': args.workers},
+        'runs': runs,
+        'median': summary,
+    }
+
+    print(f"{args.nquery} queries, library {args.nlib}, engine {args.engine}, median of {args.repeat} runs (s)")
+    print(f"{'stage':<12}" + ''.join(f"{t:>10}" for t in summary))
+    for stage in STAGES + ('total',):
+        print(f"{stage:<12}" + ''.join(f"{summary[t][stage]:>10.3f}" for t in summary))
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=1)
+        print(f"Results: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Filter jobs with a memory budget (queries read, scored and written in
+batches) vs. the whole spectra file in memory.
+
+    $ python -m benchmarks.bench_stream [--nquery 2000] [--nlib 20000] [--budget 1] [--scale 4]
+          [dataset options, see benchmarks.synthetic]
+
+Writes a synthetic dataset whose query file repeats some TITLEs further
+down, and runs it with and without --memory-budget for several option
+sets (cutoff sweep, --top-k, --prune, --dta-output, -e sparse, a
+.mgf.gz spectra file): every output must be byte-identical. Then runs
+both modes on --scale times as many queries and reports their peak RSS,
+which with a budget should not grow with the number of queries.
+"""
+
+import argparse
+import filecmp
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from benchmarks import synthetic
+from msfilter import Spectrum
+
+RUN_EAGLEEYE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run_eagleeye.py')
+
+VARIANTS = {
+    'default': [],
+    'sweep': ['-a', '0.01,0.05,0.2'],
+    'top-k': ['--top-k', '3'],
+    'prune': ['--prune'],
+    'dta-output': ['--dta-output'],
+    'sparse': ['-e', 'sparse'],
+}
+
+
+def run(args: list, cwd: str) -> tuple:
+    """
+    :return: (wall time, peak RSS of the job in MB)
+    """
+    os.makedirs(cwd, exist_ok=True)
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, RUN_EAGLEEYE] + args, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - t0
+    stats = [f for f in os.listdir(cwd) if f.endswith('-stats.json')]
+    with open(os.path.join(cwd, stats[0])) as fin:
+        return elapsed, json.load(fin)['peak_rss_bytes']['self'] / 2**20
+
+
+def zip_members(path: str) -> list:
+    with zipfile.ZipFile(path) as zf:
+        return [(info.filename, zf.read(info)) for info in zf.infolist()]
+
+
+def compare(expected: str, actual: str) -> list:
+    names = sorted(n for n in os.listdir(expected) if not n.endswith(('-params.csv', '-stats.json')))
+    if sorted(n for n in os.listdir(actual) if not n.endswith(('-params.csv', '-stats.json'))) != names:
+        raise Exception(f"Outputs differ: {actual} has other files than {expected}")
+    match, mismatch, errors = filecmp.cmpfiles(expected, actual, names, shallow=False)
+    # ZIP members carry the time they were written
+    mismatch = [n for n in mismatch if not n.endswith('.zip') or
+                zip_members(os.path.join(expected, n)) != zip_members(os.path.join(actual, n))]
+    if mismatch or errors:
+        raise Exception(f"Outputs differ: {mismatch + errors} in {actual}")
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Filter jobs with a memory budget")
+    synthetic.add_arguments(parser)
+    parser.add_argument("--budget", type=float, default=1, help="Memory budget of the streamed runs, MB")
+    parser.add_argument("--scale", type=int, default=4, help="Query set multiple for the memory comparison")
+    args = parser.parse_args()
+    if args.library_format == 'dir':
+        parser.error("the library must be a file")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        queries, library = synthetic.dataset_from_args(args)
+        # Later IONS blocks with the TITLE of earlier ones replace them
+        repeated = [Spectrum(s.precursor_mass, s.charge, q.scan_id, s.mass, s.intensity)
+                    for q, s in zip(queries, synthetic.perturbed(queries[:len(queries) // 20], seed=args.seed + 5))]
+        query_file = os.path.join(tmp, 'queries.mgf')
+        synthetic.write_mgf(queries + repeated, query_file)
+        with open(query_file, 'rb') as fin, gzip.open(query_file + '.gz', 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+        library_file = synthetic.write_library(library, tmp, args.library_format)
+        job = [library_file, '-p', '2', '-f', '0.6', '-a', '0.05']
+        budget = ['--memory-budget', str(args.budget)]
+
+        print(f"{len(queries)} queries ({len(repeated)} TITLEs repeated), library {len(library)}, "
+              f"budget {args.budget} MB")
+        for name, options in list(VARIANTS.items()) + [('mgf.gz', None)]:
+            spectra = query_file + '.gz' if options is None else query_file
+            options = options or []
+            t_whole, _ = run([spectra] + job + options, os.path.join(tmp, name, 'whole'))
+            t_stream, _ = run([spectra] + job + options + budget, os.path.join(tmp, name, 'stream'))
+            match = compare(os.path.join(tmp, name, 'whole'), os.path.join(tmp, name, 'stream'))
+            print(f"{name:12s} in memory {t_whole:7.2f} s  streamed {t_stream:7.2f} s  "
+                  f"{len(match)} outputs identical")
+
+        print("\nPeak RSS, MB (library alone included):")
+        for scale in (1, args.scale):
+            more = synthetic.random_spectra(len(queries) * (scale - 1), seed=args.seed + 7, prefix='more')
+            spectra = os.path.join(tmp, f'queries{scale}.mgf')
+            synthetic.write_mgf(queries + more, spectra)
+            size = os.path.getsize(spectra) / 2**20
+            _, rss_whole = run([spectra] + job, os.path.join(tmp, f'rss{scale}', 'whole'))
+            _, rss_stream = run([spectra] + job + budget, os.path.join(tmp, f'rss{scale}', 'stream'))
+            compare(os.path.join(tmp, f'rss{scale}', 'whole'), os.path.join(tmp, f'rss{scale}', 'stream'))
+            print(f"{len(queries) * scale:8d} queries ({size:6.1f} MB): in memory {rss_whole:7.1f}  "
+                  f"streamed {rss_stream:7.1f}")
+
+
+if __name__ == "__main__":
+    main()
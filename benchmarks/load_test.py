@@ -0,0 +1,189 @@
+"""
+Load test for eagleeye_server.py: concurrent filter jobs against one
+preloaded library.
+
+    $ python -m benchmarks.load_test --spawn [--jobs 32] [--concurrency 4] [--workers 4] [--cold 4]
+    $ python -m benchmarks.load_test --url http://127.0.0.1:8765 --library lib.mgf.gz
+    $ python -m benchmarks.load_test --socket /tmp/eagleeye.sock --library lib.mgf.gz
+
+With --spawn, a synthetic library (.mgf.gz) is generated and a server is
+started on a free localhost port with that library preloaded. Otherwise
+the server must already be running and --library must name a library
+file the server can read. Query files are generated next to the library.
+Job latency (request to final status line) and throughput are reported;
+--cold N also times N plain run_eagleeye.py invocations on the same
+inputs for comparison.
+"""
+
+import argparse
+import concurrent.futures
+import gzip
+import http.client
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from benchmarks.synthetic import perturbed, random_spectra, write_mgf
+from eagleeye_server import UnixHTTPConnection
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUN_EAGLEEYE = os.path.join(PACKAGE_PATH, 'run_eagleeye.py')
+SERVER = os.path.join(PACKAGE_PATH, 'eagleeye_server.py')
+
+
+def connection(url: str, sock: str, timeout: float = 600) -> http.client.HTTPConnection:
+    if sock:
+        return UnixHTTPConnection(sock, timeout=timeout)
+    u = urllib.parse.urlsplit(url)
+    return http.client.HTTPConnection(u.hostname, u.port, timeout=timeout)
+
+
+def post_job(url: str, sock: str, params: dict) -> tuple:
+    """
+    Submits one job and reads its streamed log to the final status line.
+
+    :return: (latency in seconds, status object)
+    """
+    t0 = time.perf_counter()
+    conn = connection(url, sock)
+    try:
+        conn.request('POST', '/jobs', json.dumps(params), {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        body = response.read().decode()
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - t0
+    if response.status != 200:
+        return elapsed, {'status': f'http {response.status}', 'error': body.strip()}
+    return elapsed, json.loads(body.rstrip('\n').rsplit('\n', 1)[-1])
+
+
+def wait_for_server(url: str, proc: subprocess.Popen, timeout: float = 300) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise Exception(f"Server exited with status {proc.returncode}")
+        try:
+            conn = connection(url, None, timeout=5)
+            conn.request('GET', '/status')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise Exception("Server did not start")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a running or spawned EagleEye service")
+    parser.add_argument("--url", default="http://127.0.0.1:8765", help="Service URL")
+    parser.add_argument("--socket", default=None, help="Service Unix socket, instead of --url")
+    parser.add_argument("--spawn", action="store_true", help="Start a local service with a synthetic library")
+    parser.add_argument("--library", default=None, help="Library file known to a running service")
+    parser.add_argument("--workers", type=int, default=4, help="Workers of a spawned service")
+    parser.add_argument("-e", "--engine", choices=("python", "msfilter"), default="python")
+    parser.add_argument("--jobs", type=int, default=32, help="Jobs to submit")
+    parser.add_argument("--concurrency", type=int, default=4, help="Jobs in flight at once")
+    parser.add_argument("--nquery", type=int, default=200, help="Spectra per job")
+    parser.add_argument("--nlib", type=int, default=20000, help="Size of a generated library")
+    parser.add_argument("--cold", type=int, default=0, help="Also time N run_eagleeye.py invocations")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if not args.spawn and not args.library:
+        parser.error("--library is required unless --spawn is given")
+
+    tmp = tempfile.mkdtemp(prefix='eagleeye-load-')
+    server = None
+    try:
+        library = random_spectra(args.nlib, seed=args.seed, prefix='lib')
+        if args.spawn:
+            write_mgf(library, os.path.join(tmp, 'library.mgf'))
+            with open(os.path.join(tmp, 'library.mgf'), 'rb') as fin, \
+                    gzip.open(os.path.join(tmp, 'library.mgf.gz'), 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+            os.remove(os.path.join(tmp, 'library.mgf'))
+            args.library = os.path.join(tmp, 'library.mgf.gz')
+            args.socket = None
+            args.url = f"http://127.0.0.1:{free_port()}"
+            t0 = time.perf_counter()
+            server = subprocess.Popen(
+                [sys.executable, SERVER, '--port', args.url.rsplit(':', 1)[1], '--workers', str(args.workers),
+                 '--preload', args.library, '-e', args.engine, '--workdir', os.path.join(tmp, 'jobs')],
+                cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_for_server(args.url, server)
+            print(f"service started in {time.perf_counter() - t0:.2f} s, {args.workers} workers")
+        library_file = os.path.abspath(args.library)
+
+        # A handful of distinct query files, reused round-robin
+        queries = []
+        for k in range(min(args.jobs, 8)):
+            half = args.nquery // 2
+            start = (k * half) % max(1, args.nlib - half)
+            spectra = perturbed(library[start:start + half], seed=args.seed + k, prefix=f'dup{k}_') + \
+                random_spectra(args.nquery - half, seed=args.seed + 1000 + k, prefix=f'rnd{k}_')
+            name = os.path.join(tmp, f"run{k:03d}.mgf")
+            write_mgf(spectra, name)
+            queries.append(name)
+
+        def job(k: int) -> tuple:
+            return post_job(args.url, args.socket, {
+                'type': 'Filter', 'engine': args.engine,
+                'uploaded_spectra': queries[k % len(queries)],
+                'uploaded_background_library': library_file,
+                'pmt': 2, 'fmt': 0.6, 'smj': 0.05,
+            })
+
+        t0 = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+            results = list(pool.map(job, range(args.jobs)))
+        wall = time.perf_counter() - t0
+
+        latencies = [t for t, r in results if r.get('status') == 'done']
+        failed = [r for t, r in results if r.get('status') != 'done']
+        print(f"{args.jobs} jobs x {args.nquery} spectra, concurrency {args.concurrency}, engine {args.engine}")
+        print(f"done {len(latencies)}, failed {len(failed)}")
+        for r in failed[:3]:
+            print(f"  {r.get('status')}: {r.get('error')}")
+        if latencies:
+            print(f"throughput: {len(latencies) / wall:8.2f} jobs/s  ({wall:.2f} s)")
+            print(f"latency s:  p50 {statistics.median(latencies):.3f}  p95 {percentile(latencies, 0.95):.3f}"
+                  f"  max {max(latencies):.3f}")
+
+        if args.cold:
+            cold = os.path.join(tmp, 'cold')
+            os.makedirs(cold)
+            times = []
+            for k in range(args.cold):
+                t0 = time.perf_counter()
+                subprocess.run([sys.executable, RUN_EAGLEEYE, queries[k % len(queries)], library_file,
+                                '-p', '2', '-f', '0.6', '-a', '0.05', '-e', args.engine],
+                               cwd=cold, check=True, stdout=subprocess.DEVNULL)
+                times.append(time.perf_counter() - t0)
+            print(f"cold run_eagleeye.py: p50 {statistics.median(times):.3f} s per job")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
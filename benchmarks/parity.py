@@ -0,0 +1,107 @@
+"""
+Parity check of the NumPy engine against the msfilter binary.
+
+    $ g++ -O2 -o msfilter src/msfilter.cc src/correlations_eagle_eye_bins_6norms.cc
+    $ python -m benchmarks.parity --msfilter ./msfilter
+
+Generates synthetic query and library directories (or uses the ones given),
+runs both engines and compares every (query, match) DScore. Exits non-zero
+if any pair is missing on either side or deviates by more than --tolerance.
+"""
+
+import argparse
+import math
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from benchmarks.synthetic import perturbed, random_spectra, write_dta_directory
+from msfilter import Spectrum, msfilter, read_directory
+
+EYE_CATCHING_HEIGHT = 0.05
+
+
+def parse_msfilter_output(text: str) -> dict:
+    scores = {}
+    for line in text.splitlines():
+        arr = line.split()
+        if len(arr) < 7:
+            continue
+        scores[(os.path.basename(arr[0]), os.path.basename(arr[1]))] = float(arr[-1])
+    return scores
+
+
+def make_dataset(directory: str, nlib: int, nquery: int, seed: int) -> tuple:
+    """
+    Library of random spectra; queries are half near-duplicates of library
+    spectra and half unrelated, with a few unsorted peak lists mixed in to
+    exercise the sequential matching path.
+    """
+    library = random_spectra(nlib, seed=seed, prefix='lib')
+    queries = perturbed(library[:nquery // 2], seed=seed + 1) + \
+        random_spectra(nquery - nquery // 2, seed=seed + 2, prefix='rnd')
+    rng = np.random.default_rng(seed + 3)
+    for k in range(0, len(queries), 17):
+        s = queries[k]
+        order = rng.permutation(len(s.mass))
+        queries[k] = Spectrum(s.precursor_mass, s.charge, s.scan_id, s.mass[order], s.intensity[order])
+    qdir, ldir = os.path.join(directory, 'queries'), os.path.join(directory, 'library')
+    write_dta_directory(queries, qdir)
+    write_dta_directory(library, ldir)
+    return qdir, ldir
+
+
+def compare(binary: str, qdir: str, ldir: str, pmt: float, fmt: float) -> tuple:
+    out = subprocess.run([binary, qdir, ldir, str(EYE_CATCHING_HEIGHT), str(pmt), str(fmt)],
+                         check=True, capture_output=True, text=True).stdout
+    expected = parse_msfilter_output(out)
+
+    queries, library = read_directory(qdir), read_directory(ldir)
+    table = msfilter(queries, library, EYE_CATCHING_HEIGHT, pmt, fmt)
+    actual = {}
+    for i, j, ds in zip(table.query.tolist(), table.match.tolist(), table.dscore.tolist()):
+        lid = os.path.basename(library[j].scan_id) if j >= 0 else 'no_bckgr_spectra_with_same_precursor_mass'
+        actual[(os.path.basename(queries[i].scan_id), lid)] = ds
+
+    missing = set(expected) ^ set(actual)
+    worst = 0.0
+    for key in set(expected) & set(actual):
+        a, b = expected[key], actual[key]
+        if math.isnan(a) and math.isnan(b):
+            continue
+        # msfilter prints 6 significant digits
+        worst = max(worst, abs(a - b) / max(abs(a), 1e-12) if a else abs(b))
+    return len(expected), missing, worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare NumPy engine scores with the msfilter binary")
+    parser.add_argument("--msfilter", default="msfilter", help="Path to the msfilter binary")
+    parser.add_argument("--queries", help="Query .dta directory (default: synthetic)")
+    parser.add_argument("--library", help="Library .dta directory (default: synthetic)")
+    parser.add_argument("--nlib", type=int, default=400, help="Synthetic library size")
+    parser.add_argument("--nquery", type=int, default=100, help="Synthetic query count")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=1e-5, help="Maximum relative DScore deviation")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.queries and args.library:
+            qdir, ldir = args.queries, args.library
+        else:
+            qdir, ldir = make_dataset(tmp, args.nlib, args.nquery, args.seed)
+        for pmt, fmt in ((2.0, 0.6), (0.5, 0.5), (10.0, 0.2), (3.0, 1.0)):
+            npairs, missing, worst = compare(args.msfilter, qdir, ldir, pmt, fmt)
+            ok = not missing and worst <= args.tolerance
+            failed |= not ok
+            print(f"pmt={pmt:<5} fmt={fmt:<4} pairs={npairs:<7} missing={len(missing):<4} "
+                  f"max_rel_dev={worst:.2e} {'OK' if ok else 'FAIL'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Synthetic spectra for benchmarks and parity checks.
+
+Also writes complete datasets, a query MGF plus a library, for runs of
+run_eagleeye.py outside the benchmarks:
+
+    $ python -m benchmarks.synthetic OUTDIR [--nquery 2000] [--nlib 20000] [--charges 2:0.7,3:0.3]
+          [--precursor normal] [--background 0.3] [--library-format mgf.gz]
+"""
+
+import argparse
+import gzip
+import os
+import shutil
+import tarfile
+import zipfile
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from msfilter import Spectrum
+
+PRECURSOR_DISTRIBUTIONS = ('uniform', 'normal')
+LIBRARY_FORMATS = ('mgf', 'mgf.gz', 'dta.zip', 'dta.tgz', 'dir')
+
+
+def random_spectra(n: int, seed: int = 0, peaks: int = 100, charges=(2, 3),
+                   mass_range=(800.0, 3500.0), prefix: str = 'syn', charge_weights: Sequence[float] = None,
+                   precursor: str = 'uniform') -> List[Spectrum]:
+    """
+    Generates n random peptide-like spectra with sorted peak lists.
+
+    :param peaks: Mean number of peaks per spectrum (Poisson distributed)
+    :param charge_weights: Relative frequency of each of `charges` (default: equal)
+    :param precursor: Precursor mass distribution over mass_range: 'uniform',
+        or 'normal' around its midpoint with a sixth of its width as s.d.
+    """
+    if precursor not in PRECURSOR_DISTRIBUTIONS:
+        raise Exception(f"Unknown precursor mass distribution: {precursor}")
+    rng = np.random.default_rng(seed)
+    p = np.asarray(charge_weights, dtype=float) / np.sum(charge_weights) if charge_weights else None
+    lo, hi = mass_range
+    spectra = []
+    for k in range(n):
+        charge = int(rng.choice(charges, p=p))
+        if precursor == 'uniform':
+            pm = float(np.round(rng.uniform(lo, hi), 4))
+        else:
+            pm = float(np.round(np.clip(rng.normal((lo + hi) / 2, (hi - lo) / 6), lo, hi), 4))
+        npeaks = max(1, int(rng.poisson(peaks)))
+        mass = np.sort(np.round(rng.uniform(100.0, pm, npeaks), 4))
+        intensity = np.round(rng.lognormal(4.0, 1.2, npeaks), 2)
+        spectra.append(Spectrum(pm, charge, f"{prefix}{k:07d}", mass, intensity))
+    return spectra
+
+
+def perturbed(spectra: List[Spectrum], seed: int = 1, jitter: float = 0.2, prefix: str = 'dup') -> List[Spectrum]:
+    """
+    Near-duplicates of the given spectra: precursor and fragment masses are
+    shifted by up to `jitter` Da and intensities rescaled by up to 50%.
+    """
+    rng = np.random.default_rng(seed)
+    result = []
+    for k, s in enumerate(spectra):
+        mass = np.sort(np.round(s.mass + rng.uniform(-jitter, jitter, len(s.mass)), 4))
+        intensity = np.round(s.intensity * rng.uniform(0.5, 1.5, len(s.intensity)), 2)
+        pm = round(s.precursor_mass + float(rng.uniform(-jitter, jitter)), 4)
+        result.append(Spectrum(pm, s.charge, f"{prefix}{k:07d}", mass, intensity))
+    return result
+
+
+def write_dta_directory(spectra: List[Spectrum], directory: str) -> None:
+    """
+    Writes spectra as <scan_id>.<charge>.dta files.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for s in spectra:
+        with open(os.path.join(directory, f"{s.scan_id}.{s.charge}.dta"), 'w') as fout:
+            fout.write(f"{s.precursor_mass} {s.charge}\n")
+            for m, i in zip(s.mass.tolist(), s.intensity.tolist()):
+                fout.write(f"{m} {i}\n")
+
+
+def write_mgf(spectra: List[Spectrum], path: str) -> None:
+    """
+    Writes spectra as an MGF file, one IONS block per spectrum.
+    """
+    with open(path, 'w') as fout:
+        for s in spectra:
+            mz = (s.precursor_mass - 1.007825) / s.charge + 1.007825
+            fout.write(f"BEGIN IONS\nTITLE={s.scan_id}\nCHARGE={s.charge}+\nPEPMASS={mz:.6f}\n")
+            for m, i in zip(s.mass.tolist(), s.intensity.tolist()):
+                fout.write(f"{m} {i}\n")
+            fout.write("END IONS\n\n")
+
+
+def dataset(nquery: int, nlib: int, seed: int = 0, background: float = 0.5, jitter: float = 0.2,
+            **kwargs) -> Tuple[List[Spectrum], List[Spectrum]]:
+    """
+    A query set and a library. A `background` fraction of the queries are
+    near-duplicates of library spectra, the rest are unrelated.
+
+    :param kwargs: Passed to random_spectra(): peaks, charges, charge_weights,
+        precursor, mass_range
+    :return: (queries, library)
+    """
+    library = random_spectra(nlib, seed=seed, prefix='lib', **kwargs)
+    rng = np.random.default_rng(seed + 1)
+    ndup = min(nlib, int(round(nquery * background)))
+    picked = sorted(rng.choice(nlib, ndup, replace=False).tolist()) if ndup else []
+    queries = perturbed([library[k] for k in picked], seed=seed + 2, jitter=jitter) + \
+        random_spectra(nquery - ndup, seed=seed + 3, prefix='rnd', **kwargs)
+    return queries, library
+
+
+def write_library(spectra: List[Spectrum], directory: str, fmt: str = 'mgf.gz') -> str:
+    """
+    Writes a library in one of LIBRARY_FORMATS, as accepted for a
+    user-supplied library (or, for 'dir', a .dta directory like the bundled one).
+
+    :return: Path of the written library
+    """
+    if fmt not in LIBRARY_FORMATS:
+        raise Exception(f"Unknown library format: {fmt}")
+    os.makedirs(directory, exist_ok=True)
+    if fmt.startswith('mgf'):
+        path = os.path.join(directory, 'library.mgf')
+        write_mgf(spectra, path)
+        if fmt == 'mgf.gz':
+            with open(path, 'rb') as fin, gzip.open(path + '.gz', 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+            os.remove(path)
+            path += '.gz'
+        return path
+    dtadir = os.path.join(directory, 'library')
+    write_dta_directory(spectra, dtadir)
+    if fmt == 'dir':
+        return dtadir
+    names = sorted(os.listdir(dtadir))
+    if fmt == 'dta.zip':
+        path = os.path.join(directory, 'library.dta.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for name in names:
+                zf.write(os.path.join(dtadir, name), name)
+    else:
+        path = os.path.join(directory, 'library.dta.tgz')
+        with tarfile.open(path, 'w:gz') as tf:
+            for name in names:
+                tf.add(os.path.join(dtadir, name), name)
+    shutil.rmtree(dtadir)
+    return path
+
+
+def parse_charges(text: str) -> Tuple[tuple, list]:
+    """
+    Parses a charge mix such as '2:0.7,3:0.3' (or '2,3' for equal weights).
+
+    :return: (charges, weights)
+    """
+    charges, weights = [], []
+    for item in text.split(','):
+        charge, _, weight = item.partition(':')
+        charges.append(int(charge))
+        weights.append(float(weight) if weight else 1.0)
+    return tuple(charges), weights
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Dataset options shared by the generator and the benchmarks that use it.
+    """
+    parser.add_argument("--nquery", type=int, default=2000, help="Query spectra")
+    parser.add_argument("--nlib", type=int, default=20000, help="Library spectra")
+    parser.add_argument("--peaks", type=int, default=100, help="Mean number of peaks per spectrum")
+    parser.add_argument("--charges", default="2:0.5,3:0.5", help="Charge mix, e.g. 2:0.7,3:0.3")
+    parser.add_argument("--precursor", choices=PRECURSOR_DISTRIBUTIONS, default="uniform",
+                        help="Precursor mass distribution")
+    parser.add_argument("--mass-range", type=float, nargs=2, default=(800.0, 3500.0), help="Precursor mass range")
+    parser.add_argument("--background", type=float, default=0.5,
+                        help="Fraction of queries that are near-duplicates of library spectra")
+    parser.add_argument("--library-format", choices=LIBRARY_FORMATS, default="mgf.gz")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def dataset_from_args(args: argparse.Namespace) -> Tuple[List[Spectrum], List[Spectrum]]:
+    charges, weights = parse_charges(args.charges)
+    return dataset(args.nquery, args.nlib, seed=args.seed, background=args.background, peaks=args.peaks,
+                   charges=charges, charge_weights=weights, precursor=args.precursor,
+                   mass_range=tuple(args.mass_range))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic EagleEye dataset")
+    parser.add_argument("outdir", help="Directory for queries.mgf and the library")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    queries, library = dataset_from_args(args)
+    os.makedirs(args.outdir, exist_ok=True)
+    write_mgf(queries, os.path.join(args.outdir, 'queries.mgf'))
+    path = write_library(library, args.outdir, args.library_format)
+    print(f"{len(queries)} queries: {os.path.join(args.outdir, 'queries.mgf')}")
+    print(f"{len(library)} library spectra: {path}")
+
+
+if __name__ == "__main__":
+    main()
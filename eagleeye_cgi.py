@@ -1,30 +1,48 @@
 # Scaffold created by GitHub Co-pilot
 
+import contextlib
+import cProfile
 import os
 import shutil
 import tempfile
 import subprocess
 import csv
-import glob
 from datetime import datetime
-
-from preprocessLibrary import main as preprocessLibrary_main
-from make_nonredundant import main as make_nonredundant_main
+from typing import Dict, Iterable, List, Tuple, Union
+
+import jobstats
+import libindex
+import msfilter
+import msfilter_sparse
+import planner
+import resultsdb
+import scorecache
+import spectra_io
+import streamfilter
+from preprocessLibrary import preprocess_store
+from make_nonredundant import open_table, read_graph, select_nonredundant
+
+
+def parse_params(lines: Iterable[str]) -> dict:
+    """
+    Parses query parameters, key=value per line.
+    """
+    params = {}
+    for line in lines:
+        line = line.strip()
+        if not line or '=' not in line:
+            continue
+        k, v = line.split('=', 1)
+        params[k] = v
+    return params
 
 
 def read_params(qfile: str) -> dict:
     """
     Reads query parameters from a file (key=value per line).
     """
-    params = {}
     with open(qfile) as f:
-        for line in f:
-            line = line.strip()
-            if not line or '=' not in line:
-                continue
-            k, v = line.split('=', 1)
-            params[k] = v
-    return params
+        return parse_params(f)
 
 
 def mgf2dta(mgfile: str, dtapath: str) -> None:
@@ -32,92 +50,8 @@ def mgf2dta(mgfile: str, dtapath: str) -> None:
     Converts an MGF file to DTA files in the specified directory.
     Each ion is written as a single .dta file, with associated meta info.
     """
-    os.makedirs(dtapath, exist_ok=True)
-    gtitle = gcharge = gpepmass = ''
-    title = charge = pepmass = ''
-    t = c = m = None
-    cc = []
-    sbuffer = ''
-    gbuffer = ''
-    lbuffer = ''
-    globals_flag = True
-    locals_flag = False
-    mgfname = os.path.basename(mgfile)
-    with open(mgfile, 'r') as fin:
-        for line in fin:
-            line = line.rstrip('\r\n')
-            if line.startswith('TITLE='):
-                if globals_flag:
-                    gtitle = line[6:]
-                elif locals_flag:
-                    title = line[6:]
-            elif line.startswith('CHARGE='):
-                if globals_flag:
-                    gcharge = line[7:]
-                elif locals_flag:
-                    charge = line[7:]
-            elif line.startswith('PEPMASS='):
-                if globals_flag:
-                    gpepmass = line[8:]
-                elif locals_flag:
-                    pepmass = line[8:]
-            elif line.startswith('BEGIN IONS'):
-                globals_flag = False
-                locals_flag = True
-                continue
-            elif line.startswith('END IONS'):
-                # Write DTA file(s) for all charge states
-                if c:
-                    cc = [x.replace('+', '').replace('-', '').strip() for x in c.split('and')]
-                else:
-                    cc = ['2', '3']
-                for chargevar in cc:
-                    dta = t or ''
-                    dta = dta.replace('.dta', '').rsplit('.', 1)[0] if '.dta' in dta else dta
-                    # URL encode (simple, for safety)
-                    dta = ''.join(['%%%02X' % ord(ch) if not ch.isalnum() and ch not in ',._-=' else ch for ch in dta])
-                    meta = dta
-                    dta_file = os.path.join(dtapath, f"{dta}.{chargevar}.dta")
-                    dtamass = float(m) if m else 0.0
-                    dtamass = ((dtamass - 1.007825) * float(chargevar)) + 1.007825
-                    with open(dta_file, 'w') as f_out:
-                        f_out.write(f"{dtamass} {chargevar}\n")
-                        f_out.write(sbuffer)
-                    # Write local spectrum metadata
-                    if lbuffer:
-                        meta_file = os.path.join(dtapath, f"{meta}.{chargevar}.meta")
-                        with open(meta_file, 'w') as f_meta:
-                            f_meta.write(lbuffer)
-                # Reset for next ion
-                title = charge = pepmass = t = c = m = None
-                sbuffer = lbuffer = ''
-                cc = []
-                globals_flag = True
-                locals_flag = False
-                continue
-            elif line and all(
-                    x.replace('.', '', 1).replace('E', '', 1).replace('+', '', 1).replace('-', '', 1).isdigit() for x in
-                    line.split()):
-                # peak data line
-                if globals_flag:
-                    raise Exception(f"Illegal global parameter in file: {mgfname}")
-                if locals_flag:
-                    t = title or gtitle
-                    c = charge or gcharge
-                    m = pepmass or gpepmass
-                    if not t or not c or not m:
-                        raise Exception("Missing precursor info in mgf2dta")
-                    locals_flag = False
-                sbuffer += line + '\n'
-            if globals_flag:
-                gbuffer += line + '\n'
-            elif locals_flag:
-                lbuffer += line + '\n'
-    # Save global MGF parameters
-    if gbuffer:
-        gfile = os.path.join(dtapath, 'globals.meta')
-        with open(gfile, 'w') as fout:
-            fout.write(gbuffer)
+    records, globals_meta = spectra_io.read_mgf(mgfile)
+    spectra_io.write_dta_directory(records, globals_meta, dtapath)
 
 
 def dta2mgf(dtapath: str, mgfname: str) -> None:
@@ -125,369 +59,513 @@ def dta2mgf(dtapath: str, mgfname: str) -> None:
     Converts a directory of DTA files to an MGF file.
     Each DTA file becomes an IONS block in the MGF.
     """
-    with open(mgfname, 'w') as fout:
-        # Copy global parameters if present
-        gfile = os.path.join(dtapath, 'globals.meta')
-        if os.path.exists(gfile):
-            with open(gfile, 'r') as gf:
-                fout.write(gf.read())
-        for file in sorted(glob.glob(os.path.join(dtapath, '*.dta'))):
-            name = os.path.basename(file)
-            with open(file, 'r') as fin:
-                header = fin.readline().strip()
-                if not header:
-                    continue
-                MH, Z = header.split()
-                MH = float(MH)
-                Z = int(Z)
-                fout.write("BEGIN IONS\n")
-                MoverZ = (MH + (Z - 1) * 1.007825) / Z
-                title = name
-                # Simple URL decode (for coverage)
-                import re
-                title = re.sub(r'%([A-Fa-f0-9]{2})', lambda m: chr(int(m.group(1), 16)), title)
-                # Copy local meta if present
-                lfile = file[:-4] + '.meta'
-                intensity = None
-                extras = ''
-                if os.path.exists(lfile):
-                    with open(lfile, 'r') as lf:
-                        for line in lf:
-                            if line.strip().startswith('TITLE='):
-                                fout.write(f"TITLE={title}\n")
-                                title = ''
-                            elif line.strip().startswith('CHARGE='):
-                                fout.write(f"CHARGE={Z}+\n")
-                                Z = ''
-                            elif line.strip().startswith('PEPMASS='):
-                                parts = line.strip().split('=')
-                                if len(parts) > 1:
-                                    vals = parts[1].split()
-                                    if len(vals) > 1:
-                                        intensity = vals[1]
-                                if intensity:
-                                    fout.write(f"PEPMASS={MoverZ} {intensity}\n")
-                                else:
-                                    fout.write(f"PEPMASS={MoverZ}\n")
-                                MoverZ = ''
-                            else:
-                                extras += line
-                if title:
-                    fout.write(f"TITLE={title}\n")
-                if Z:
-                    fout.write(f"CHARGE={Z}+\n")
-                if MoverZ != '':
-                    fout.write(f"PEPMASS={MoverZ}\n")
-                if extras:
-                    fout.write(extras)
-                for line in fin:
-                    line = line.strip()
-                    if line and all(
-                            x.replace('.', '', 1).replace('E', '', 1).replace('+', '', 1).replace('-', '', 1).isdigit()
-                            for x in line.split()):
-                        one, two = line.split()
-                        fout.write(f"{one}\t{two}\n")
-                    else:
-                        raise Exception(f"Invalid data format in file {name}: {line}")
-                fout.write("END IONS\n\n")
+    records, globals_meta = spectra_io.read_dta_records(dtapath)
+    spectra_io.write_mgf(records, globals_meta, mgfname)
 
 
-def processtable(INPUT_FILE: str, OUTPUT_FILE: str, SMJ: float, UPLOAD_NAME: str,
-                 NUMFILES: int, MGF_FLAG: bool, SUFFIX: str) -> None:
+def best_matches(INPUT_FILE: Union[str, Iterable[str]]) -> Tuple[list, float, float]:
     """
-    Processes the filtered table, classifies spectra as 'Good' or 'Background',
-    copies DTA/meta files to temporary dirs, and outputs a summary table (CSV).
-    """
-    import math
-    gd = tempfile.mkdtemp()
-    bd = tempfile.mkdtemp()
-    copied = {}
-    datapath = None
-    good_flag = False
-    backgr_flag = False
-
-    with open(INPUT_FILE, 'r') as fin, open(OUTPUT_FILE, 'w', newline='') as fout:
-        fout.write("{:<40}\t{:<40}\t{:7}\t{:9}\t{:10}\n".format(
-            '#Query', 'Matched', 'DScore', 'p-Value', 'Prediction'
-        ))
+    The first row of each query in a sorted score table, which decides its
+    classification at any cutoff.
+
+    :param INPUT_FILE: Sorted score table, a file name or the table lines
+    :return: (query file as in the table, query name, matched name, DScore,
+        p-value) of each query, in table order; the lowest and highest
+        p-value of all rows
+    """
+    matches = []
+    seen = set()
+    lowest, highest = float('inf'), float('-inf')
+    with open_table(INPUT_FILE) as fin:
         for line in fin:
             arr = line.strip().split()
             if len(arr) < 7:
                 continue
             sfile, lfile, *_, ds = arr
-            if not datapath:
-                datapath = os.path.dirname(sfile)
-            import re
-            # URL decode
-            sfile = re.sub(r'%([A-Fa-f0-9]{2})', lambda m: chr(int(m.group(1), 16)), os.path.basename(sfile))
-            lfile = re.sub(r'%([A-Fa-f0-9]{2})', lambda m: chr(int(m.group(1), 16)), os.path.basename(lfile))
             ds = float(ds)
-            if ds == 1.0:
-                pvalue = 1
-            elif ds > 0:
-                pvalue = 1 - math.exp(-(ds / 0.832697) ** 8.87259)
-            else:
-                pvalue = 0
-            if pvalue < SMJ:
-                backgr_flag = True
-                if not copied.get(sfile, False):
-                    shutil.copy(arr[0], bd)
-                    metafile = arr[0][:-4] + '.meta' if arr[0].endswith('.dta') else arr[0] + '.meta'
-                    if os.path.exists(metafile):
-                        shutil.copy(metafile, bd)
-                    copied[sfile] = True
-                    fout.write("{:<40}\t{:<40}\t{:.4f}\t{:.6f}\t{:10}\n".format(
-                        sfile, lfile, ds, pvalue, 'Background'))
-            else:
-                good_flag = True
-                if not copied.get(sfile, False):
-                    shutil.copy(arr[0], gd)
-                    metafile = arr[0][:-4] + '.meta' if arr[0].endswith('.dta') else arr[0] + '.meta'
-                    if os.path.exists(metafile):
-                        shutil.copy(metafile, gd)
-                    copied[sfile] = True
-                    fout.write("{:<40}\t{:<40}\t{:.4f}\t{:.6f}\t{:10}\n".format(
-                        sfile, lfile, ds, pvalue, 'Good'))
-
-    # Copy global meta to good/backgr if present
-    globals_file = os.path.join(datapath, 'globals.meta') if datapath else None
-    if globals_file and os.path.exists(globals_file) and os.path.getsize(globals_file) > 0:
-        shutil.copy(globals_file, gd)
-        shutil.copy(globals_file, bd)
-
-    if MGF_FLAG:
-        gf = f"{UPLOAD_NAME}{SUFFIX}-good.mgf"
-        bf = f"{UPLOAD_NAME}{SUFFIX}-background.mgf"
-        if good_flag:
-            dta2mgf(gd, gf)
-        if backgr_flag:
-            dta2mgf(bd, bf)
-    else:
-        gf = f"{UPLOAD_NAME}{SUFFIX}-good.zip"
-        bf = f"{UPLOAD_NAME}{SUFFIX}-background.zip"
-        if good_flag:
-            shutil.make_archive(gf.replace('.zip', ''), 'zip', gd)
-        if backgr_flag:
-            shutil.make_archive(bf.replace('.zip', ''), 'zip', bd)
+            pvalue = msfilter.pvalue(ds)
+            lowest, highest = min(lowest, pvalue), max(highest, pvalue)
+            sname = spectra_io.url_decode(os.path.basename(sfile))
+            if sname in seen:
+                continue
+            seen.add(sname)
+            matches.append((sfile, sname, spectra_io.url_decode(os.path.basename(lfile)), ds, pvalue))
+    return matches, lowest, highest
 
-    shutil.rmtree(gd)
-    shutil.rmtree(bd)
 
+# Header and row format of the <name>-table.csv output
+TABLE_HEADER = "{:<40}\t{:<40}\t{:7}\t{:9}\t{:10}\n".format('#Query', 'Matched', 'DScore', 'p-Value', 'Prediction')
+TABLE_ROW = "{:<40}\t{:<40}\t{:.4f}\t{:.6f}\t{:10}\n"
 
-def main(qfile: str):
-    params = read_params(qfile)
 
-    WRK_PATH = os.environ.get('PWD', os.getcwd())
-    PRJ_PATH = params.get('prjpath', WRK_PATH)
-    DATA_PATH = os.path.join(PRJ_PATH, 'data')
-    SUFFIX = params.get('suffix', '')
-    SUFFIX = f'-{SUFFIX}' if SUFFIX else ''
-    IONTRAP_LIBRARY = 'redundant-library-1.11v'
+def processtable(INPUT_FILE: Union[str, Iterable[str], None], OUTPUT_FILE: str, SMJ: float, UPLOAD_NAME: str,
+                 NUMFILES: int, MGF_FLAG: bool, SUFFIX: str,
+                 records: Dict[str, spectra_io.SpectrumRecord] = None, globals_meta: str = None,
+                 stats: jobstats.JobStats = None, best: tuple = None) -> Tuple[int, int]:
+    """
+    Processes the filtered table, classifies spectra as 'Good' or 'Background',
+    writes good/background spectra (MGF or zipped DTA), and outputs a summary table (CSV).
+
+    :param INPUT_FILE: Sorted score table, a file name or the table lines
+    :param records: Query spectra keyed by .dta file name; read from the
+        directory the table refers to when not given
+    :param globals_meta: Global MGF parameters to copy into the outputs
+    :param stats: Job statistics to record the table and output stages in
+    :param best: best_matches() of the table, when classifying it at
+        several cutoffs; INPUT_FILE is not read then
+    :return: Number of good and background spectra
+    """
+    good = []
+    background = []
+    stage = stats.stage if stats is not None else jobstats.null_stage
+
+    with stage('table'):
+        matches, lowest, highest = best if best is not None else best_matches(INPUT_FILE)
+        with open(OUTPUT_FILE, 'w', newline='') as fout:
+            fout.write(TABLE_HEADER)
+            for sfile, sname, lname, ds, pvalue in matches:
+                if pvalue < SMJ:
+                    background.append(os.path.basename(sfile))
+                    prediction = 'Background'
+                else:
+                    good.append(os.path.basename(sfile))
+                    prediction = 'Good'
+                fout.write(TABLE_ROW.format(sname, lname, ds, pvalue, prediction))
+
+    # Any row, not only the first of a query, flags the output files to write
+    good_flag, backgr_flag = highest >= SMJ, lowest < SMJ
+    if stats is not None:
+        stats.count(good=len(good), background=len(background))
+
+    with stage('output'):
+        if records is None:
+            datapath = os.path.dirname(matches[0][0]) if matches else None
+            dtarecords, globals_meta = spectra_io.read_dta_records(datapath or '.')
+            records = spectra_io.by_name(dtarecords)
+
+        if MGF_FLAG:
+            gf = f"{UPLOAD_NAME}{SUFFIX}-good.mgf"
+            bf = f"{UPLOAD_NAME}{SUFFIX}-background.mgf"
+            if good_flag:
+                spectra_io.write_mgf([records[n] for n in good], globals_meta, gf)
+            if backgr_flag:
+                spectra_io.write_mgf([records[n] for n in background], globals_meta, bf)
+        else:
+            gf = f"{UPLOAD_NAME}{SUFFIX}-good.zip"
+            bf = f"{UPLOAD_NAME}{SUFFIX}-background.zip"
+            if good_flag:
+                spectra_io.write_dta_zip([records[n] for n in good], globals_meta, gf)
+            if backgr_flag:
+                spectra_io.write_dta_zip([records[n] for n in background], globals_meta, bf)
+    return len(good), len(background)
 
-    file = params.get('uploaded_spectra')
-    if not file:
-        raise Exception("No spectra file(s) submitted")
+
+IONTRAP_LIBRARY = 'redundant-library-1.11v'
+
+
+def parse_cutoffs(value: Union[str, float]) -> List[float]:
+    """
+    p-Value cutoffs of a job, in increasing order: one value, or a
+    comma-separated list for a sweep.
+    """
+    try:
+        cutoffs = sorted({float(v) for v in str(value).split(',') if v.strip()})
+    except ValueError:
+        raise Exception(f"Invalid p-value cutoff: {value}")
+    if not cutoffs:
+        raise Exception("No p-value cutoff given")
+    return cutoffs
+
+
+def read_manifest(path: str, suffix: str = '') -> List[Tuple[str, str]]:
+    """
+    Reads a batch manifest: one spectra file per line, optionally followed by
+    the output suffix for that file. Blank lines and lines starting with '#'
+    are skipped.
+
+    :param suffix: Output suffix of files listed without one
+    :return: (spectra file, suffix) pairs
+    """
+    inputs = []
+    with open(path) as fin:
+        for line in fin:
+            arr = line.split()
+            if not arr or arr[0].startswith('#'):
+                continue
+            if len(arr) > 2:
+                raise Exception(f"Invalid manifest line in {path}: {line.strip()}")
+            inputs.append((arr[0], arr[1] if len(arr) > 1 else suffix))
+    return inputs
+
+
+def output_name(file: str, suffix: str) -> str:
+    """
+    Common prefix of the output files of one spectra file.
+    """
     spectra = os.path.basename(file)
+    if ':' in spectra:
+        spectra = spectra.split(':', 1)[1]
+    return spectra.split('.')[0] + (f'-{suffix}' if suffix else '')
+
+
+def load_library(params: dict, data_path: str) -> dict:
+    """
+    Reads and preprocesses the background library once, for all spectra
+    files of a job.
+
+    :return: Library state: 'records' (user-supplied library, by name),
+        'numfiles', 'libtemp' (temporary .dta directory to remove),
+        'libpath' (.dta directory for the msfilter binary), 'background'
+        and 'peaks' (spectra and peak lists for the in-process engines),
+        'bins' (binned peak lists for the sparse engine, set by
+        process_spectra()), 'stats' (JobStats of the library stage),
+        'fingerprint' (set by score_cache_key()), 'histogram' (precursor
+        masses, set by planner.plan_job())
+    """
+    stats = jobstats.JobStats()
+    with stats.stage('library'):
+        lib = _load_library(params, data_path)
+    if lib['numfiles']:
+        stats.count(library_files=lib['numfiles'])
+    lib['stats'] = stats
+    return lib
 
-    DATATEMP = tempfile.mkdtemp()
-    cleanup = []
 
+def _load_library(params: dict, data_path: str) -> dict:
     library = params.get('uploaded_background_library')
     request_type = params.get('type')
-    pmt = params.get('pmt')
-    fmt = params.get('fmt')
-    smj = float(params.get('smj', 0.05))
-    request_name = None
-    mgf_flag = False
-    mgflib_flag = False
-    rs = None
-
-    print("Eagle Eye v1.66\n")
+    engine = params.get('engine', 'python')
+    cache_dir = params.get('library_cache')
+    lib = {'records': None, 'numfiles': 0, 'libtemp': None, 'libpath': None, 'background': None, 'peaks': None,
+           'bins': None, 'fingerprint': None, 'histogram': None}
 
-    # Archive extraction
-    if ':' in spectra:
-        sarc, sfile = spectra.split(':', 1)
-        arcbase, arcext = os.path.splitext(sarc)
-        if arcext == '.zip':
-            cmd = f"unzip -qq -j -o {sarc} {sfile} '*/{sfile}'"
-        elif arcext in ('.tar', '.tar.gz', '.tgz'):
-            op = 'xf' if arcext == '.tar' else 'xzf'
-            cmd = f"tar {op} {sarc} --transform='s,^/\\?([^/]+/)*,,' --no-anchored {sfile}"
+    librecords = None
+    background = None
+    if library:
+        print('Pre-processing user-supplied library...')
+        if cache_dir and request_type == 'Filter':
+            # Parsed and preprocessed only if the cache has no copy of this library file yet
+            background, lib['fingerprint'] = libindex.cached_library(
+                library, 0.05, cache_dir, lambda: preprocess_store(_library_store(library), 0.05))
+            lib['numfiles'] = numfiles = len(background)
         else:
-            raise Exception(f"Unsupported archive type: {sarc}")
-        subprocess.run(cmd, shell=True, check=True)
-        if not os.path.exists(sfile):
-            raise Exception(f"Failed to extract file '{sfile}' from archive: {sarc}")
-        spectra = file = sfile
-        cleanup.append(sfile)
+            # Read straight from the (compressed) library file, nothing is extracted to disk
+            librecords = spectra_io.by_name(spectra_io.read_library(library))
+            lib['numfiles'] = numfiles = len(librecords)
+        if not numfiles:
+            raise Exception(f"No data (.dta) files in archive: {library}")
 
-    spectra_name = spectra.split('.')[0]
-    numfiles = 0
-
-    # Convert MGF to DTA or extract DTA files
-    if spectra.lower().endswith(('.mgf', '.mgf.zip', '.mgf.gz')):
-        mgf_flag = True
-        mgfile = spectra
-        if spectra.lower().endswith('.zip'):
-            mgfile = mgfile[:-4]
-            cmd = f"unzip -qq -j -o {file}"
-            subprocess.run(cmd, shell=True, check=True)
-        elif spectra.lower().endswith('.gz'):
-            mgfile = mgfile[:-3]
-            cmd = f"gunzip -q -c {file} > {mgfile}"
-            subprocess.run(cmd, shell=True, check=True)
+        print(" Done.")
+
+    lib['records'] = librecords
+    if request_type != 'Filter':
+        return lib
+    if library and background is None:
+        background = preprocess_store(_library_store(library, librecords), 0.05)
+    if engine == 'msfilter':
+        # The external binary reads .dta directories
+        if cache_dir and library:
+            lib['libpath'] = libindex.cached_dta_directory(background, lib['fingerprint'], cache_dir)
+        elif library:
+            LIBTEMP = lib['libtemp'] = tempfile.mkdtemp()
+            libindex.write_dta_files(background, LIBTEMP)
+            lib['libpath'] = LIBTEMP
         else:
-            mgfile = file
-        mgf2dta(mgfile, DATATEMP)
-        if mgfile != file:
-            os.remove(mgfile)
-    elif spectra.lower().endswith(('.tar.gz', '.tgz')):
-        cmd = f"tar --no-same-owner --no-same-permissions --overwrite -xzf {file} --transform='s,^/\\?([^/]+/)*,,' -C {DATATEMP}/"
-        subprocess.run(cmd, shell=True, check=True)
-        cmd = f"find {DATATEMP} -depth -mindepth 1 -type d -execdir rmdir '{{}}' \\;"
-        subprocess.run(cmd, shell=True, check=True)
-    elif spectra.lower().endswith('.zip'):
-        cmd = f"unzip -qq -j -o {file} -d {DATATEMP}/"
-        subprocess.run(cmd, shell=True, check=True)
+            lib['libpath'] = os.path.join(data_path, IONTRAP_LIBRARY)
+    elif engine in ('python', 'sparse'):
+        if not library:
+            libpath = lib['libpath'] = os.path.join(data_path, IONTRAP_LIBRARY)
+            if os.path.exists(libindex.index_path(libpath)):
+                try:
+                    background = libindex.open_library(libpath)
+                except libindex.StaleIndexError:
+                    print(' Library index is out of date, rebuilding...')
+                    background = libindex.open_library(libpath, rebuild=True)
+            else:
+                background = msfilter.read_directory(libpath)
+        lib['background'] = background
+        lib['peaks'] = msfilter.PeakLists(background, 0.05)
     else:
-        raise Exception(f"Unsupported file type uploaded: {spectra}")
+        raise Exception(f"Unsupported scoring engine: {engine}")
+    return lib
 
-    dtafiles = glob.glob(os.path.join(DATATEMP, "*.dta"))
-    if not dtafiles:
-        raise Exception(f"No data (.dta) files in archive: {spectra}")
 
-    LIBTEMP = None
-    if library:
-        print('Pre-processing user-supplied library...')
-        LIBTEMP = tempfile.mkdtemp()
-        libfile = library
-
-        libname, libext = os.path.splitext(os.path.basename(library))
-        libformat = 'dta' if libname.lower().endswith('.dta') else 'mgf'
-        libext = libext.lower()
-        if libformat == 'mgf':
-            mgflib_flag = True
-            mgfile = library
-            if not libext:
-                if not libname.lower().endswith('.mgf'):
-                    raise Exception(f"Unspecified or unsupported library format: {library}")
-                mgfile = libfile
-            elif libext == '.zip':
-                cmd = f"unzip -qql {libfile}"
-                lines = subprocess.check_output(cmd, shell=True).decode().splitlines()
-                arclist = []
-                for l in lines:
-                    a = l.strip().split(None, 3)
-                    if len(a) < 4:
-                        continue
-                    length, name = a[0], a[3]
-                    if name and length.isdigit() and int(length) > 0:
-                        arclist.append(os.path.basename(name))
-                if not arclist:
-                    raise Exception(f"No files found in library archive: {library}")
-                if len(arclist) > 1:
-                    raise Exception(f"Multiple files found in library archive: {library}")
-                mgfile = arclist[0]
-                if not mgfile.lower().endswith('.mgf'):
-                    raise Exception(f"Unspecified or unsupported library format: {library}:{mgfile}")
-                cmd = f"unzip -qq -j -o {libfile}"
-                subprocess.run(cmd, shell=True, check=True)
-            elif libext == '.gz':
-                mgfile = libname
-                if not mgfile.lower().endswith('.mgf'):
-                    raise Exception(f"Unspecified or unsupported library format: {library}")
-                cmd = f"gunzip -q -c {libfile} > {mgfile}"
-                subprocess.run(cmd, shell=True, check=True)
-            else:
-                raise Exception(f"Unsupported library archive format: {library}")
-            mgf2dta(mgfile, LIBTEMP)
-            if mgfile != libfile:
-                os.remove(mgfile)
-        elif libformat == 'dta':
-            if not libext:
-                raise Exception(f"Library in DTA format should be archived: {library}")
-            elif libext in ('.tar', '.tar.gz', '.tgz'):
-                cmd = f"tar --no-same-owner --no-same-permissions --overwrite -xzf {libfile} --transform='s,^/\\?([^/]+/)*,,' -C {LIBTEMP}/"
-                subprocess.run(cmd, shell=True, check=True)
-                cmd = f"find {LIBTEMP} -depth -mindepth 1 -type d -execdir rmdir '{{}}' \\;"
-                subprocess.run(cmd, shell=True, check=True)
-            elif libext == '.zip':
-                cmd = f"unzip -qq -j -o {libfile} -d {LIBTEMP}/"
-                subprocess.run(cmd, shell=True, check=True)
+def _library_store(library: str, librecords: Dict[str, spectra_io.SpectrumRecord] = None) -> msfilter.SpectrumStore:
+    """
+    The spectra of a user-supplied library, in file name order.
+    """
+    if librecords is None:
+        librecords = spectra_io.by_name(spectra_io.read_library(library))
+        if not librecords:
+            raise Exception(f"No data (.dta) files in archive: {library}")
+    return msfilter.SpectrumStore.from_spectra(r.spectrum() for _, r in sorted(librecords.items()))
+
+
+def score_cache_key(params: dict, records: Dict[str, spectra_io.SpectrumRecord], lib: dict, **rows) -> str:
+    """
+    Score cache key of a spectra file: everything its score table depends
+    on, but not the p-value cutoff (except for the sparse engine, which
+    rescores the pairs below the cutoffs exactly).
+
+    :param rows: Settings of the in-process engine that select the rows of
+        the table
+    """
+    request_type = params.get('type')
+    engine = params.get('engine', 'python')
+    fields = {'queries': scorecache.digest_records(records.values()), 'type': request_type, 'engine': engine,
+              'pmt': float(params.get('pmt')), 'fmt': float(params.get('fmt')), 'eye_catching_height': 0.05}
+    if request_type == 'Filter':
+        # Hashed once per library load
+        if lib['fingerprint'] is None:
+            if lib['records'] is not None:
+                lib['fingerprint'] = scorecache.digest_records(lib['records'].values())
             else:
-                raise Exception(f"Unsupported library archive format: {library}")
-        else:
-            raise Exception(f"Unsupported library format: {library}")
+                lib['fingerprint'] = libindex.fingerprint(lib['libpath'])
+        fields['library'] = lib['fingerprint']
+    if engine == 'sparse':
+        fields['subdivisions'] = msfilter_sparse.SUBDIVISIONS
+        fields['cutoffs'] = parse_cutoffs(params.get('smj', 0.05))
+    if engine in ('python', 'sparse'):
+        fields.update(rows)
+    return scorecache.ScoreCache.key(**fields)
+
+
+def score_queries(params: dict, queries: msfilter.SpectrumStore, background: List[msfilter.Spectrum],
+                  peaks: msfilter.PeakLists, lib: dict, keep: int, prune: bool,
+                  counters: dict) -> msfilter.ScoreTable:
+    """
+    Scores queries with the in-process engine of a job, python or sparse.
 
-        numfiles = len(glob.glob(os.path.join(LIBTEMP, "*.dta")))
-        if not numfiles:
-            raise Exception(f"No data (.dta) files in archive: {library}")
+    :param background: Library spectra, or the queries for a Nonred job
+    :param peaks: PeakLists of the library from load_library(), None for a Nonred job
+    :param keep: Best matches kept per query, None for all pairs
+    :param prune: Prune the candidates of the python engine's best matches
+    :param counters: Filled with the engine's counters
+    """
+    engine = params.get('engine', 'python')
+    pmt, fmt = float(params.get('pmt')), float(params.get('fmt'))
+    if engine == 'sparse':
+        bins = None
+        if peaks is not None:
+            # Binned once per library and fragment mass tolerance
+            bins = lib['bins']
+            if bins is None or bins.fragment_mass_tolerance != fmt:
+                bins = lib['bins'] = msfilter_sparse.library_bins(background, peaks, fmt)
+        # Pairs that may be below the job's cutoffs are rescored exactly, so that they classify as with msfilter
+        return msfilter_sparse.msfilter_sparse(queries, background, 0.05, pmt, fmt, top_k=keep,
+                                               library_peaks=peaks, library_bins=bins, stats=counters,
+                                               cutoffs=parse_cutoffs(params.get('smj', 0.05)))
+    return msfilter.msfilter(queries, background, 0.05, pmt, fmt, workers=int(params.get('workers', 1)),
+                             top_k=keep, prune=prune, library_peaks=peaks, stats=counters)
+
+
+def process_spectra(params: dict, file: str, suffix: str, lib: dict, plan: planner.Plan = None) -> None:
+    """
+    Runs the job on one spectra file against a library from load_library()
+    and writes its output files.
 
-        preprocessLibrary_main(library_dir=LIBTEMP, threshold=0.05)
+    :param file: Spectra file (MGF, archived .dta files or archive:member)
+    :param suffix: Output file suffix
+    :param plan: Execution plan of the file from planner.plan_file(), whose
+        parameters `params` already holds
+    """
+    WRK_PATH = os.environ.get('PWD', os.getcwd())
+    SUFFIX = f'-{suffix}' if suffix else ''
+    upload = file
+    spectra = os.path.basename(file)
 
-        print(" Done.")
+    DATATEMP = None
+    cleanup = []
+
+    library = params.get('uploaded_background_library')
+    request_type = params.get('type')
+    pmt = params.get('pmt')
+    fmt = params.get('fmt')
+    # Several cutoffs share one scoring pass
+    cutoffs = parse_cutoffs(params.get('smj', 0.05))
+    sweep = len(cutoffs) > 1
+    engine = params.get('engine', 'python')
+    all_pairs = bool(params.get('all_pairs'))
+    top_k = int(params['top_k']) if params.get('top_k') else None
+    prune = bool(params.get('prune'))
+    dta_output = bool(params.get('dta_output'))
+    request_name = None
+    numfiles = lib['numfiles']
+
+    stats = jobstats.JobStats()
+    stats.merge(lib['stats'])
+    if plan is not None:
+        stats.merge(plan.stats)
+
+    # MGF or archived .dta files, decompressed as they are parsed
+    with stats.stage('conversion'):
+        records, globals_meta, mgf_flag = spectra_io.read_spectra(file)
+        stats.count(spectra_parsed=len(records))
+        records = spectra_io.by_name(records)
+    if plan is not None and plan.profile is None:
+        # Inputs that cannot be sampled are planned once they have been read
+        plan = planner.plan_job(params, lib, planner.profile_records(records.values()), stats)
+        params = dict(params, workers=plan.workers)
+        print(plan.describe())
+    if ':' in spectra:
+        spectra = spectra.split(':', 1)[1]
+    spectra_name = spectra.split('.')[0]
+
+    if not records:
+        raise Exception(f"No data (.dta) files in archive: {spectra}")
+    mgf_output = mgf_flag and not dta_output
 
     print('Calculating distances...')
 
     tmpyt1 = tempfile.NamedTemporaryFile(prefix=f"{WRK_PATH}/your1table", delete=False)
-    tmpyt2 = tempfile.NamedTemporaryFile(prefix=f"{WRK_PATH}/your2table", delete=False)
     yourtable1 = tmpyt1.name
-    yourtable2 = tmpyt2.name
     tmpyt1.close()
-    tmpyt2.close()
+    cleanup.append(yourtable1)
+    # Sorted score table: a file name, or the table lines when scored in-process
+    table = None
+
+    # Filter jobs only need the best match of each query; the non-redundant
+    # library is built from all pairs, in any order
+    best = request_type == 'Filter' and not all_pairs
+    keep = (top_k or 1) if best else top_k if request_type == 'Filter' else None
+    # Stop scoring the candidates of a query once none can beat its best match
+    prune = prune and engine == 'python' and best and keep == 1
+
+    # A re-run with another cutoff finds its score table in the cache
+    cache = cache_key = None
+    cached = False
+    if params.get('score_cache'):
+        cache = scorecache.ScoreCache(params['score_cache'], int(float(params.get('score_cache_size', 1024)) * 2**20))
+        with stats.stage('score_cache'):
+            cache_key = score_cache_key(params, records, lib, all_pairs=all_pairs, top_k=keep)
+            cached = cache.get(cache_key, yourtable1)
+        stats.count(score_cache='hit' if cached else 'miss')
 
     # Main computation
     if request_type == 'Nonred':
-        cmd = f"msfilter {DATATEMP} {DATATEMP} 0.05 {pmt} {fmt} > {yourtable1}"
         request_name = 'Create non-redundant library'
+    elif library:
+        request_name = 'Process spectra with user-supplied Iontrap-type library'
     else:
-        if library:
-            cmd = f"msfilter {DATATEMP} {LIBTEMP} 0.05 {pmt} {fmt} > {yourtable1}"
-            request_name = 'Process spectra with user-supplied Iontrap-type library'
+        request_name = 'Process spectra with Iontrap background library'
+    if cached:
+        # Stored as the in-process engine uses it: sorted for Filter jobs,
+        # unsorted for the redundancy graph
+        if engine in ('python', 'sparse') and not all_pairs:
+            table = yourtable1
+    elif engine == 'msfilter':
+        # The external binary reads .dta directories
+        with stats.stage('conversion'):
+            DATATEMP = tempfile.mkdtemp()
+            spectra_io.write_dta_directory(records.values(), '', DATATEMP)
+        libpath = DATATEMP if request_type == 'Nonred' else lib['libpath']
+        # An argument list: no shell sees the job's parameters
+        cmd = ['msfilter', DATATEMP, libpath, '0.05', str(pmt), str(fmt)]
+        with stats.stage('scoring'), open(yourtable1, 'w') as fout:
+            subprocess.run(cmd, stdout=fout, check=True)
+    elif engine in ('python', 'sparse'):
+        with stats.stage('conversion'):
+            queries = msfilter.SpectrumStore.from_spectra(r.spectrum() for _, r in sorted(records.items()))
+        if request_type == 'Nonred':
+            background, peaks = queries, None
         else:
-            cmd = f"msfilter {DATATEMP} {os.path.join(DATA_PATH, IONTRAP_LIBRARY)} 0.05 {pmt} {fmt} > {yourtable1}"
-            request_name = 'Process spectra with Iontrap background library'
-    subprocess.run(cmd, shell=True, check=True)
-    print(" Done.")
-
-    print('Sorting table...')
-    cmd = f"sort -b -g -k 7,7 {yourtable1} > {yourtable2}"
-    subprocess.run(cmd, shell=True, check=True)
-    print(" Done.")
-
-    goodfile = bgroundfile = nonredfile = tablefilename = None
+            background, peaks = lib['background'], lib['peaks']
+        counters = {}
+        with stats.stage('scoring'):
+            scores = score_queries(params, queries, background, peaks, lib, keep, prune, counters)
+        stats.count(**counters)
+        if best:
+            with stats.stage('sort'):
+                table = list(msfilter.table_lines(queries, background,
+                                                  msfilter.sort_table(queries, background, scores)))
+            if cache is not None:
+                with stats.stage('score_cache'), open(yourtable1, 'w') as fout:
+                    fout.writelines(table)
+        elif not all_pairs and cache is None:
+            # Streamed into the redundancy graph
+            table = msfilter.table_lines(queries, background, scores)
+        elif not all_pairs:
+            with stats.stage('scoring'), open(yourtable1, 'w') as fout:
+                msfilter.write_table(fout, queries, background, scores)
+            table = yourtable1
+        else:
+            with stats.stage('scoring'), open(yourtable1, 'w') as fout:
+                msfilter.write_table(fout, queries, background, scores)
+    else:
+        raise Exception(f"Unsupported scoring engine: {engine}")
+    if cache is not None and not cached:
+        with stats.stage('score_cache'):
+            cache.put(cache_key, yourtable1)
+    print(" Done (cached scores)." if cached else " Done.")
+    if plan is not None:
+        # Cached tables and the msfilter binary leave only the estimate to record
+        plan.report(stats, stats.counters)
+
+    pairsfile = None
+    if table is None:
+        print('Sorting table...')
+        if all_pairs:
+            pairsfile = yourtable2 = f"{spectra_name}{SUFFIX}-pairs.txt"
+        else:
+            tmpyt2 = tempfile.NamedTemporaryFile(prefix=f"{WRK_PATH}/your2table", delete=False)
+            yourtable2 = tmpyt2.name
+            tmpyt2.close()
+            cleanup.append(yourtable2)
+        cmd = ['sort', '-b', '-g', '-k', '7,7', yourtable1]
+        with stats.stage('sort'), open(yourtable2, 'w') as fout:
+            subprocess.run(cmd, stdout=fout, check=True)
+        table = yourtable2
+        print(" Done.")
 
+    # Outputs of each cutoff
+    results = []
+    dbfile = None
     if request_type == 'Filter':
-        tablefilename = f"{spectra_name}{SUFFIX}-table.csv"
-        processtable(yourtable2, tablefilename, smj, spectra_name, numfiles, mgf_flag, SUFFIX)
-        if mgf_flag:
-            goodfile = f"{spectra_name}{SUFFIX}-good.mgf"
-            bgroundfile = f"{spectra_name}{SUFFIX}-background.mgf"
-        else:
-            goodfile = f"{spectra_name}{SUFFIX}-good.zip"
-            bgroundfile = f"{spectra_name}{SUFFIX}-background.zip"
+        # The best match of each query decides its call at every cutoff
+        best_rows = None
+        if sweep:
+            with stats.stage('table'):
+                best_rows = best_matches(table)
+        ext = 'mgf' if mgf_output else 'zip'
+        for smj in cutoffs:
+            x = f"{SUFFIX}-a{smj}" if sweep else SUFFIX
+            tablefilename = f"{spectra_name}{x}-table.csv"
+            ngood, nbackground = processtable(table, tablefilename, smj, spectra_name, numfiles, mgf_output, x,
+                                              records=records, globals_meta=globals_meta, stats=stats,
+                                              best=best_rows)
+            results.append({'smj': smj, 'table': tablefilename, 'good': f"{spectra_name}{x}-good.{ext}",
+                            'background': f"{spectra_name}{x}-background.{ext}",
+                            'counts': {'good': ngood, 'background': nbackground}})
+        if params.get('results_db'):
+            dbfile = f"{spectra_name}{SUFFIX}{resultsdb.RESULTS_EXT}"
+            with stats.stage('output'):
+                resultsdb.write_results(dbfile, table, cutoffs, pairs=all_pairs)
     elif request_type == 'Nonred':
-        NRLIBTEMP = tempfile.mkdtemp()
-
-        cmd = f"{PRJ_PATH}/make_nonredundant.py {yourtable2} {smj} {DATATEMP} {NRLIBTEMP} > {yourtable1}"
-        subprocess.run(cmd, shell=True, check=True)
-
-        make_nonredundant_main(yourtable2=yourtable2,
-                               smj=smj,
-                               msdata_temp_dir=DATATEMP,
-                               msdata_nonred_lib=NRLIBTEMP)
-
-        if mgf_flag:
-            nonredfile = f"{spectra_name}{SUFFIX}-nonredundant.mgf"
-            dta2mgf(NRLIBTEMP, nonredfile)
-        else:
-            nonredfile = f"{spectra_name}{SUFFIX}-nonredundant.zip"
-            cmd = f"zip -qr {nonredfile} {NRLIBTEMP}/"
-            subprocess.run(cmd, shell=True, check=True)
-        shutil.rmtree(NRLIBTEMP)
+        # Built once at the highest cutoff, then pruned for the lower ones
+        with stats.stage('table'):
+            graph = read_graph(table, cutoffs[-1])
+        for smj in cutoffs:
+            x = f"{SUFFIX}-a{smj}" if sweep else SUFFIX
+            with stats.stage('table'):
+                selected = select_nonredundant(sorted(records), graph.with_cutoff(smj))
+            stats.count(nonredundant=len(selected))
+            # The non-redundant library carries the .dta content only, without MGF parameters
+            nonred = [spectra_io.SpectrumRecord(n, records[n].header, records[n].peaks, checked=records[n].checked)
+                      for n in selected]
+            with stats.stage('output'):
+                if mgf_output:
+                    nonredfile = f"{spectra_name}{x}-nonredundant.mgf"
+                    spectra_io.write_mgf(nonred, '', nonredfile)
+                else:
+                    nonredfile = f"{spectra_name}{x}-nonredundant.zip"
+                    spectra_io.write_dta_zip(nonred, '', nonredfile)
+            results.append({'smj': smj, 'nonred': nonredfile, 'counts': {'nonredundant': len(selected)}})
     else:
         raise Exception(f"Unsupported request type: {request_type}")
 
+    if DATATEMP:
+        shutil.rmtree(DATATEMP, ignore_errors=True)
+
     # Cleanup
     for f in cleanup:
         try:
@@ -495,37 +573,276 @@ def main(qfile: str):
         except Exception:
             pass
 
+    write_summary(params, upload, spectra_name, SUFFIX, request_name, results, stats, pairsfile, dbfile)
+
+
+def stream_spectra(params: dict, file: str, suffix: str, lib: dict, plan: planner.Plan = None) -> None:
+    """
+    Runs a Filter job on one MGF file in bounded memory: queries are read,
+    scored against the library and written to sorted runs in batches of
+    about `memory_budget` MB / streamfilter.BATCH_OVERHEAD of spectra, and
+    the outputs are merged from the runs (see streamfilter). Memory use
+    does not grow with the number of queries; the outputs are those of
+    process_spectra().
+
+    :param file: MGF spectra file (.mgf, .mgf.gz, .mgf.zip or archive:member)
+    :param suffix: Output file suffix
+    :param plan: Execution plan of the file from planner.plan_file()
+    """
+    WRK_PATH = os.environ.get('PWD', os.getcwd())
+    SUFFIX = f'-{suffix}' if suffix else ''
+    spectra_name = output_name(file, '')
+
+    library = params.get('uploaded_background_library')
+    engine = params.get('engine', 'python')
+    if params.get('type') != 'Filter':
+        raise Exception("Only Filter jobs can run with a memory budget")
+    if engine not in ('python', 'sparse'):
+        raise Exception("Jobs with a memory budget need the python or sparse scoring engine")
+    if params.get('all_pairs') or params.get('score_cache'):
+        raise Exception("Jobs with a memory budget write neither all pairs nor score caches")
+    cutoffs = parse_cutoffs(params.get('smj', 0.05))
+    sweep = len(cutoffs) > 1
+    keep = int(params['top_k']) if params.get('top_k') else 1
+    prune = bool(params.get('prune')) and engine == 'python' and keep == 1
+    workers = int(params.get('workers', 1))
+    batch_bytes = max(1, int(float(params['memory_budget']) * 2**20 / streamfilter.BATCH_OVERHEAD))
+    background, peaks = lib['background'], lib['peaks']
+
+    stats = jobstats.JobStats()
+    stats.merge(lib['stats'])
+    if plan is not None:
+        stats.merge(plan.stats)
+
+    print('Calculating distances...')
+    rundir = tempfile.mkdtemp(prefix='stream', dir=WRK_PATH)
+    try:
+        runs = streamfilter.BatchRuns(rundir)
+        nspectra = 0
+        totals = {}
+        with contextlib.ExitStack() as stack:
+            # The parser processes hold two chunks each
+            chunk_bytes = min(spectra_io.MGF_CHUNK_BYTES, max(1, batch_bytes // (2 * workers)))
+            reader = spectra_io.open_mgf(stack, file, workers, chunk_bytes)
+            batches = streamfilter.batches(reader, batch_bytes)
+            while True:
+                with stats.stage('conversion'):
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    records = spectra_io.by_name(batch)
+                    queries = msfilter.SpectrumStore.from_spectra(r.spectrum() for _, r in sorted(records.items()))
+                nspectra += len(batch)
+                counters = {}
+                with stats.stage('scoring'):
+                    scores = score_queries(params, queries, background, peaks, lib, keep, prune, counters)
+                streamfilter.add_counters(totals, counters)
+                with stats.stage('sort'):
+                    runs.add(queries, background, msfilter.sort_table(queries, background, scores), records)
+            globals_meta = reader.globals
+        if not nspectra:
+            raise Exception(f"No data (.dta) files in archive: {os.path.basename(file)}")
+        stats.count(spectra_parsed=nspectra, batches=runs.count, **totals)
+        print(" Done.")
+        if plan is not None:
+            plan.report(stats, totals)
+
+        with stats.stage('table'):
+            runs.close()
+        mgf_output = not params.get('dta_output')
+        ext = 'mgf' if mgf_output else 'zip'
+        write = spectra_io.write_mgf if mgf_output else spectra_io.write_dta_zip
+        results = []
+        dbfile = None
+        for smj in cutoffs:
+            x = f"{SUFFIX}-a{smj}" if sweep else SUFFIX
+            tablefilename = f"{spectra_name}{x}-table.csv"
+            ngood = nbackground = 0
+            with stats.stage('table'), open(tablefilename, 'w', newline='') as fout:
+                fout.write(TABLE_HEADER)
+                for line in runs.table():
+                    sfile, lfile, *_, ds = line.split()
+                    ds = float(ds)
+                    pvalue = msfilter.pvalue(ds)
+                    if pvalue < smj:
+                        nbackground += 1
+                        prediction = 'Background'
+                    else:
+                        ngood += 1
+                        prediction = 'Good'
+                    fout.write(TABLE_ROW.format(spectra_io.url_decode(os.path.basename(sfile)),
+                                                spectra_io.url_decode(os.path.basename(lfile)), ds, pvalue, prediction))
+            stats.count(good=ngood, background=nbackground)
+            gf, bf = f"{spectra_name}{x}-good.{ext}", f"{spectra_name}{x}-background.{ext}"
+            # As in processtable(), any row of a query flags the output files to write
+            with stats.stage('output'):
+                if runs.highest >= smj:
+                    write((r for p, r in runs.records() if p >= smj), globals_meta, gf, presorted=True)
+                if runs.lowest < smj:
+                    write((r for p, r in runs.records() if p < smj), globals_meta, bf, presorted=True)
+            results.append({'smj': smj, 'table': tablefilename, 'good': gf, 'background': bf,
+                            'counts': {'good': ngood, 'background': nbackground}})
+        if params.get('results_db'):
+            dbfile = f"{spectra_name}{SUFFIX}{resultsdb.RESULTS_EXT}"
+            with stats.stage('output'):
+                resultsdb.write_results(dbfile, runs.table(), cutoffs)
+    finally:
+        shutil.rmtree(rundir, ignore_errors=True)
+
+    if library:
+        request_name = 'Process spectra with user-supplied Iontrap-type library'
+    else:
+        request_name = 'Process spectra with Iontrap background library'
+    write_summary(params, file, spectra_name, SUFFIX, request_name, results, stats, dbfile=dbfile)
+
+
+def write_summary(params: dict, upload: str, spectra_name: str, SUFFIX: str, request_name: str, results: list,
+                  stats: jobstats.JobStats, pairsfile: str = None, dbfile: str = None) -> None:
+    """
+    Writes the cutoff sweep, parameters and statistics files of one spectra
+    file and prints the job summary.
+
+    :param results: Outputs and counts of each cutoff
+    """
+    WRK_PATH = os.environ.get('PWD', os.getcwd())
+    library = params.get('uploaded_background_library')
+    request_type = params.get('type')
+    pmt = params.get('pmt')
+    fmt = params.get('fmt')
+    cutoffs = [r['smj'] for r in results]
+    sweep = len(cutoffs) > 1
+
+    sweepfile = None
+    if sweep:
+        stats.count(sweep={str(r['smj']): r['counts'] for r in results})
+        sweepfile = f"{spectra_name}{SUFFIX}-sweep.csv"
+        columns = list(results[0]['counts'])
+        with open(sweepfile, 'w', newline='') as sf:
+            writer = csv.writer(sf)
+            writer.writerow(["SMJ"] + [c.capitalize() for c in columns])
+            for r in results:
+                writer.writerow([r['smj']] + [r['counts'][c] for c in columns])
+
     # Store query parameters in CSV format
     params_file = f"{spectra_name}{SUFFIX}-params.csv"
     description = params.get('description', '')
     with open(params_file, 'w', newline='') as pf:
         writer = csv.writer(pf)
         writer.writerow(["Spectra", "Library", "PMT", "FMT", "SMJ", "RequestType", "Description"])
-        writer.writerow([params.get('uploaded_spectra', ''), library, pmt, fmt, smj, request_type, description])
+        writer.writerow([upload, library, pmt, fmt, ','.join(map(str, cutoffs)), request_type, description])
+
+    # Stage timings and counters next to the parameters
+    stats_file = f"{spectra_name}{SUFFIX}-stats.json"
+    stats.write(stats_file)
 
     # Output summary
     print()
     if description:
         print(f"Description: {description}")
-    print(f"Input file: {params.get('uploaded_spectra', '')}")
+    print(f"Input file: {upload}")
     print(f"Job type: {request_name}")
     if request_type == 'Filter' and library:
         print(f"User-supplied library: {library}")
     print(f"Precursor mass tolerance: {pmt}")
     print(f"Fragment mass tolerance: {fmt}")
-    print(f"p-Value cutoff: {smj}")
+    print(f"p-Value cutoff: {', '.join(map(str, cutoffs))}")
+
+    if sweep:
+        print("\nCutoff sweep:")
+        print(f"{'p-Value':<10}" + ''.join(f"{c:>14}" for c in results[0]['counts']))
+        for r in results:
+            print(f"{r['smj']:<10}" + ''.join(f"{n:>14}" for n in r['counts'].values()))
+
+    print("\nOutput files:")
+    print(f"Parameters: {WRK_PATH}/{params_file}")
+    if sweepfile:
+        print(f"Cutoff sweep: {WRK_PATH}/{sweepfile}")
+    if pairsfile:
+        print(f"Candidate pairs: {WRK_PATH}/{pairsfile}")
+    if dbfile:
+        print(f"Results database: {WRK_PATH}/{dbfile}")
+    for r in results:
+        if sweep:
+            print(f"p-Value cutoff {r['smj']}:")
+        if request_type == 'Nonred':
+            print(f"Non-redundant library: {WRK_PATH}/{r['nonred']}")
+            continue
+        print(f"Spectra table: {WRK_PATH}/{r['table']}")
+        if os.path.exists(r['good']) and os.path.getsize(r['good']) > 0:
+            print(f"Good spectra: {WRK_PATH}/{r['good']}")
+        if os.path.exists(r['background']) and os.path.getsize(r['background']) > 0:
+            print(f"Background spectra: {WRK_PATH}/{r['background']}")
+    print(f"Job statistics: {WRK_PATH}/{stats_file}")
 
-    if request_type == 'Nonred':
-        print("\nOutput files:")
-        print(f"Parameters: {WRK_PATH}/{params_file}")
-        print(f"Non-redundant library: {WRK_PATH}/{nonredfile}")
+    print("\nCreated:", datetime.now().strftime("%c"))
+
+
+def job_inputs(params: dict) -> List[Tuple[str, str]]:
+    """
+    The spectra files of a job with their output suffixes: the manifest of a
+    batch job, or the single uploaded file.
+    """
+    suffix = params.get('suffix', '')
+    if params.get('manifest'):
+        inputs = read_manifest(params['manifest'], suffix)
+    elif params.get('uploaded_spectra'):
+        inputs = [(params['uploaded_spectra'], suffix)]
     else:
-        print("\nOutput files:")
-        print(f"Parameters: {WRK_PATH}/{params_file}")
-        print(f"Spectra table: {WRK_PATH}/{tablefilename}")
-        if goodfile and os.path.exists(goodfile) and os.path.getsize(goodfile) > 0:
-            print(f"Good spectra: {WRK_PATH}/{goodfile}")
-        if bgroundfile and os.path.exists(bgroundfile) and os.path.getsize(bgroundfile) > 0:
-            print(f"Background spectra: {WRK_PATH}/{bgroundfile}")
+        inputs = []
+    if not inputs:
+        raise Exception("No spectra file(s) submitted")
+    names = [output_name(f, x) for f, x in inputs]
+    for name in set(names):
+        if names.count(name) > 1:
+            raise Exception(f"Several spectra files write outputs named {name}, give them distinct suffixes")
+    return inputs
 
-    print("\nCreated:", datetime.now().strftime("%c"))
+
+def run_job(params: dict, inputs: List[Tuple[str, str]], lib: dict) -> None:
+    """
+    Runs every spectra file of a job against a loaded library.
+    """
+    for k, (file, x) in enumerate(inputs):
+        if len(inputs) > 1:
+            print(f"\n[{k + 1}/{len(inputs)}] {file}")
+        job, plan = params, None
+        if params.get('plan'):
+            # Processes and memory budget chosen from the estimated cost of the file
+            plan = planner.plan_file(params, file, lib)
+            job = dict(params, **plan.params())
+            if plan.profile is not None:
+                print(plan.describe())
+        # Spectra files larger than memory are processed in batches
+        process = stream_spectra if job.get('memory_budget') else process_spectra
+        if not params.get('profile'):
+            process(job, file, x, lib, plan)
+            continue
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            process(job, file, x, lib, plan)
+        finally:
+            profiler.disable()
+            profile_file = f"{output_name(file, x)}-profile.prof"
+            profiler.dump_stats(profile_file)
+            print(f"Profile: {os.environ.get('PWD', os.getcwd())}/{profile_file}")
+
+
+def main(qfile: str):
+    params = read_params(qfile)
+
+    WRK_PATH = os.environ.get('PWD', os.getcwd())
+    PRJ_PATH = params.get('prjpath', WRK_PATH)
+    DATA_PATH = os.path.join(PRJ_PATH, 'data')
+
+    # A batch job runs every file of a manifest against one library load
+    inputs = job_inputs(params)
+
+    print("Eagle Eye v1.66\n")
+
+    lib = load_library(params, DATA_PATH)
+    try:
+        run_job(params, inputs, lib)
+    finally:
+        if lib['libtemp']:
+            shutil.rmtree(lib['libtemp'], ignore_errors=True)
@@ -0,0 +1,377 @@
+"""
+Long-running EagleEye service.
+
+Background libraries are loaded once, at startup or by the first job that
+uses them, and stay resident; jobs are accepted over local HTTP or a Unix
+socket and run concurrently in a bounded pool of worker processes:
+
+    $ python eagleeye_server.py --port 8765 --preload lib.mgf.gz --workers 4
+    $ curl -s --data-binary @job.query http://127.0.0.1:8765/jobs
+
+API:
+
+    POST   /jobs              Run a job. The body holds the parameters of
+                              eagleeye_cgi.read_params() (key=value lines, or
+                              a JSON object). The job log is streamed back as
+                              it is written, followed by one JSON line with
+                              the job id, status and output files.
+    GET    /jobs/<id>/<file>  Download an output file of a job.
+    DELETE /jobs/<id>         Remove a job's directory.
+    GET    /status            Loaded libraries and pool usage, as JSON.
+
+File names in job parameters refer to the server's file system and are
+resolved against the directory the server was started in. Each job runs in
+its own directory under --workdir, where its outputs are kept until deleted.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import http.client
+import http.server
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Tuple
+
+from eagleeye_cgi import job_inputs, load_library, parse_cutoffs, parse_params, run_job
+
+PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
+JOB_LOG = 'log.txt'
+# Libraries a worker loads for itself, beyond those preloaded by the server
+WORKER_CACHE_SIZE = 2
+# Numeric job parameters and their types
+NUMERIC_PARAMS = {'pmt': float, 'fmt': float, 'workers': int, 'top_k': int, 'memory_budget': float,
+                  'score_cache_size': float, 'plan_memory': float}
+
+# Libraries loaded before the workers are forked, shared with all of them
+_libraries: Dict[tuple, dict] = {}
+# Libraries loaded by a worker process, most recently used last
+_worker_libraries: Dict[tuple, dict] = {}
+
+
+def library_key(params: dict) -> tuple:
+    """
+    Jobs with the same key can share a loaded library.
+    """
+    library = params.get('uploaded_background_library') or ''
+    data_path = os.path.join(params.get('prjpath', PROJECT_PATH), 'data')
+    return (os.path.abspath(library) if library else '', params.get('type'),
+            params.get('engine', 'python'), data_path)
+
+
+def _release(lib: dict) -> None:
+    if lib['libtemp']:
+        shutil.rmtree(lib['libtemp'], ignore_errors=True)
+
+
+def get_library(params: dict) -> dict:
+    """
+    The loaded library of a job: preloaded, cached in this process, or read now.
+    """
+    key = library_key(params)
+    if key in _libraries:
+        return _libraries[key]
+    lib = _worker_libraries.pop(key, None)
+    if lib is None:
+        lib = load_library(params, key[3])
+        while len(_worker_libraries) >= WORKER_CACHE_SIZE:
+            _release(_worker_libraries.pop(next(iter(_worker_libraries))))
+    _worker_libraries[key] = lib
+    return lib
+
+
+def _execute(jobdir: str, params: dict, inputs: List[Tuple[str, str]]) -> List[str]:
+    """
+    Runs one job in a worker process, with its outputs and log in jobdir.
+    """
+    os.chdir(jobdir)
+    os.environ['PWD'] = jobdir
+    with open(os.path.join(jobdir, JOB_LOG), 'w', buffering=1) as log, contextlib.redirect_stdout(log):
+        print("Eagle Eye v1.66\n")
+        run_job(params, inputs, get_library(params))
+    return sorted(f for f in os.listdir(jobdir) if f != JOB_LOG)
+
+
+def _ready(_: int) -> int:
+    return os.getpid()
+
+
+def job_params(body: bytes, content_type: str, base: str) -> dict:
+    """
+    Job parameters from a request body, with file names made absolute.
+    Numeric parameters must parse as numbers.
+    """
+    text = body.decode('utf-8')
+    if content_type.split(';')[0].strip() == 'application/json':
+        # Flags are present only when set, as in a .query file
+        params = {k: str(v) for k, v in json.loads(text).items() if v is not None and v is not False}
+    else:
+        params = parse_params(text.splitlines())
+    for k, kind in NUMERIC_PARAMS.items():
+        if params.get(k):
+            try:
+                kind(params[k])
+            except ValueError:
+                raise Exception(f"Invalid {k}: {params[k]}")
+    if params.get('smj'):
+        parse_cutoffs(params['smj'])
+    for k in ('uploaded_spectra', 'uploaded_background_library', 'manifest'):
+        if params.get(k):
+            params[k] = os.path.join(base, params[k])
+    return params
+
+
+class Service:
+    """
+    Job directories, the worker pool and the count of queued or running jobs.
+    """
+
+    def __init__(self, workdir: str, workers: int, max_pending: int):
+        self.base = os.getcwd()
+        self.workdir = os.path.abspath(workdir)
+        os.makedirs(self.workdir, exist_ok=True)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.pool_lock = threading.Lock()
+        # Before any request thread exists
+        self.pool = self._start_pool()
+
+    def _start_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        """
+        A pool of workers forked from this process, sharing its preloaded
+        libraries.
+        """
+        methods = multiprocessing.get_all_start_methods()
+        pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context('fork' if 'fork' in methods else None))
+        # Fork every worker now
+        list(pool.map(_ready, range(self.workers)))
+        return pool
+
+    def _restart(self, pool: concurrent.futures.ProcessPoolExecutor) -> None:
+        """
+        Replaces a pool that lost a worker (killed, or out of memory); its
+        queued jobs have failed.
+        """
+        with self.pool_lock:
+            if self.pool is pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = self._start_pool()
+
+    def submit(self, params: dict) -> Tuple[str, concurrent.futures.Future]:
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return None, None
+            self.pending += 1
+        try:
+            # Manifest entries are relative to the server's directory too
+            inputs = [(os.path.join(self.base, f), x) for f, x in job_inputs(params)]
+            job = uuid.uuid4().hex[:16]
+            jobdir = os.path.join(self.workdir, job)
+            os.makedirs(jobdir)
+            pool = self.pool
+            try:
+                future = pool.submit(_execute, jobdir, params, inputs)
+            except BrokenProcessPool:
+                self._restart(pool)
+                future = self.pool.submit(_execute, jobdir, params, inputs)
+        except BaseException:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return job, future
+
+    def _done(self, future) -> None:
+        with self.lock:
+            self.pending -= 1
+
+    def jobdir(self, job: str) -> str:
+        if not job or os.path.basename(job) != job or job.startswith('.'):
+            return None
+        path = os.path.join(self.workdir, job)
+        return path if os.path.isdir(path) else None
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(cancel_futures=True)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    server_version = 'EagleEye/1.66'
+    service: Service = None
+
+    def address_string(self) -> str:
+        # Unix socket peers have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def _send_json(self, code: int, obj) -> None:
+        body = (json.dumps(obj) + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['status']:
+            self._send_json(200, {
+                'libraries': [list(k) for k in _libraries],
+                'workers': self.service.workers,
+                'pending': self.service.pending,
+            })
+        elif len(parts) == 3 and parts[0] == 'jobs':
+            jobdir = self.service.jobdir(parts[1])
+            name = parts[2]
+            path = os.path.join(jobdir, name) if jobdir and os.path.basename(name) == name else None
+            if not path or not os.path.isfile(path):
+                self._send_json(404, {'error': 'no such file'})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, 'rb') as fin:
+                shutil.copyfileobj(fin, self.wfile)
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_DELETE(self):
+        parts = self.path.strip('/').split('/')
+        jobdir = self.service.jobdir(parts[1]) if len(parts) == 2 and parts[0] == 'jobs' else None
+        if not jobdir:
+            self._send_json(404, {'error': 'no such job'})
+            return
+        shutil.rmtree(jobdir, ignore_errors=True)
+        self._send_json(200, {'job': parts[1], 'deleted': True})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': 'not found'})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            params = job_params(body, self.headers.get('Content-Type', ''), self.service.base)
+            job, future = self.service.submit(params)
+        except Exception as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        if job is None:
+            self._send_json(503, {'error': 'too many pending jobs'})
+            return
+
+        # Stream the job log while it runs; the body ends when the connection closes
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('X-EagleEye-Job', job)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        log = os.path.join(self.service.workdir, job, JOB_LOG)
+        pos = 0
+        try:
+            while True:
+                done = future.done()
+                if os.path.exists(log):
+                    with open(log, 'rb') as fin:
+                        fin.seek(pos)
+                        data = fin.read()
+                    if data:
+                        pos += len(data)
+                        self.wfile.write(data)
+                        self.wfile.flush()
+                if done:
+                    break
+                time.sleep(0.05)
+            error = future.exception()
+            result = {'job': job, 'status': 'failed' if error else 'done',
+                      'files': [] if error else future.result()}
+            if error:
+                result['error'] = str(error)
+            self.wfile.write((json.dumps(result) + '\n').encode())
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; the job still runs to completion
+            pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP client connection over a Unix socket.
+    """
+
+    def __init__(self, path: str, timeout: float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EagleEye service with resident background libraries")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port")
+    parser.add_argument("--socket", default=None, help="Listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Jobs run at the same time")
+    parser.add_argument("--max-pending", type=int, default=64,
+                        help="Queued and running jobs before new ones are refused")
+    parser.add_argument("--workdir", default="eagleeye-jobs", help="Directory for job outputs")
+    parser.add_argument("--preload", action="append", default=[],
+                        help="Background library to load at startup, '-' for the bundled one (repeatable)")
+    parser.add_argument("-e", "--engine", choices=("python", "sparse", "msfilter"), default="python",
+                        help="Scoring engine the preloaded libraries are prepared for")
+    args = parser.parse_args()
+
+    for library in args.preload:
+        params = {'type': 'Filter', 'engine': args.engine}
+        if library != '-':
+            params['uploaded_background_library'] = os.path.abspath(library)
+        key = library_key(params)
+        _libraries[key] = load_library(params, key[3])
+
+    service = Service(args.workdir, args.workers, args.max_pending)
+    Handler.service = service
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, Handler)
+        where = args.socket
+    else:
+        server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+        server.daemon_threads = True
+        where = f"http://{args.host}:{server.server_address[1]}"
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"EagleEye service on {where}, {args.workers} workers, {len(_libraries)} preloaded libraries",
+          flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        for lib in _libraries.values():
+            _release(lib)
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
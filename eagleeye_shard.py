@@ -0,0 +1,305 @@
+"""
+Sharded Filter jobs for several nodes sharing a file system.
+
+A job is split into self-contained work units in a shared directory, any
+number of workers on any nodes process the units, and the merged result is
+the same table and good/background spectra as a single-node run:
+
+    $ python eagleeye_shard.py shard myspectra.mgf lib.mgf.gz -p 2 -f 0.6 -a 0.05 --units 32 -o /shared/job1
+    node1$ python eagleeye_shard.py worker /shared/job1
+    node2$ python eagleeye_shard.py worker /shared/job1
+    $ python eagleeye_shard.py merge /shared/job1
+
+Queries are partitioned by charge and precursor mass range. A unit holds
+its queries and every library spectrum of the same charge within `pmt` of
+its mass range, so it has all candidates of its queries. Units are indexes
+in the libindex format, with the preprocessed library spectra and the
+scan ids of a single-node run.
+
+A worker claims a unit by creating its lock file with O_EXCL, and writes
+the unit's score rows to a temporary file renamed into place when done. A
+unit whose lock is older than --reclaim-after seconds without a result is
+taken over, for workers that died. Merge sorts the rows of all units as
+a single-node job sorts its table and classifies them.
+"""
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from typing import List
+
+import numpy as np
+
+import libindex
+import msfilter
+import msfilter_sparse
+import spectra_io
+from eagleeye_cgi import best_matches, load_library, output_name, parse_cutoffs, processtable
+
+JOB_FILE = 'job.json'
+UNITS_DIR = 'units'
+SCORES_EXT = '.scores'
+LOCK_EXT = '.lock'
+
+
+def partition(precursor_mass: np.ndarray, charge: np.ndarray, units: int) -> List[np.ndarray]:
+    """
+    Splits queries into about `units` groups of one charge and contiguous
+    precursor mass, with similar numbers of queries.
+
+    :return: Query indices of each group, in increasing mass
+    """
+    groups = []
+    n = len(charge)
+    for c in np.unique(charge):
+        idx = np.flatnonzero(charge == c)
+        idx = idx[np.argsort(precursor_mass[idx], kind='stable')]
+        k = min(len(idx), max(1, round(units * len(idx) / n)))
+        groups.extend(g for g in np.array_split(idx, k) if len(g))
+    return groups
+
+
+def shard(params: dict, spectra: str, directory: str, units: int) -> dict:
+    """
+    Writes the work units of a Filter job into directory.
+
+    :param params: Job parameters, as for eagleeye_cgi
+    :param spectra: Spectra file (MGF, archived .dta files or archive:member)
+    :return: The job description, also written to <directory>/job.json
+    """
+    pmt = float(params['pmt'])
+    os.makedirs(os.path.join(directory, UNITS_DIR))
+
+    # The spectra file is copied, so that the directory is all merge needs
+    source = spectra.split(':', 1)[0] if ':' in os.path.basename(spectra) else spectra
+    member = spectra[len(source):]
+    shutil.copyfile(source, os.path.join(directory, os.path.basename(source)))
+    records, _, _ = spectra_io.read_spectra(spectra)
+    records = spectra_io.by_name(records)
+    if not records:
+        raise Exception(f"No data (.dta) files in archive: {spectra}")
+    queries = msfilter.SpectrumStore.from_spectra(r.spectrum() for _, r in sorted(records.items()))
+
+    # The library as the in-process engine loads it: preprocessed, with the scan ids of a single-node run
+    lib = load_library(dict(params, engine='python'), os.path.join(params['prjpath'], 'data'))
+    background = lib['background']
+    lib_mass = np.asarray(background.precursor_mass, dtype=np.float64)
+    lib_charge = np.asarray(background.charge)
+
+    job = {'params': params, 'spectra': os.path.basename(source) + member, 'upload': spectra, 'units': []}
+    for k, group in enumerate(partition(queries.precursor_mass, queries.charge, units)):
+        c = int(queries.charge[group[0]])
+        lo, hi = float(queries.precursor_mass[group[0]]), float(queries.precursor_mass[group[-1]])
+        # Candidates are within pmt of a query; the slack covers rounding of msfilter's test
+        margin = pmt + 1e-9 * (abs(hi) + pmt)
+        subset = np.flatnonzero((lib_charge == c) & (lib_mass >= lo - margin) & (lib_mass <= hi + margin))
+        name = f"u{k:05d}"
+        unit = os.path.join(directory, UNITS_DIR, name)
+        libindex.write_index([queries[i] for i in group.tolist()], unit + '-queries' + libindex.INDEX_EXT, '', '')
+        libindex.write_index([background[j] for j in subset.tolist()], unit + '-library' + libindex.INDEX_EXT,
+                             '', '')
+        job['units'].append({'name': name, 'charge': c, 'mass_range': [lo, hi], 'queries': len(group),
+                             'library': len(subset)})
+    with open(os.path.join(directory, JOB_FILE), 'w') as fout:
+        json.dump(job, fout, indent=1)
+    return job
+
+
+def read_job(directory: str) -> dict:
+    with open(os.path.join(directory, JOB_FILE)) as fin:
+        return json.load(fin)
+
+
+def _claim(lock: str, reclaim_after: float = None) -> bool:
+    """
+    Creates the lock file of a unit, unless another worker holds it.
+    """
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if reclaim_after is None:
+            return False
+        try:
+            if time.time() - os.stat(lock).st_mtime < reclaim_after:
+                return False
+            # Only one of the workers that find the lock stale renames it away
+            stale = f"{lock}.{socket.gethostname()}.{os.getpid()}"
+            os.rename(lock, stale)
+            os.remove(stale)
+        except FileNotFoundError:
+            return False
+        return _claim(lock)
+    with os.fdopen(fd, 'w') as fout:
+        fout.write(f"{socket.gethostname()} {os.getpid()}\n")
+    return True
+
+
+def score_unit(params: dict, unit: str, output: str) -> None:
+    """
+    Writes the score rows of a unit, unsorted, in the format of msfilter's
+    stdout.
+    """
+    pmt, fmt = float(params['pmt']), float(params['fmt'])
+    queries = libindex.LibraryIndex(unit + '-queries' + libindex.INDEX_EXT)
+    library = libindex.LibraryIndex(unit + '-library' + libindex.INDEX_EXT)
+    engine = params.get('engine', 'python')
+    if engine == 'python':
+        scores = msfilter.msfilter(queries, library, 0.05, pmt, fmt, workers=int(params.get('workers', 1)), top_k=1)
+        with open(output, 'w') as fout:
+            msfilter.write_table(fout, queries, library, scores)
+    elif engine == 'sparse':
+        scores = msfilter_sparse.msfilter_sparse(queries, library, 0.05, pmt, fmt, top_k=1,
+                                                 cutoffs=parse_cutoffs(params.get('smj', 0.05)))
+        with open(output, 'w') as fout:
+            msfilter.write_table(fout, queries, library, scores)
+    elif engine == 'msfilter':
+        # The external binary reads .dta directories
+        tmp = tempfile.mkdtemp()
+        try:
+            for name, spectra in (('queries', queries), ('library', library)):
+                os.makedirs(os.path.join(tmp, name))
+                libindex.write_dta_files(spectra, os.path.join(tmp, name))
+            # Relative paths give the rows of all units the same prefix, which the sort sees on ties
+            subprocess.run(f"msfilter queries library 0.05 {pmt} {fmt} > {os.path.abspath(output)}", shell=True,
+                           check=True, cwd=tmp)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    else:
+        raise Exception(f"Unsupported scoring engine: {engine}")
+
+
+def work(directory: str, reclaim_after: float = None) -> int:
+    """
+    Processes units of a sharded job until none is left unclaimed.
+
+    :return: Number of units processed
+    """
+    job = read_job(directory)
+    done = 0
+    for unit in job['units']:
+        path = os.path.join(directory, UNITS_DIR, unit['name'])
+        if os.path.exists(path + SCORES_EXT) or not _claim(path + LOCK_EXT, reclaim_after):
+            continue
+        # Another worker may have finished the unit after a reclaim
+        if os.path.exists(path + SCORES_EXT):
+            continue
+        t0 = time.perf_counter()
+        tmp = f"{path}{SCORES_EXT}.{socket.gethostname()}.{os.getpid()}.tmp"
+        try:
+            score_unit(job['params'], path, tmp)
+            os.replace(tmp, path + SCORES_EXT)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            os.remove(path + LOCK_EXT)
+            raise
+        done += 1
+        print(f"{unit['name']}: charge {unit['charge']}, {unit['queries']} queries, {unit['library']} library "
+              f"spectra, {time.perf_counter() - t0:.2f} s", flush=True)
+    return done
+
+
+def merge(directory: str) -> List[str]:
+    """
+    Writes the outputs of a sharded job, once every unit is done, into the
+    current directory.
+
+    :return: Output files
+    """
+    job = read_job(directory)
+    params = job['params']
+    missing = [u['name'] for u in job['units']
+               if not os.path.exists(os.path.join(directory, UNITS_DIR, u['name'] + SCORES_EXT))]
+    if missing:
+        raise Exception(f"{len(missing)} of {len(job['units'])} units not done yet: {', '.join(missing[:10])}")
+
+    rows = []
+    for u in job['units']:
+        with open(os.path.join(directory, UNITS_DIR, u['name'] + SCORES_EXT)) as fin:
+            rows.extend(line for line in fin if len(line.split()) >= 7)
+    # As `sort -b -g -k 7,7` orders the table of a single-node job
+    rows.sort(key=lambda line: (msfilter.sort_key(float(line.split()[6])), line))
+
+    records, globals_meta, mgf_flag = spectra_io.read_spectra(os.path.join(directory, job['spectra']))
+    records = spectra_io.by_name(records)
+    mgf_output = mgf_flag and not params.get('dta_output')
+    name = output_name(job['spectra'], '')
+    suffix = f"-{params['suffix']}" if params.get('suffix') else ''
+    cutoffs = parse_cutoffs(params.get('smj', 0.05))
+    sweep = len(cutoffs) > 1
+    best = best_matches(rows)
+    ext = 'mgf' if mgf_output else 'zip'
+    outputs = []
+    for smj in cutoffs:
+        x = f"{suffix}-a{smj}" if sweep else suffix
+        tablefile = f"{name}{x}-table.csv"
+        processtable(None, tablefile, smj, name, len(records), mgf_output, x, records=records,
+                     globals_meta=globals_meta, best=best)
+        outputs.append(tablefile)
+        outputs.extend(f for f in (f"{name}{x}-good.{ext}", f"{name}{x}-background.{ext}") if os.path.exists(f))
+
+    params_file = f"{name}{suffix}-params.csv"
+    with open(params_file, 'w', newline='') as pf:
+        writer = csv.writer(pf)
+        writer.writerow(["Spectra", "Library", "PMT", "FMT", "SMJ", "RequestType", "Description"])
+        writer.writerow([job['upload'], params.get('uploaded_background_library'), params['pmt'], params['fmt'],
+                         ','.join(map(str, cutoffs)), 'Filter', params.get('description', '')])
+    return [params_file] + outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a Filter job into work units for several nodes")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("shard", help="Write the work units of a job into a shared directory")
+    p.add_argument("data_file", help="Spectra data file (MGF or .dta format)")
+    p.add_argument("library_file", nargs="?", default=None, help="Optional background library (MGF format)")
+    p.add_argument("-o", "--output", required=True, help="Job directory to create, on a shared file system")
+    p.add_argument("--units", type=int, default=os.cpu_count(), help="Approximate number of work units")
+    p.add_argument("-p", type=float, required=True, help="Precursor mass tolerance")
+    p.add_argument("-f", type=float, required=True, help="Fragment mass tolerance")
+    p.add_argument("-a", type=str, default="0.05", help="p-value cutoff, or a comma-separated list")
+    p.add_argument("-x", type=str, default="", help="Suffix for output files")
+    p.add_argument("-d", type=str, default="", help="Description/comment")
+    p.add_argument("-e", "--engine", choices=("python", "sparse", "msfilter"), default="python",
+                   help="Scoring engine")
+    p.add_argument("--workers", type=int, default=1, help="Processes per unit for the in-process engine")
+    p.add_argument("--dta-output", action="store_true", help="Write zipped .dta files instead of MGF for MGF input")
+    p.add_argument("--library-cache", default=None, metavar="DIR", help="Cache of preprocessed user libraries")
+
+    p = commands.add_parser("worker", help="Process unclaimed units of a job")
+    p.add_argument("directory", help="Job directory")
+    p.add_argument("--reclaim-after", type=float, default=None, metavar="SECONDS",
+                   help="Take over units locked longer than this without a result")
+
+    p = commands.add_parser("merge", help="Write the outputs of a job whose units are all done")
+    p.add_argument("directory", help="Job directory")
+    args = parser.parse_args()
+
+    if args.command == "shard":
+        params = {
+            'type': 'Filter', 'pmt': args.p, 'fmt': args.f, 'smj': ','.join(map(str, parse_cutoffs(args.a))),
+            'engine': args.engine, 'workers': args.workers, 'suffix': args.x, 'description': args.d,
+            'dta_output': args.dta_output or None, 'prjpath': os.path.dirname(os.path.abspath(__file__)),
+            'uploaded_background_library': os.path.abspath(args.library_file) if args.library_file else None,
+            'library_cache': os.path.abspath(args.library_cache) if args.library_cache else None,
+        }
+        job = shard({k: v for k, v in params.items() if v is not None}, args.data_file, args.output, args.units)
+        print(f"{len(job['units'])} units in {args.output}")
+    elif args.command == "worker":
+        print(f"Processed {work(args.directory, args.reclaim_after)} units")
+    else:
+        for f in merge(args.directory):
+            print(f"{os.getcwd()}/{f}")
+        print("\nCreated:", datetime.now().strftime("%c"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Per-job instrumentation: wall and CPU time per stage, peak memory and
+hot-path counters, written as a JSON file next to a job's other outputs.
+
+CPU time includes finished child processes (scoring workers, the msfilter
+binary, sort), so a stage whose CPU time is well below its wall time was
+waiting on I/O.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _cpu() -> float:
+    if resource is None:
+        t = os.times()
+        return t.user + t.system + t.children_user + t.children_system
+    cpu = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        r = resource.getrusage(who)
+        cpu += r.ru_utime + r.ru_stime
+    return cpu
+
+
+def peak_rss() -> dict:
+    """
+    Peak resident set size of this process and of its largest finished
+    child process, in bytes.
+    """
+    if resource is None:
+        return {}
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+
+class JobStats:
+    """
+    Stage timings and counters of one job. Stages are timed with
+    `with stats.stage(name):`; a stage entered more than once accumulates.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        wall, cpu = time.perf_counter(), _cpu()
+        try:
+            yield
+        finally:
+            s = self.stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0})
+            s['wall_s'] += time.perf_counter() - wall
+            s['cpu_s'] += _cpu() - cpu
+
+    def count(self, **counters) -> None:
+        self.counters.update(counters)
+
+    def merge(self, other: 'JobStats') -> None:
+        """
+        Adds the stages and counters of another JobStats, e.g. those of a
+        library load shared by the files of a batch job.
+        """
+        for name, s in other.stages.items():
+            t = self.stages.setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0})
+            t['wall_s'] += s['wall_s']
+            t['cpu_s'] += s['cpu_s']
+        self.counters.update(other.counters)
+
+    def as_dict(self) -> dict:
+        stages = {name: {k: round(v, 6) for k, v in s.items()} for name, s in self.stages.items()}
+        return {'stages': stages, 'wall_s': round(time.perf_counter() - self.start, 6),
+                'peak_rss_bytes': peak_rss(), 'counters': self.counters}
+
+    def write(self, path: str) -> None:
+        with open(path, 'w') as fout:
+            json.dump(self.as_dict(), fout, indent=1)
+            fout.write('\n')
+
+
+def null_stage(name: str):
+    """
+    Stand-in for JobStats.stage when a job is not instrumented.
+    """
+    return contextlib.nullcontext()
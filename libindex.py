@@ -0,0 +1,281 @@
+"""
+Prebuilt binary index of a .dta spectra library.
+
+The index holds the library sorted by charge and precursor mass, with all
+peaks in two contiguous arrays, and is opened with mmap so that concurrent
+jobs share its pages through the OS page cache:
+
+    $ python libindex.py compile data/redundant-library-1.11v
+
+writes data/redundant-library-1.11v.eeidx. The index records a fingerprint
+of the source directory (file names, sizes and modification times) and is
+never used when the directory has changed since it was compiled.
+
+User-supplied libraries are cached in the same format once preprocessed,
+keyed by the content hash of the library file (see cached_library()).
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import shutil
+import tempfile
+from typing import Tuple
+
+import numpy as np
+
+from msfilter import MassIndex, Spectrum, SpectrumStore, read_dta
+
+MAGIC = b'EEIDX001'
+ALIGN = 64
+INDEX_EXT = '.eeidx'
+# Bump when preprocessing changes, to invalidate cached user libraries
+CACHE_VERSION = 1
+
+
+class StaleIndexError(Exception):
+    pass
+
+
+def index_path(directory: str) -> str:
+    """
+    Default index file location for a library directory.
+    """
+    return os.path.normpath(directory) + INDEX_EXT
+
+
+def fingerprint(directory: str) -> str:
+    """
+    Fingerprint of the .dta files in a directory: names, sizes and
+    modification times.
+    """
+    h = hashlib.sha1()
+    entries = sorted((e.name, e.stat()) for e in os.scandir(directory)
+                     if len(e.name) >= 4 and e.name[-4:].lower() == '.dta')
+    for name, st in entries:
+        h.update(f"{name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def compile_library(directory: str, path: str = None) -> str:
+    """
+    Reads every .dta file of a library directory and writes the binary index.
+
+    :param directory: Library directory with .dta files
+    :param path: Index file to write (default: <directory>.eeidx)
+    :return: Path of the written index
+    """
+    path = path or index_path(directory)
+    fp = fingerprint(directory)
+    names = sorted(n for n in os.listdir(directory) if len(n) >= 4 and n[-4:].lower() == '.dta')
+    spectra = [read_dta(os.path.join(directory, n), scan_id=n) for n in names]
+    order = sorted(range(len(spectra)), key=lambda k: (spectra[k].charge, spectra[k].precursor_mass))
+    spectra = [spectra[k] for k in order]
+    return write_index(spectra, path, fp, os.path.abspath(directory))
+
+
+def write_index(spectra, path: str, fp: str, source: str) -> str:
+    """
+    Writes spectra, in their order, as an index file.
+
+    :param spectra: SpectrumStore or list of spectra; scan ids are stored as given
+    :param fp: Fingerprint of the source the spectra were read from
+    :param source: Directory the scan ids are relative to, or '' if they are not
+    :return: path
+    """
+    if isinstance(spectra, SpectrumStore):
+        ids = [spectra.scan_id(j).encode() for j in range(len(spectra))]
+        columns = spectra.precursor_mass, spectra.charge, spectra.offsets, spectra.mass, spectra.intensity
+    else:
+        lengths = np.array([len(s.mass) for s in spectra], dtype=np.int64)
+        ids = [s.scan_id.encode() for s in spectra]
+        columns = ([s.precursor_mass for s in spectra], [s.charge for s in spectra],
+                   np.concatenate(([0], np.cumsum(lengths))),
+                   np.concatenate([s.mass for s in spectra] or [np.zeros(0)]),
+                   np.concatenate([s.intensity for s in spectra] or [np.zeros(0)]))
+    arrays = {
+        'precursor_mass': np.asarray(columns[0], dtype=np.float64),
+        'charge': np.asarray(columns[1], dtype=np.int64),
+        'offsets': np.asarray(columns[2], dtype=np.int64),
+        'mass': np.asarray(columns[3], dtype=np.float64),
+        'intensity': np.asarray(columns[4], dtype=np.float64),
+        'id_offsets': np.concatenate(([0], np.cumsum([len(b) for b in ids]))).astype(np.int64),
+        'ids': np.frombuffer(b''.join(ids), dtype=np.uint8),
+    }
+
+    header = {'fingerprint': fp, 'source': source, 'count': len(ids), 'arrays': {}}
+    offset = 0
+    for name, a in arrays.items():
+        header['arrays'][name] = [offset, a.dtype.str, len(a)]
+        offset += -(-a.nbytes // ALIGN) * ALIGN
+    hbytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(hbytes)) // ALIGN) * ALIGN
+
+    # Write to a temporary file and rename, so concurrent readers never see a partial index
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=INDEX_EXT)
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            fout.write(MAGIC + struct.pack('<Q', len(hbytes)) + hbytes)
+            for name, a in arrays.items():
+                fout.seek(data_start + header['arrays'][name][0])
+                fout.write(a.tobytes())
+            fout.truncate(data_start + offset)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return path
+
+
+class LibraryIndex:
+    """
+    Memory-mapped library index. Spectra are returned in index order
+    (charge, precursor mass) as Spectrum objects whose peak arrays are views
+    into the mapped file.
+    """
+
+    def __init__(self, path: str, directory: str = None):
+        with open(path, 'rb') as fin:
+            self._mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise Exception(f"Not an EagleEye library index: {path}")
+        hlen, = struct.unpack_from('<Q', self._mm, len(MAGIC))
+        start = len(MAGIC) + 8
+        self.header = json.loads(self._mm[start:start + hlen])
+        data_start = -(-(start + hlen) // ALIGN) * ALIGN
+        for name, (offset, dtype, count) in self.header['arrays'].items():
+            setattr(self, name, np.frombuffer(self._mm, dtype=dtype, count=count, offset=data_start + offset))
+        self.path = path
+        self.directory = self.header['source'] if directory is None else directory
+        self._mass_index = None
+
+    def __reduce__(self):
+        # Reopen the mapping in the receiving process instead of pickling the arrays
+        return LibraryIndex, (self.path, self.directory)
+
+    @property
+    def fingerprint(self) -> str:
+        return self.header['fingerprint']
+
+    @property
+    def mass_index(self) -> MassIndex:
+        if self._mass_index is None:
+            self._mass_index = MassIndex(self.precursor_mass, self.charge)
+        return self._mass_index
+
+    def scan_id(self, j: int) -> str:
+        name = bytes(self.ids[self.id_offsets[j]:self.id_offsets[j + 1]]).decode()
+        return self.directory + '/' + name if self.directory else name
+
+    def __len__(self) -> int:
+        return self.header['count']
+
+    def __getitem__(self, j: int) -> Spectrum:
+        lo, hi = self.offsets[j], self.offsets[j + 1]
+        return Spectrum(self.precursor_mass[j], self.charge[j], self.scan_id(j),
+                        self.mass[lo:hi], self.intensity[lo:hi])
+
+
+def open_library(directory: str, path: str = None, rebuild: bool = False) -> LibraryIndex:
+    """
+    Opens the index of a library directory after checking it against the
+    directory's current fingerprint.
+
+    :param directory: Library directory the index was compiled from
+    :param path: Index file (default: <directory>.eeidx)
+    :param rebuild: Recompile a missing or stale index instead of raising StaleIndexError
+    """
+    path = path or index_path(directory)
+    if not os.path.exists(path):
+        if not rebuild:
+            raise StaleIndexError(f"No index for library {directory}: run 'libindex.py compile {directory}'")
+        compile_library(directory, path)
+    index = LibraryIndex(path, directory)
+    if index.fingerprint != fingerprint(directory):
+        if not rebuild:
+            raise StaleIndexError(f"Library index {path} is out of date with {directory}")
+        compile_library(directory, path)
+        index = LibraryIndex(path, directory)
+    return index
+
+
+def file_digest(path: str) -> str:
+    """
+    Content hash of a file.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cached_library(path: str, threshold: float, cache_dir: str, load) -> Tuple[LibraryIndex, str]:
+    """
+    Preprocessed user library from a cache directory, keyed by the content
+    hash of the library file and the threshold. On a miss, load() returns
+    the preprocessed spectra, which are stored for the next job.
+
+    :return: The library index and its cache key
+    """
+    key = hashlib.sha256(f"{file_digest(path)}\0{threshold!r}\0{CACHE_VERSION}".encode()).hexdigest()
+    index_file = os.path.join(cache_dir, key + INDEX_EXT)
+    if not os.path.exists(index_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        write_index(load(), index_file, key, '')
+    return LibraryIndex(index_file), key
+
+
+def write_dta_files(spectra, directory: str) -> None:
+    """
+    Writes spectra as .dta files named after their scan ids. Values are
+    written with repr(), so msfilter reads back the same doubles.
+    """
+    for s in spectra:
+        lines = [f"{s.precursor_mass!r} {s.charge}\n"]
+        lines += [f"{m!r} {i!r}\n" for m, i in zip(s.mass.tolist(), s.intensity.tolist())]
+        with open(os.path.join(directory, os.path.basename(s.scan_id)), 'w') as fout:
+            fout.writelines(lines)
+
+
+def cached_dta_directory(index: LibraryIndex, key: str, cache_dir: str) -> str:
+    """
+    The spectra of a cached library as a directory of .dta files, for the
+    msfilter binary, written on first use.
+    """
+    directory = os.path.join(cache_dir, key + '.dta')
+    if os.path.isdir(directory):
+        return directory
+    # Written next to the cache entry and renamed, so concurrent jobs never see a partial directory
+    tmp = tempfile.mkdtemp(dir=cache_dir, suffix='.tmp')
+    try:
+        write_dta_files(index, tmp)
+        os.rename(tmp, directory)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        # Another job renamed its copy into place first
+        if not os.path.isdir(directory):
+            raise
+    return directory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile or check a binary EagleEye library index")
+    parser.add_argument("command", choices=("compile", "check"))
+    parser.add_argument("directory", help="Library directory with .dta files")
+    parser.add_argument("-o", "--output", default=None, help="Index file (default: <directory>.eeidx)")
+    args = parser.parse_args()
+
+    if args.command == 'compile':
+        path = compile_library(args.directory, args.output)
+        print(f"Compiled {len(LibraryIndex(path))} spectra into {path}")
+    else:
+        index = open_library(args.directory, args.output)
+        print(f"{index.path}: {len(index)} spectra, up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,9 @@
 import math
 import os
 import shutil
+from contextlib import nullcontext
 from glob import glob
-from typing import Dict, List
+from typing import ContextManager, Dict, Iterable, List, Tuple, Union
 
 
 def compute_pvalue(score: float) -> float:
@@ -13,59 +14,124 @@ def compute_pvalue(score: float) -> float:
     return 1 - math.exp(- (score / 0.832697) ** 8.87259)
 
 
-def parse_table(table_path: str) -> Dict[str, float]:
-    PV: Dict[str, float] = {}
-    with open(table_path, "r") as fin:
+def open_table(table: Union[str, Iterable[str]]) -> ContextManager[Iterable[str]]:
+    """
+    Opens a score table given as a file name, or passes table lines through.
+    """
+    if isinstance(table, str):
+        return open(table, "r")
+    return nullcontext(table)
+
+
+class RedundancyGraph:
+    """
+    Spectra of a score table as integer ids, linked when their row has a
+    p-value strictly between 0 and smj. Only those edges are kept, with
+    their p-value. When a pair occurs in several rows, the last one decides,
+    as it did when every row was stored in a dict keyed by "fileA fileB".
+    """
+
+    def __init__(self, smj: float):
+        self.smj = smj
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.edges: Dict[Tuple[int, int], float] = {}
+        self._adjacency = None
+
+    def id(self, name: str) -> int:
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def add(self, fileA: str, fileB: str, pvalue: float) -> None:
+        a, b = self.id(fileA), self.id(fileB)
+        if a == b:
+            # A spectrum is never redundant with itself
+            return
+        edge = (a, b) if a < b else (b, a)
+        if 0 < pvalue < self.smj:
+            self.edges[edge] = pvalue
+        else:
+            self.edges.pop(edge, None)
+        self._adjacency = None
+
+    def with_cutoff(self, smj: float) -> 'RedundancyGraph':
+        """
+        The graph of the same table at a cutoff no higher than this one's.
+        """
+        if smj > self.smj:
+            raise Exception(f"Cannot raise the cutoff of a redundancy graph from {self.smj} to {smj}")
+        graph = RedundancyGraph(smj)
+        graph.ids, graph.names = self.ids, self.names
+        graph.edges = {edge: p for edge, p in self.edges.items() if p < smj}
+        return graph
+
+    def neighbors(self, i: int) -> List[int]:
+        if self._adjacency is None:
+            self._adjacency = [[] for _ in self.names]
+            for a, b in self.edges:
+                self._adjacency[a].append(b)
+                self._adjacency[b].append(a)
+        return self._adjacency[i]
+
+
+def read_graph(table: Union[str, Iterable[str]], smj: float) -> RedundancyGraph:
+    """
+    Streams a score table (file name or lines) into a RedundancyGraph.
+    """
+    graph = RedundancyGraph(smj)
+    with open_table(table) as fin:
         for line in fin:
-            arr = line.strip().split()
-            fileA = os.path.basename(arr[0])
-            fileB = os.path.basename(arr[1])
+            arr = line.split()
+            if not arr:
+                continue
             try:
                 score = float(arr[-1])
             except Exception:
                 score = -1.0
-            pvalue = compute_pvalue(score)
-            lr = f"{fileA} {fileB}"
-            rl = f"{fileB} {fileA}"
-            PV[lr] = pvalue
-            PV[rl] = pvalue
-            if fileA == fileB:
-                PV[lr] = 1.0
-                PV[rl] = 1.0
-    return PV
+            graph.add(os.path.basename(arr[0]), os.path.basename(arr[1]), compute_pvalue(score))
+    return graph
+
+
+def select_nonredundant(names: Iterable[str], graph: RedundancyGraph) -> List[str]:
+    """
+    Greedily selects spectra, skipping any that match an already selected
+    spectrum with a p-value below the cutoff.
+
+    :param names: Spectrum (.dta file) names, in selection order
+    :return: Selected names
+    """
+    list_of_files: List[str] = []
+    selected = set()
+    for f1 in names:
+        i = graph.ids.get(f1)
+        if i is not None:
+            if any(j in selected for j in graph.neighbors(i)):
+                continue
+            selected.add(i)
+        list_of_files.append(f1)
+    return list_of_files
 
 
 def select_nonredundant_files(
         dta_files: List[str],
-        PV: Dict[str, float],
-        smj: float,
+        graph: RedundancyGraph,
         output_dir: str
 ) -> None:
-    copied: Dict[str, int] = {}
-    list_of_files: List[str] = []
-    num_non_red_files = 0
-
-    for file in dta_files:
-        if copied.get(file, 0) == 1:
-            continue
-        net_pohojego = True
-        for i in range(num_non_red_files):
-            f1 = os.path.basename(file)
-            f2 = os.path.basename(list_of_files[i])
-            lr = f"{f1} {f2}"
-            rl = f"{f2} {f1}"
-            if ((PV.get(lr, 0) > 0 or PV.get(rl, 0) > 0) and
-                    (PV.get(lr, 0) < smj or PV.get(rl, 0) < smj)):
-                net_pohojego = False
-                break
-        if net_pohojego:
+    paths = {os.path.basename(f): f for f in dta_files}
+    for name in select_nonredundant(paths, graph):
+        file = paths[name]
+        dest = os.path.join(output_dir, name)
+        try:
+            # Hard links share the data with the input directory instead of copying it
             try:
-                shutil.copy(file, output_dir)
-            except Exception as e:
-                raise RuntimeError(f"Copy failed: {file} to {output_dir}: {str(e)}")
-            copied[file] = 1
-            list_of_files.append(file)
-            num_non_red_files += 1
+                os.link(file, dest)
+            except OSError:
+                shutil.copyfile(file, dest)
+        except Exception as e:
+            raise RuntimeError(f"Copy failed: {file} to {output_dir}: {str(e)}")
 
 
 def main(yourtable2: str, smj: float, msdata_temp_dir: str, msdata_nonred_lib: str) -> None:
@@ -75,7 +141,7 @@ def main(yourtable2: str, smj: float, msdata_temp_dir: str, msdata_nonred_lib: s
     :param msdata_temp_dir: Directory with input DTA files
     :param msdata_nonred_lib: Output directory for non-redundant DTA files
     """
-    PV = parse_table(yourtable2)
+    graph = read_graph(yourtable2, smj)
 
     dta_files = glob(os.path.join(msdata_temp_dir, "*.dta"))
     if not dta_files:
@@ -86,8 +152,7 @@ def main(yourtable2: str, smj: float, msdata_temp_dir: str, msdata_nonred_lib: s
 
     select_nonredundant_files(
         dta_files=dta_files,
-        PV=PV,
-        smj=smj,
+        graph=graph,
         output_dir=msdata_nonred_lib
     )
 
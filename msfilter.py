@@ -0,0 +1,777 @@
+"""
+In-process NumPy port of the msfilter scoring engine
+(src/msfilter.cc and src/correlations_eagle_eye_bins_6norms.cc).
+"""
+
+import math
+import multiprocessing
+import os
+from typing import Iterator, List, NamedTuple, TextIO
+
+import numpy as np
+
+
+class Spectrum:
+    """
+    A single MS/MS spectrum as loaded by msfilter: precursor (M+H) mass,
+    charge, identifier and the peak list in file order.
+    """
+    __slots__ = ('precursor_mass', 'charge', 'scan_id', 'mass', 'intensity', 'max_intensity')
+
+    def __init__(self, precursor_mass: float, charge: int, scan_id: str,
+                 mass: np.ndarray, intensity: np.ndarray):
+        self.precursor_mass = float(precursor_mass)
+        self.charge = int(charge)
+        self.scan_id = scan_id
+        self.mass = np.asarray(mass, dtype=np.float64)
+        self.intensity = np.asarray(intensity, dtype=np.float64)
+        # msfilter starts the running maximum at 0.0
+        self.max_intensity = float(self.intensity.max(initial=0.0))
+
+
+class ScoreTable(NamedTuple):
+    """
+    Scores in msfilter output order. `match` is -1 for queries without any
+    library spectrum within the precursor mass tolerance (DScore 1.0).
+    """
+    query: np.ndarray
+    match: np.ndarray
+    dscore: np.ndarray
+
+
+def parse_dta(text: str, scan_id: str) -> Spectrum:
+    """
+    Parses .dta content the way msfilter reads it: whitespace-separated
+    number pairs up to the first token that is not a number; the first pair
+    is "precursor_mass charge".
+    """
+    values = []
+    for tok in text.split():
+        try:
+            values.append(float(tok))
+        except ValueError:
+            break
+    n = len(values) // 2
+    if n == 0:
+        raise Exception(f"Invalid data format in file {scan_id}")
+    pairs = np.array(values[:2 * n], dtype=np.float64).reshape(n, 2)
+    return Spectrum(pairs[0, 0], int(pairs[0, 1]), scan_id, pairs[1:, 0], pairs[1:, 1])
+
+
+def read_dta(path: str, scan_id: str = None) -> Spectrum:
+    """
+    Reads a single .dta file.
+    """
+    with open(path, 'r') as fin:
+        return parse_dta(fin.read(), scan_id or path)
+
+
+def read_directory(directory_name: str, dtype=np.float64) -> 'SpectrumStore':
+    """
+    Loads every .dta file in a directory. Spectrum ids are "<dir>/<file>",
+    exactly as msfilter reports them in its output table.
+
+    :param dtype: Peak storage type, see SpectrumStore
+    """
+    store = SpectrumStore(dtype)
+    for name in sorted(os.listdir(directory_name)):
+        if len(name) < 4 or name[-4:].lower() != '.dta':
+            continue
+        s = read_dta(directory_name + '/' + name)
+        store.add(s.precursor_mass, s.charge, name, s.mass, s.intensity, prefix=directory_name)
+    return store.trim()
+
+
+def _grow(a: np.ndarray, n: int) -> np.ndarray:
+    """
+    Returns `a`, or a copy of it with room for at least n elements.
+    """
+    if n <= len(a):
+        return a
+    b = np.empty(max(n, 2 * len(a)), dtype=a.dtype)
+    b[:len(a)] = a
+    return b
+
+
+class SpectrumStore:
+    """
+    Columnar spectrum collection. All peaks live in two contiguous arrays
+    with per-spectrum offsets (CSR layout), next to precursor mass and charge
+    columns; scan ids are kept as one byte string of names plus an interned
+    table of directory prefixes. The store grows as spectra are added and has
+    no fixed capacity.
+
+    Indexing returns Spectrum objects whose peak arrays are views into the
+    store, so a SpectrumStore can be passed wherever a list of spectra is
+    expected. With dtype=np.float32 the peaks take half the memory, but m/z
+    values are rounded to about 1e-4 Da, which can move a peak across the
+    fragment mass tolerance and change DScores compared to msfilter.
+    """
+
+    def __init__(self, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self._count = 0
+        self._precursor_mass = np.empty(16, dtype=np.float64)
+        self._charge = np.empty(16, dtype=np.int32)
+        self._prefix = np.empty(16, dtype=np.int32)
+        self._offsets = np.zeros(17, dtype=np.int64)
+        self._id_offsets = np.zeros(17, dtype=np.int64)
+        self._mass = np.empty(1024, dtype=self.dtype)
+        self._intensity = np.empty(1024, dtype=self.dtype)
+        self._ids = bytearray()
+        self.prefixes = []
+        self._prefix_index = {}
+        self._mass_index = None
+
+    @classmethod
+    def from_spectra(cls, spectra, dtype=np.float64) -> 'SpectrumStore':
+        store = cls(dtype)
+        for s in spectra:
+            store.add(s.precursor_mass, s.charge, s.scan_id, s.mass, s.intensity)
+        return store.trim()
+
+    def add(self, precursor_mass: float, charge: int, scan_id: str,
+            mass: np.ndarray, intensity: np.ndarray, prefix: str = None) -> int:
+        """
+        Appends a spectrum and returns its index.
+
+        :param prefix: Directory the spectrum was read from. Its scan id is
+            then "<prefix>/<scan_id>", with the prefix stored only once.
+        """
+        j = self._count
+        npeaks = len(mass)
+        start = self._offsets[j]
+        self._precursor_mass = _grow(self._precursor_mass, j + 1)
+        self._charge = _grow(self._charge, j + 1)
+        self._prefix = _grow(self._prefix, j + 1)
+        self._offsets = _grow(self._offsets, j + 2)
+        self._id_offsets = _grow(self._id_offsets, j + 2)
+        self._mass = _grow(self._mass, start + npeaks)
+        self._intensity = _grow(self._intensity, start + npeaks)
+
+        self._precursor_mass[j] = precursor_mass
+        self._charge[j] = charge
+        if prefix is None:
+            self._prefix[j] = -1
+        else:
+            if prefix not in self._prefix_index:
+                self._prefix_index[prefix] = len(self.prefixes)
+                self.prefixes.append(prefix)
+            self._prefix[j] = self._prefix_index[prefix]
+        self._mass[start:start + npeaks] = mass
+        self._intensity[start:start + npeaks] = intensity
+        self._offsets[j + 1] = start + npeaks
+        self._ids += scan_id.encode()
+        self._id_offsets[j + 1] = len(self._ids)
+        self._count = j + 1
+        self._mass_index = None
+        return j
+
+    def trim(self) -> 'SpectrumStore':
+        """
+        Releases unused capacity once loading is done.
+        """
+        n, npeaks = self._count, self._offsets[self._count]
+        self._precursor_mass = self._precursor_mass[:n].copy()
+        self._charge = self._charge[:n].copy()
+        self._prefix = self._prefix[:n].copy()
+        self._offsets = self._offsets[:n + 1].copy()
+        self._id_offsets = self._id_offsets[:n + 1].copy()
+        self._mass = self._mass[:npeaks].copy()
+        self._intensity = self._intensity[:npeaks].copy()
+        return self
+
+    def select_peaks(self, keep: np.ndarray) -> 'SpectrumStore':
+        """
+        Copy of the store with only the peaks where `keep` is true.
+        """
+        store = SpectrumStore(self.dtype)
+        n = self._count
+        retained = np.concatenate(([0], np.cumsum(keep, dtype=np.int64)))
+        store._count = n
+        store._precursor_mass = self.precursor_mass.copy()
+        store._charge = self.charge.copy()
+        store._prefix = self._prefix[:n].copy()
+        store._offsets = retained[self.offsets]
+        store._id_offsets = self._id_offsets[:n + 1].copy()
+        store._mass = self.mass[keep]
+        store._intensity = self.intensity[keep]
+        store._ids = bytearray(self._ids)
+        store.prefixes = list(self.prefixes)
+        store._prefix_index = dict(self._prefix_index)
+        return store
+
+    @property
+    def precursor_mass(self) -> np.ndarray:
+        return self._precursor_mass[:self._count]
+
+    @property
+    def charge(self) -> np.ndarray:
+        return self._charge[:self._count]
+
+    @property
+    def offsets(self) -> np.ndarray:
+        return self._offsets[:self._count + 1]
+
+    @property
+    def mass(self) -> np.ndarray:
+        return self._mass[:self._offsets[self._count]]
+
+    @property
+    def intensity(self) -> np.ndarray:
+        return self._intensity[:self._offsets[self._count]]
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory held by the store's arrays, including unused capacity.
+        """
+        return sum(a.nbytes for a in (self._precursor_mass, self._charge, self._prefix, self._offsets,
+                                      self._id_offsets, self._mass, self._intensity)) + len(self._ids)
+
+    @property
+    def mass_index(self) -> 'MassIndex':
+        if self._mass_index is None:
+            self._mass_index = MassIndex(self.precursor_mass, self.charge)
+        return self._mass_index
+
+    def scan_id(self, j: int) -> str:
+        name = self._ids[self._id_offsets[j]:self._id_offsets[j + 1]].decode()
+        prefix = self._prefix[j]
+        return name if prefix < 0 else self.prefixes[prefix] + '/' + name
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, j: int) -> Spectrum:
+        if not -self._count <= j < self._count:
+            raise IndexError(j)
+        j %= self._count
+        lo, hi = self._offsets[j], self._offsets[j + 1]
+        return Spectrum(self._precursor_mass[j], self._charge[j], self.scan_id(j),
+                        self._mass[lo:hi], self._intensity[lo:hi])
+
+    def __iter__(self) -> Iterator[Spectrum]:
+        return (self[j] for j in range(self._count))
+
+
+class MassIndex:
+    """
+    Library precursor masses bucketed by charge and sorted, so the candidates
+    of a query are found by binary search instead of a scan of the library.
+    """
+
+    def __init__(self, precursor_mass: np.ndarray, charge: np.ndarray):
+        self.precursor_mass = np.asarray(precursor_mass, dtype=np.float64)
+        self.charge = np.asarray(charge, dtype=np.int64)
+        order = np.lexsort((self.precursor_mass, self.charge))
+        bounds = np.flatnonzero(np.diff(self.charge[order])) + 1
+        self._buckets = {}
+        for idx in np.split(order, bounds):
+            if len(idx):
+                self._buckets[int(self.charge[idx[0]])] = (self.precursor_mass[idx], idx)
+
+    def candidates(self, precursor_mass: float, charge: int, tolerance: float) -> np.ndarray:
+        """
+        Indices, in library order, of spectra with the given charge and
+        |precursor mass difference| < tolerance.
+        """
+        bucket = self._buckets.get(charge)
+        if bucket is None:
+            return np.zeros(0, dtype=np.int64)
+        masses, idx = bucket
+        # Widen the search by a few ulps and apply msfilter's exact test to the window
+        slack = 1e-9 * (abs(precursor_mass) + tolerance)
+        lo = np.searchsorted(masses, precursor_mass - tolerance - slack, side='left')
+        hi = np.searchsorted(masses, precursor_mass + tolerance + slack, side='right')
+        window = idx[lo:hi]
+        window = window[np.abs(precursor_mass - self.precursor_mass[window]) < tolerance]
+        return np.sort(window)
+
+
+class PeakList(NamedTuple):
+    """
+    The eye-catching peaks of a spectrum, as eagles_eye() uses them.
+
+    `seq_mass` and `weighted` are the peaks above threshold in the order
+    eagles_eye() visits them: bin 1 (below 90% of precursor m/z), bin 2
+    (90-100%) and bin 3 (above precursor m/z), each in file order, with
+    max-normalized intensities times the 2/1/4 bin weights. `mass` holds the
+    same peaks once each, in file order, for matching against.
+    """
+    seq_mass: np.ndarray
+    weighted: np.ndarray
+    mass: np.ndarray
+    total: float
+    seq_sorted: bool
+    mass_sorted: bool
+
+
+def peak_list(s: Spectrum, eye_catching_height: float) -> PeakList:
+    pm, ch = s.precursor_mass, s.charge
+    keep = s.intensity > s.max_intensity * eye_catching_height
+    mass = s.mass[keep]
+    bins = (mass < 0.900001 * pm / ch,
+            (mass > 0.9 * pm / ch) & (mass < 1.000001 * pm / ch),
+            mass > (pm / ch))
+    seq = np.concatenate([np.flatnonzero(b) for b in bins])
+    weight = np.repeat([2., 1., 4.], [np.count_nonzero(b) for b in bins])
+    norm = s.intensity[keep][seq] / s.max_intensity if s.max_intensity else np.zeros(0)
+    weighted = weight * norm
+    seq_mass = mass[seq]
+    return PeakList(seq_mass, weighted, mass, float(weighted.sum()),
+                    not np.any(np.diff(seq_mass) < 0), not np.any(np.diff(mass) < 0))
+
+
+def _columns(spectra) -> tuple:
+    """
+    (precursor_mass, charge, offsets, mass, intensity) columns of a
+    SpectrumStore, LibraryIndex or list of spectra.
+    """
+    if hasattr(spectra, 'offsets'):
+        return (np.asarray(spectra.precursor_mass, dtype=np.float64), np.asarray(spectra.charge),
+                np.asarray(spectra.offsets), np.asarray(spectra.mass, dtype=np.float64),
+                np.asarray(spectra.intensity, dtype=np.float64))
+    spectra = list(spectra)
+    lengths = [len(s.mass) for s in spectra]
+    return (np.array([s.precursor_mass for s in spectra], dtype=np.float64),
+            np.array([s.charge for s in spectra], dtype=np.int64),
+            np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+            np.concatenate([s.mass for s in spectra] + [np.zeros(0)]).astype(np.float64),
+            np.concatenate([s.intensity for s in spectra] + [np.zeros(0)]).astype(np.float64))
+
+
+def max_intensities(offsets: np.ndarray, intensity: np.ndarray) -> np.ndarray:
+    """
+    Highest intensity of each spectrum of a CSR peak column, as
+    Spectrum.max_intensity: msfilter starts the running maximum at 0.0.
+    """
+    lengths = np.diff(offsets)
+    max_intensity = np.zeros(len(lengths))
+    nonempty = lengths > 0
+    if nonempty.any():
+        max_intensity[nonempty] = np.maximum.reduceat(intensity, offsets[:-1][nonempty])
+    return np.maximum(max_intensity, 0.0)
+
+
+def _segment_sorted(values: np.ndarray, segment: np.ndarray, n: int) -> np.ndarray:
+    """
+    Per segment, whether its values are in ascending order.
+    """
+    down = np.flatnonzero((np.diff(values) < 0) & (segment[1:] == segment[:-1]))
+    result = np.ones(n, dtype=bool)
+    result[segment[down]] = False
+    return result
+
+
+class PeakLists:
+    """
+    peak_list() of every spectrum of a collection, computed in one pass and
+    kept in CSR layout, so that pair scoring only walks the retained peaks.
+    Indexing returns PeakList views.
+    """
+
+    def __init__(self, spectra, eye_catching_height: float):
+        pm, ch, offsets, mass, intensity = _columns(spectra)
+        n = len(pm)
+        lengths = np.diff(offsets)
+        spec = np.repeat(np.arange(n), lengths)
+        max_intensity = max_intensities(offsets, intensity)
+
+        keep = intensity > (max_intensity * eye_catching_height)[spec]
+        kspec, kmass, kint = spec[keep], mass[keep], intensity[keep]
+        # The bins of eagles_eye() overlap at their edges, a peak can be in two
+        bins = (kmass < (0.900001 * pm / ch)[kspec],
+                (kmass > (0.9 * pm / ch)[kspec]) & (kmass < (1.000001 * pm / ch)[kspec]),
+                kmass > (pm / ch)[kspec])
+        pos = [np.flatnonzero(b) for b in bins]
+        key = np.concatenate([kspec[p] * 3 + k for k, p in enumerate(pos)])
+        order = np.argsort(key, kind='stable')
+        seq = np.concatenate(pos)[order]
+        weight = np.repeat([2., 1., 4.], [len(p) for p in pos])[order]
+        sspec = kspec[seq]
+
+        # Peaks before thresholding
+        self.npeaks = len(mass)
+        self.mass = kmass
+        self.mass_offsets = np.concatenate(([0], np.cumsum(np.bincount(kspec, minlength=n)))).astype(np.int64)
+        self.seq_mass = kmass[seq]
+        self.weighted = weight * (kint[seq] / max_intensity[sspec])
+        self.seq_offsets = np.concatenate(([0], np.cumsum(np.bincount(sspec, minlength=n)))).astype(np.int64)
+        # Summed per spectrum like peak_list() does; reduceat may round differently
+        bounds = self.seq_offsets.tolist()
+        self.total = np.array([self.weighted[a:b].sum() for a, b in zip(bounds[:-1], bounds[1:])],
+                              dtype=np.float64)
+        self.seq_sorted = _segment_sorted(self.seq_mass, sspec, n)
+        self.mass_sorted = _segment_sorted(self.mass, kspec, n)
+
+    def __len__(self) -> int:
+        return len(self.total)
+
+    def __getitem__(self, j: int) -> PeakList:
+        if j < 0:
+            j += len(self.total)
+        a, b = self.seq_offsets[j], self.seq_offsets[j + 1]
+        c, d = self.mass_offsets[j], self.mass_offsets[j + 1]
+        return PeakList(self.seq_mass[a:b], self.weighted[a:b], self.mass[c:d], float(self.total[j]),
+                        bool(self.seq_sorted[j]), bool(self.mass_sorted[j]))
+
+
+def _match_sequential(m1: np.ndarray, m2: np.ndarray, fragment_mass_tolerance: float) -> np.ndarray:
+    """
+    Literal replica of the msfilter peak matching loop, where the search for
+    each peak resumes at the previous match. Used for unsorted peak lists.
+    """
+    matched = np.zeros(len(m1), dtype=bool)
+    lastj = 0
+    for k, m in enumerate(m1):
+        lo, hi = m - fragment_mass_tolerance, m + fragment_mass_tolerance
+        for j in range(lastj, len(m2)):
+            if lo < m2[j] < hi:
+                lastj = j
+                matched[k] = True
+                break
+    return matched
+
+
+def _match(p1: PeakList, p2: PeakList, fragment_mass_tolerance: float) -> np.ndarray:
+    """
+    Flags the peaks of p1 that have a partner in p2 within the fragment mass
+    tolerance. When both lists are in ascending order the msfilter resume
+    point never skips a candidate, so a binary search gives the same answer.
+    """
+    m1, m2 = p1.seq_mass, p2.mass
+    if len(m1) == 0 or len(m2) == 0:
+        return np.zeros(len(m1), dtype=bool)
+    if not (p1.seq_sorted and p2.mass_sorted):
+        return _match_sequential(m1, m2, fragment_mass_tolerance)
+    lo = np.searchsorted(m2, m1 - fragment_mass_tolerance, side='right')
+    matched = lo < len(m2)
+    matched[matched] = m2[lo[matched]] < m1[matched] + fragment_mass_tolerance
+    return matched
+
+
+def _nesovpal(p1: PeakList, p2: PeakList, fragment_mass_tolerance: float) -> float:
+    return float(p1.weighted[~_match(p1, p2, fragment_mass_tolerance)].sum())
+
+
+def _ratio(nesovpal: float, total: float) -> float:
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return float(np.float64(nesovpal) / np.float64(total))
+
+
+def eagles_eye(s1: Spectrum, s2: Spectrum, eye_catching_height: float,
+               fragment_mass_tolerance: float) -> tuple:
+    """
+    Vectorized eagles_eye(): weighted intensity of the eye-catching peaks of
+    s1 that are not matched in s2, and the weighted total intensity of s1.
+
+    :return: (nesovpal, total_intens)
+    """
+    p1 = peak_list(s1, eye_catching_height)
+    return _nesovpal(p1, peak_list(s2, eye_catching_height), fragment_mass_tolerance), p1.total
+
+
+def _dscore(p1: PeakList, p2: PeakList, fragment_mass_tolerance: float) -> float:
+    return _ratio(_nesovpal(p1, p2, fragment_mass_tolerance) + _nesovpal(p2, p1, fragment_mass_tolerance),
+                  p1.total + p2.total)
+
+
+def dscore(s1: Spectrum, s2: Spectrum, eye_catching_height: float,
+           fragment_mass_tolerance: float) -> float:
+    """
+    Symmetric distance between two spectra, 0 for identical peak lists and 1
+    for no peaks in common.
+    """
+    return _dscore(peak_list(s1, eye_catching_height), peak_list(s2, eye_catching_height),
+                   fragment_mass_tolerance)
+
+
+def pvalue(dscore: float) -> float:
+    """
+    p-value of a DScore under the Weibull fit used to classify spectra.
+    """
+    if dscore == 1.0:
+        return 1
+    elif dscore > 0:
+        return 1 - math.exp(-(dscore / 0.832697) ** 8.87259)
+    return 0
+
+
+def dscore_cutoff(cutoff: float) -> float:
+    """
+    The DScore a p-value cutoff corresponds to: for DScores below 1,
+    pvalue(d) < cutoff exactly when d < dscore_cutoff(cutoff).
+    """
+    if cutoff <= 0:
+        return 0.0
+    elif cutoff >= 1:
+        return 1.0
+    return 0.832697 * (-math.log1p(-cutoff)) ** (1 / 8.87259)
+
+
+def sort_key(dscore: float) -> float:
+    """
+    Ordering key of a DScore in the text table, as `sort -g` sees it: the
+    value printed with 6 significant digits, with NaN sorting first.
+    """
+    value = float(f"{dscore:g}")
+    return -math.inf if math.isnan(value) else value
+
+
+def _best(library: List[Spectrum], candidates: np.ndarray, scores: np.ndarray, top_k: int) -> tuple:
+    """
+    The top_k candidates of one query in sorted table order: lowest printed
+    DScore first, ties broken by library spectrum id.
+    """
+    keys = np.array([sort_key(d) for d in scores.tolist()])
+    if len(keys) > top_k:
+        # Keep everything tied with the k-th key, the id tie-break decides among those
+        kth = np.partition(keys, top_k - 1)[top_k - 1]
+        keep = np.flatnonzero(keys <= kth)
+        candidates, scores, keys = candidates[keep], scores[keep], keys[keep]
+    order = sorted(range(len(keys)), key=lambda k: (keys[k], library[candidates[k]].scan_id))[:top_k]
+    return candidates[order], scores[order]
+
+
+# Heaviest query peaks whose unmatched weight bounds a pair before it is scored
+PRUNE_PEAKS = 32
+
+
+def _segments(offsets: np.ndarray, candidates: np.ndarray) -> tuple:
+    """
+    Indices of the elements of the given CSR segments, concatenated, and
+    the start of each segment in them.
+    """
+    starts, ends = offsets[candidates], offsets[candidates + 1]
+    lengths = ends - starts
+    first = np.cumsum(lengths) - lengths
+    return np.repeat(starts - first, lengths) + np.arange(int(lengths.sum())), first, lengths
+
+
+def _segment_sums(values: np.ndarray, first: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    sums = np.zeros((len(lengths),) + values.shape[1:], dtype=values.dtype)
+    nonempty = lengths > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, first[nonempty], axis=0)
+    return sums
+
+
+def _unmatched_bounds(pq: PeakList, peaks: PeakLists, candidates: np.ndarray,
+                      fragment_mass_tolerance: float) -> np.ndarray:
+    """
+    A lower bound of nesovpal1 + nesovpal2 of the query against each
+    candidate: the unmatched weight of the PRUNE_PEAKS heaviest peaks of the
+    query, and of all peaks of the candidate. Peaks are matched with the
+    comparisons of _match() against every peak of the other spectrum, so a
+    partner msfilter finds is always found; its resumed search on unsorted
+    lists can only miss some.
+    """
+    tol = fragment_mass_tolerance
+    heavy = np.argsort(-pq.weighted, kind='stable')[:PRUNE_PEAKS]
+    mass, weighted = pq.seq_mass[heavy], pq.weighted[heavy]
+    idx, first, lengths = _segments(peaks.mass_offsets, candidates)
+    m2 = peaks.mass[idx][:, None]
+    hit = ((m2 > mass - tol) & (m2 < mass + tol)).astype(np.int64)
+    bound1 = (_segment_sums(hit, first, lengths) == 0).astype(np.float64) @ weighted
+
+    idx, first, lengths = _segments(peaks.seq_offsets, candidates)
+    m1 = peaks.seq_mass[idx]
+    qmass = np.sort(pq.mass)
+    matched = np.zeros(len(m1), dtype=bool)
+    if len(qmass):
+        lo = np.searchsorted(qmass, m1 - tol, side='right')
+        matched = lo < len(qmass)
+        matched[matched] = qmass[lo[matched]] < m1[matched] + tol
+    bound2 = _segment_sums(np.where(matched, 0.0, peaks.weighted[idx]), first, lengths)
+    return bound1 + bound2
+
+
+def _score_pruned(q: Spectrum, pq: PeakList, library: List[Spectrum], index: MassIndex,
+                  peaks: PeakLists, candidates: np.ndarray, fragment_mass_tolerance: float) -> tuple:
+    """
+    Best match of one query, the same as _best() with top_k=1. Candidates
+    are visited in order of a lower bound of their DScore (see
+    _unmatched_bounds()), and scoring stops at the first one whose bound
+    cannot beat the best match so far. A pair is also dropped when
+    nesovpal1 alone cannot; nesovpal2 only adds to it.
+
+    :return: (match, dscore, number of pairs fully scored)
+    """
+    totals = pq.total + peaks.total[candidates]
+    # Summed in another order than nesovpal1; the margin keeps them lower bounds
+    bounds = _unmatched_bounds(pq, peaks, candidates, fragment_mass_tolerance) * (1 - 1e-12)
+    keys = [sort_key(_ratio(b, t)) for b, t in zip(bounds.tolist(), totals.tolist())]
+    distance = np.abs(q.precursor_mass - index.precursor_mass[candidates]).tolist()
+    best = None
+    scored = 0
+    for k in sorted(range(len(candidates)), key=lambda k: (keys[k], distance[k])):
+        if best is not None and keys[k] > best[0]:
+            break
+        j = int(candidates[k])
+        pl = peaks[j]
+        total = pq.total + pl.total
+        nesovpal1 = _nesovpal(pq, pl, fragment_mass_tolerance)
+        if best is not None and sort_key(_ratio(nesovpal1, total)) > best[0]:
+            continue
+        scored += 1
+        ds = _ratio(nesovpal1 + _nesovpal(pl, pq, fragment_mass_tolerance), total)
+        key = sort_key(ds)
+        if best is None or key <= best[0]:
+            key = (key, library[j].scan_id)
+            if best is None or key < best[:2]:
+                best = key + (j, ds)
+    return np.array([best[2]]), np.array([best[3]]), scored
+
+
+def _score_range(queries: List[Spectrum], library: List[Spectrum], index: MassIndex, lo: int, hi: int,
+                 query_peaks: PeakLists, library_peaks: PeakLists, precursor_mass_tolerance: float,
+                 fragment_mass_tolerance: float, top_k: int = None, prune: bool = False) -> tuple:
+    """
+    :return: (ScoreTable of queries lo..hi, candidate window size of each
+        query, number of pairs scored)
+    """
+    qidx, midx, scores = [], [], []
+    windows = np.zeros(hi - lo, dtype=np.int64)
+    pairs = 0
+    for i in range(lo, hi):
+        q = queries[i]
+        candidates = index.candidates(q.precursor_mass, q.charge, precursor_mass_tolerance)
+        windows[i - lo] = len(candidates)
+        if len(candidates) == 0:
+            qidx.append(i)
+            midx.append(-1)
+            scores.append(1.0)
+            continue
+        pq = query_peaks[i]
+        if prune and top_k == 1:
+            candidates, ds, scored = _score_pruned(q, pq, library, index, library_peaks, candidates,
+                                                   fragment_mass_tolerance)
+            pairs += scored
+        else:
+            ds = np.array([_dscore(pq, library_peaks[j], fragment_mass_tolerance) for j in candidates.tolist()])
+            pairs += len(ds)
+            if top_k:
+                candidates, ds = _best(library, candidates, ds, top_k)
+        qidx.extend([i] * len(candidates))
+        midx.extend(candidates.tolist())
+        scores.extend(ds.tolist())
+    table = ScoreTable(np.array(qidx, dtype=np.int64), np.array(midx, dtype=np.int64),
+                       np.array(scores, dtype=np.float64))
+    return table, windows, pairs
+
+
+# Per-process scoring state of pool workers, set once by _init_worker
+_worker_state = None
+
+
+def _init_worker(*state) -> None:
+    global _worker_state
+    _worker_state = state
+
+
+def _score_chunk(bounds: tuple) -> tuple:
+    queries, library, index, query_peaks, library_peaks, pmt, fmt, top_k, prune = _worker_state
+    return _score_range(queries, library, index, bounds[0], bounds[1], query_peaks, library_peaks,
+                        pmt, fmt, top_k, prune)
+
+
+def msfilter(queries: List[Spectrum], library: List[Spectrum], eye_catching_height: float,
+             precursor_mass_tolerance: float, fragment_mass_tolerance: float,
+             workers: int = 1, top_k: int = None, prune: bool = False,
+             library_peaks: PeakLists = None, stats: dict = None) -> ScoreTable:
+    """
+    Scores every query against all library spectra of the same charge within
+    the precursor mass tolerance, as msfilter's main() does.
+
+    :param queries: Query spectra
+    :param library: Library (background) spectra, a list, SpectrumStore or libindex.LibraryIndex
+    :param eye_catching_height: Peak intensity threshold, relative to the highest peak
+    :param precursor_mass_tolerance: Precursor mass tolerance, Da
+    :param fragment_mass_tolerance: Fragment mass tolerance, Da
+    :param workers: Number of processes; queries are scored in contiguous
+        chunks and merged in query order, so the result does not depend on it
+    :param top_k: Keep only the k best matches of each query (see sort_table)
+        instead of every candidate pair
+    :param prune: With top_k=1, score candidates in order of a lower bound
+        of their DScore and stop at the first one that cannot beat the best
+        match so far (see _score_pruned); the result is the same as without
+        it.
+    :param library_peaks: PeakLists of the library at eye_catching_height,
+        when already computed for an earlier call
+    :param stats: If given, filled with counters: spectra, peaks before and
+        after thresholding, candidate window sizes and pairs fully scored
+    """
+    index = getattr(library, 'mass_index', None) or \
+        MassIndex([s.precursor_mass for s in library], [s.charge for s in library])
+    # Threshold, normalize and bin every spectrum once instead of per pair
+    query_peaks = PeakLists(queries, eye_catching_height)
+    if library_peaks is None:
+        library_peaks = PeakLists(library, eye_catching_height)
+    n = len(queries)
+    if workers <= 1 or n < 2:
+        parts = [_score_range(queries, library, index, 0, n, query_peaks, library_peaks,
+                              precursor_mass_tolerance, fragment_mass_tolerance, top_k, prune)]
+    else:
+        parts = _score_parallel(queries, library, index, query_peaks, library_peaks, precursor_mass_tolerance,
+                                fragment_mass_tolerance, workers, top_k, prune)
+    tables, windows, pairs = zip(*parts)
+    if stats is not None:
+        windows = np.concatenate(windows)
+        stats.update(queries=n, library_spectra=len(library),
+                     query_peaks=query_peaks.npeaks, query_peaks_retained=len(query_peaks.mass),
+                     library_peaks=library_peaks.npeaks, library_peaks_retained=len(library_peaks.mass),
+                     pairs_scored=int(sum(pairs)), window_total=int(windows.sum()),
+                     window_mean=float(windows.mean()) if n else 0.0, window_max=int(windows.max()) if n else 0)
+    if len(tables) == 1:
+        return tables[0]
+    return ScoreTable(*(np.concatenate([getattr(t, f) for t in tables]) for f in ScoreTable._fields))
+
+
+def _score_parallel(queries, library, index: MassIndex, query_peaks: PeakLists, library_peaks: PeakLists,
+                    precursor_mass_tolerance: float, fragment_mass_tolerance: float, workers: int,
+                    top_k: int, prune: bool) -> list:
+    n = len(queries)
+    # Several chunks per worker to even out the load; with the fork start method
+    # the library is inherited by the workers rather than pickled
+    size = max(1, -(-n // (workers * 8)))
+    chunks = [(lo, min(lo + size, n)) for lo in range(0, n, size)]
+    state = (queries, library, index, query_peaks, library_peaks, precursor_mass_tolerance,
+             fragment_mass_tolerance, top_k, prune)
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    with ctx.Pool(workers, initializer=_init_worker, initargs=state) as pool:
+        return pool.map(_score_chunk, chunks)
+
+
+def table_lines(queries: List[Spectrum], library: List[Spectrum], table: ScoreTable) -> Iterator[str]:
+    """
+    Score rows in the tab-separated text format of msfilter's stdout.
+    """
+    for i, j, ds in zip(table.query.tolist(), table.match.tolist(), table.dscore.tolist()):
+        q = queries[i]
+        if j < 0:
+            yield (f"{q.scan_id}\tno_bckgr_spectra_with_same_precursor_mass\t\t\t"
+                   f"{q.precursor_mass:g}\tnot_found\t\t{q.charge}\tnot_found\t\t1.00\n")
+        else:
+            s = library[j]
+            yield (f"{q.scan_id}\t{s.scan_id}\t{q.precursor_mass:g}\t{s.precursor_mass:g}\t"
+                   f"{q.charge}\t{s.charge}\t{ds:g}\n")
+
+
+def write_table(fout: TextIO, queries: List[Spectrum], library: List[Spectrum], table: ScoreTable) -> None:
+    """
+    Writes scores in the tab-separated text format of msfilter's stdout.
+    """
+    fout.writelines(table_lines(queries, library, table))
+
+
+def sort_table(queries: List[Spectrum], library: List[Spectrum], table: ScoreTable) -> ScoreTable:
+    """
+    Reorders rows as `sort -b -g -k 7,7` orders the text table in the C
+    locale: by printed DScore, ties by the whole line.
+    """
+    lines = list(table_lines(queries, library, table))
+    keys = [1.0 if j < 0 else sort_key(ds) for j, ds in zip(table.match.tolist(), table.dscore.tolist())]
+    order = sorted(range(len(lines)), key=lambda k: (keys[k], lines[k]))
+    return ScoreTable(*(a[order] for a in table))
@@ -0,0 +1,262 @@
+"""
+Approximate batch variant of msfilter.msfilter(): peak matching by sparse
+matrix products instead of pair by pair.
+
+The eye-catching peaks of every spectrum (PeakLists, with their bin 1/2/3
+weights and normalization) are binned on a grid of fragment_mass_tolerance
+/ subdivisions. Each spectrum gives two sparse rows:
+
+- weights: its weighted peak intensities summed per grid cell;
+- partners: 1 in every cell within `subdivisions` cells of one of its peaks.
+
+For a block of queries of one charge and all library spectra within the
+precursor mass tolerance of the block, weights(queries) @ partners(library).T
+holds the matched weight of each query against each candidate, and
+partners(queries) @ weights(library).T the reverse. DScores are assembled
+from those sums and the PeakLists totals.
+
+Deviation from msfilter: a peak counts as matched when its partner is
+closer than fragment_mass_tolerance * (1 + 1 / subdivisions), instead of
+closer than fragment_mass_tolerance, and peak lists are taken as sorted
+(msfilter's resumed search can miss partners in unsorted lists). Every
+exact match is also found, so a DScore is never higher than msfilter's
+beyond rounding, and is lower by the weighted share of peaks whose nearest
+partner is in the extra margin. Spectra with few eye-catching peaks deviate
+most. `python -m benchmarks.bench_sparse` measures the deviation and fails
+when it exceeds MAX_DEVIATION. On its synthetic data (100 peaks per
+spectrum, sorted peak lists, -p 2 -f 0.6) the mean deviation is 0.007, the
+99.9th percentile 0.13, and the largest one grows with the number of pairs,
+from 0.20 to 0.27 with a library of 20000 spectra to 0.32 with 267000;
+Queries can only move towards Background, never away from it.
+
+Given p-value cutoffs, pairs whose approximate DScore is below the DScore
+of the highest cutoff (msfilter.dscore_cutoff()) are rescored exactly, as
+msfilter.msfilter() scores them. MAX_DEVIATION is measured, not a bound,
+but a DScore that is never higher than msfilter's is: the other pairs are
+above every cutoff, exact or not. So the Good/Background call of each
+query, and the pairs a Nonred job links, are the same as with msfilter.
+"""
+
+from typing import List, Sequence
+
+import numpy as np
+
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
+
+from msfilter import MassIndex, PeakLists, ScoreTable, Spectrum, _best, _dscore, dscore_cutoff
+
+# Grid cells per fragment mass tolerance
+SUBDIVISIONS = 2
+# Most queries scored together
+BLOCK_SIZE = 256
+# Widest precursor mass range of a block, in precursor mass tolerances: the
+# products cover every query of a block against every candidate of the block
+BLOCK_SPAN = 4.0
+# Most library rows of a block multiplied at once: bounds the dense products
+# to SLAB_ROWS x BLOCK_SIZE whatever the library density and tolerance
+SLAB_ROWS = 4096
+# Bound on msfilter DScore - sparse DScore checked by benchmarks.bench_sparse
+MAX_DEVIATION = 0.4
+# Slack for a DScore printed with 6 significant digits, which processtable() classifies
+ROUNDING = 1e-5
+
+
+class SparseBins:
+    """
+    The weights and partners matrices of a PeakLists, with rows in order of
+    charge and precursor mass so that spectra of a mass window are a
+    contiguous slice; `position` maps a spectrum index to its row.
+    """
+
+    def __init__(self, peaks: PeakLists, precursor_mass: np.ndarray, charge: np.ndarray,
+                 fragment_mass_tolerance: float, subdivisions: int = SUBDIVISIONS):
+        if sparse is None:
+            raise Exception("The sparse scoring engine requires scipy")
+        self.fragment_mass_tolerance = fragment_mass_tolerance
+        self.subdivisions = subdivisions
+        n = len(peaks)
+        order = np.lexsort((precursor_mass, charge))
+        self.position = np.empty(n, dtype=np.int64)
+        self.position[order] = np.arange(n)
+        width = fragment_mass_tolerance / subdivisions
+        # Cells are shifted so that a peak's partner cells never have a negative index
+        rows = np.repeat(self.position, np.diff(peaks.seq_offsets))
+        cells = np.floor(peaks.seq_mass / width).astype(np.int64) + subdivisions
+        self.ncols = int(cells.max(initial=0)) + subdivisions + 1
+        self.weights = sparse.csr_matrix((peaks.weighted, (rows, cells)), shape=(n, self.ncols))
+
+        rows = np.repeat(self.position, np.diff(peaks.mass_offsets))
+        cells = np.floor(peaks.mass / width).astype(np.int64) + subdivisions
+        spread = np.arange(-subdivisions, subdivisions + 1)
+        self.partners = sparse.csr_matrix((np.ones(len(cells) * len(spread)),
+                                           (np.repeat(rows, len(spread)), (cells[:, None] + spread).ravel())),
+                                          shape=(n, self.ncols))
+        self.partners.data[:] = 1.0
+        self.total = peaks.total[order]
+
+    def resize(self, ncols: int) -> None:
+        """
+        Widens the matrices to ncols columns, for spectra of higher mass.
+        """
+        if ncols > self.ncols:
+            self.weights.resize((self.weights.shape[0], ncols))
+            self.partners.resize((self.partners.shape[0], ncols))
+            self.ncols = ncols
+
+
+def library_bins(library: List[Spectrum], library_peaks: PeakLists, fragment_mass_tolerance: float) -> SparseBins:
+    """
+    SparseBins of a library, to reuse across msfilter_sparse() calls with
+    the same fragment mass tolerance.
+    """
+    index = getattr(library, 'mass_index', None) or \
+        MassIndex([s.precursor_mass for s in library], [s.charge for s in library])
+    return SparseBins(library_peaks, index.precursor_mass, index.charge, fragment_mass_tolerance)
+
+
+def _score_block(block: np.ndarray, candidates: List[np.ndarray], qbins: SparseBins, lbins: SparseBins) -> tuple:
+    """
+    DScores of a block of queries, consecutive rows of qbins, against their
+    candidates.
+
+    :return: (query, match, dscore) arrays of all pairs of the block
+    """
+    match = np.concatenate(candidates)
+    lrow = lbins.position[match]
+    qrow = np.repeat(qbins.position[block], [len(c) for c in candidates])
+    q0, q1 = int(qrow.min()), int(qrow.max()) + 1
+    weights_q, partners_q = qbins.weights[q0:q1].T, qbins.partners[q0:q1].T
+    matched_q, matched_l = np.empty(len(match)), np.empty(len(match))
+    # Pairs by library row, multiplied a slab of library rows at a time
+    order = np.argsort(lrow, kind='stable')
+    rows = lrow[order]
+    lo = 0
+    while lo < len(rows):
+        l0 = int(rows[lo])
+        hi = int(np.searchsorted(rows, l0 + SLAB_ROWS))
+        pairs = order[lo:hi]
+        l1 = int(rows[hi - 1]) + 1
+        r, c = lrow[pairs] - l0, qrow[pairs] - q0
+        # Candidates x queries: only the smaller query side is transposed
+        matched_q[pairs] = (lbins.partners[l0:l1] @ weights_q).toarray()[r, c]
+        matched_l[pairs] = (lbins.weights[l0:l1] @ partners_q).toarray()[r, c]
+        lo = hi
+    tq, tl = qbins.total[qrow], lbins.total[lrow]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ds = ((tq - matched_q) + (tl - matched_l)) / (tq + tl)
+    return np.repeat(block, [len(c) for c in candidates]), match, ds
+
+
+def _blocks(group: np.ndarray, pm: np.ndarray, span: float, size: int) -> List[np.ndarray]:
+    """
+    Splits queries of one charge, in precursor mass order, into blocks of at
+    most `size` queries and `span` Da.
+    """
+    blocks = []
+    start = 0
+    masses = pm[group].tolist()
+    for k, m in enumerate(masses):
+        if k - start == size or m - masses[start] > span:
+            blocks.append(group[start:k])
+            start = k
+    if start < len(masses):
+        blocks.append(group[start:])
+    return blocks
+
+
+def msfilter_sparse(queries: List[Spectrum], library: List[Spectrum], eye_catching_height: float,
+                    precursor_mass_tolerance: float, fragment_mass_tolerance: float, top_k: int = None,
+                    library_peaks: PeakLists = None, library_bins: SparseBins = None, stats: dict = None,
+                    block_size: int = BLOCK_SIZE, cutoffs: Sequence[float] = None) -> ScoreTable:
+    """
+    msfilter.msfilter() with approximate peak matching, see the module
+    docstring. Rows are in the same order. Runs in one process and does
+    not prune candidates.
+
+    :param cutoffs: p-Value cutoffs the table is classified at; pairs that
+        may be below one are rescored exactly
+    :param library_peaks: PeakLists of the library at eye_catching_height,
+        when already computed for an earlier call
+    :param library_bins: library_bins() of the library at fragment_mass_tolerance,
+        when already computed for an earlier call
+    """
+    index = getattr(library, 'mass_index', None) or \
+        MassIndex([s.precursor_mass for s in library], [s.charge for s in library])
+    query_peaks = PeakLists(queries, eye_catching_height)
+    if library_peaks is None:
+        library_peaks = PeakLists(library, eye_catching_height)
+    if library_bins is None:
+        library_bins = SparseBins(library_peaks, index.precursor_mass, index.charge, fragment_mass_tolerance)
+    elif library_bins.fragment_mass_tolerance != fragment_mass_tolerance:
+        raise Exception("library_bins were computed for another fragment mass tolerance")
+    n = len(queries)
+    pm = np.array([q.precursor_mass for q in queries], dtype=np.float64)
+    charge = np.array([q.charge for q in queries], dtype=np.int64)
+    qbins = SparseBins(query_peaks, pm, charge, fragment_mass_tolerance, library_bins.subdivisions)
+    library_bins.resize(qbins.ncols)
+    qbins.resize(library_bins.ncols)
+
+    windows = np.zeros(n, dtype=np.int64)
+    parts = []
+    # Blocks of queries close in mass share most of their candidates
+    order = np.lexsort((pm, charge))
+    bounds = np.flatnonzero(np.diff(charge[order])) + 1
+    for group in np.split(order, bounds):
+        for block in _blocks(group, pm, BLOCK_SPAN * precursor_mass_tolerance, block_size):
+            candidates = [index.candidates(pm[i], charge[i], precursor_mass_tolerance) for i in block.tolist()]
+            windows[block] = [len(c) for c in candidates]
+            found = windows[block] > 0
+            if (~found).any():
+                parts.append((block[~found], np.full((~found).sum(), -1), np.ones((~found).sum())))
+            if found.any():
+                parts.append(_score_block(block[found], [c for c in candidates if len(c)], qbins, library_bins))
+
+    qidx, midx, ds = (np.concatenate([p[k] for p in parts]) if parts else np.zeros(0) for k in range(3))
+    rows = np.lexsort((midx, qidx))
+    table = ScoreTable(qidx[rows].astype(np.int64), midx[rows].astype(np.int64), ds[rows].astype(np.float64))
+    pairs = int(np.count_nonzero(table.match >= 0))
+    rescored = _rescore(table, query_peaks, library_peaks, fragment_mass_tolerance, cutoffs) if cutoffs else 0
+    if top_k:
+        table = _top_k(library, table, top_k)
+    if stats is not None:
+        stats.update(queries=n, library_spectra=len(library),
+                     query_peaks=query_peaks.npeaks, query_peaks_retained=len(query_peaks.mass),
+                     library_peaks=library_peaks.npeaks, library_peaks_retained=len(library_peaks.mass),
+                     pairs_scored=pairs, pairs_rescored=rescored, window_total=int(windows.sum()),
+                     window_mean=float(windows.mean()) if n else 0.0, window_max=int(windows.max()) if n else 0)
+    return table
+
+
+def _rescore(table: ScoreTable, query_peaks: PeakLists, library_peaks: PeakLists, fragment_mass_tolerance: float,
+             cutoffs: Sequence[float]) -> int:
+    """
+    Replaces, in place, the DScores of the pairs that may be below a cutoff
+    by exact ones.
+
+    :return: Number of pairs rescored
+    """
+    ds = table.dscore
+    rows = np.flatnonzero((ds < dscore_cutoff(max(cutoffs)) + ROUNDING) & (table.match >= 0))
+    for k in rows.tolist():
+        ds[k] = _dscore(query_peaks[int(table.query[k])], library_peaks[int(table.match[k])], fragment_mass_tolerance)
+    return len(rows)
+
+
+def _top_k(library: List[Spectrum], table: ScoreTable, top_k: int) -> ScoreTable:
+    """
+    The top_k rows of each query, as msfilter.msfilter() selects them.
+    """
+    qidx, midx, scores = [], [], []
+    bounds = np.flatnonzero(np.diff(table.query)) + 1
+    for rows in np.split(np.arange(len(table.query)), bounds):
+        candidates, ds = table.match[rows], table.dscore[rows]
+        if len(rows) and candidates[0] >= 0:
+            candidates, ds = _best(library, candidates, ds, top_k)
+        qidx.extend([table.query[rows[0]]] * len(candidates))
+        midx.extend(candidates.tolist())
+        scores.extend(ds.tolist())
+    return ScoreTable(np.array(qidx, dtype=np.int64), np.array(midx, dtype=np.int64),
+                      np.array(scores, dtype=np.float64))
@@ -0,0 +1,307 @@
+"""
+Execution plan of a job on one spectra file (run_eagleeye.py --plan).
+
+Before a file is scored, the precursor masses of its queries and of the
+library are counted per charge in histograms; matching the two gives the
+expected number of candidate pairs (library spectra of the same charge
+within the precursor mass tolerance of a query), hence the scoring time,
+and the size of the file gives the memory an in-memory run takes. MGF
+files are planned from a sample of their first spectra and a count of
+their IONS blocks, other inputs once they have been read.
+
+From the estimate the plan picks the number of scoring processes and
+whether to stream the file in batches (eagleeye_cgi.stream_spectra())
+and with what memory budget. The engine is never changed: -e sparse is
+approximate and -e msfilter runs the external binary, so choosing either
+would change the results or the requirements of a job. The plan, its
+estimate and the actual number of candidate pairs are printed and stored
+under `plan` in <name>-stats.json, to tune the constants below.
+"""
+
+import contextlib
+import itertools
+import math
+import multiprocessing
+import os
+from typing import Iterable, NamedTuple, Optional
+
+import numpy as np
+
+import jobstats
+import spectra_io
+import streamfilter
+
+# Scoring time per candidate pair, s (python engine: one process;
+# benchmarks.bench_plan measures them on the machine at hand)
+PAIR_SECONDS = {'python': 45e-6, 'sparse': 20e-6}
+# Scoring time worth another process: below it, forking the workers and
+# merging their tables costs more than it saves
+WORKER_SECONDS = 2.0
+# Memory per score row kept until the table is written (ScoreTable entry
+# and table line)
+ROW_BYTES = 200
+# An in-memory run may take this fraction of the available memory; a
+# larger file is streamed with STREAM_FRACTION of it as its budget
+MEMORY_FRACTION = 0.5
+STREAM_FRACTION = 0.25
+# First spectra of an MGF file whose precursor masses are counted
+SAMPLE_SPECTRA = 5000
+SAMPLE_BYTES = 2**20
+
+
+class MassHistogram:
+    """
+    Precursor masses counted per charge in bins of `width` Da; only bins
+    that hold a spectrum are stored.
+    """
+
+    def __init__(self, precursor_mass: np.ndarray, charge: np.ndarray, width: float, scale: float = 1.0):
+        self.width = width
+        precursor_mass = np.asarray(precursor_mass, dtype=np.float64)
+        charge = np.asarray(charge, dtype=np.int64)
+        keys = np.floor(precursor_mass / width).astype(np.int64)
+        # charge -> (sorted bin numbers, spectra in each, spectra in the bins before)
+        self.bins = {}
+        for c in np.unique(charge).tolist():
+            ids, counts = np.unique(keys[charge == c], return_counts=True)
+            counts = counts * float(scale)
+            self.bins[c] = (ids, counts, np.concatenate(([0.0], np.cumsum(counts))))
+
+    def _below(self, charge: int, mass: np.ndarray) -> np.ndarray:
+        # Spectra of a charge below each mass, spread evenly over their bin
+        ids, counts, cumulative = self.bins[charge]
+        position = mass / self.width
+        k = np.floor(position)
+        j = np.searchsorted(ids, k)
+        inside = ids[np.minimum(j, len(ids) - 1)] == k
+        return cumulative[j] + np.where(inside, counts[np.minimum(j, len(ids) - 1)] * (position - k), 0.0)
+
+    def within(self, charge: int, mass: np.ndarray, tolerance: float) -> np.ndarray:
+        """
+        Expected number of spectra of a charge within tolerance of each mass.
+        """
+        if charge not in self.bins:
+            return np.zeros(len(mass))
+        return self._below(charge, mass + tolerance) - self._below(charge, mass - tolerance)
+
+    def pairs(self, library: 'MassHistogram', tolerance: float) -> float:
+        """
+        Expected number of candidate pairs of these spectra against a library.
+        """
+        total = 0.0
+        for c, (ids, counts, _) in self.bins.items():
+            total += float(np.dot(counts, library.within(c, (ids + 0.5) * self.width, tolerance)))
+        return total
+
+
+class QueryProfile(NamedTuple):
+    """
+    What is known of the queries of a spectra file before it is scored.
+    """
+    spectra: int
+    text_bytes: int
+    # Precursor masses and charges of all queries, or of a sample of them
+    precursor_mass: np.ndarray
+    charge: np.ndarray
+    exact: bool
+    # Read from an MGF file, which stream_spectra() can process
+    mgf: bool
+
+
+def _header_columns(records: Iterable[spectra_io.SpectrumRecord]) -> tuple:
+    masses, charges = [], []
+    for r in records:
+        precursor_mass, charge = r.header.split()
+        masses.append(float(precursor_mass))
+        charges.append(int(float(charge)))
+    return np.array(masses, dtype=np.float64), np.array(charges, dtype=np.int64)
+
+
+def profile_records(records: Iterable[spectra_io.SpectrumRecord], mgf: bool = False) -> QueryProfile:
+    """
+    The profile of queries that have been read.
+    """
+    records = list(records)
+    precursor_mass, charge = _header_columns(records)
+    text_bytes = sum(len(r.header) + len(r.peaks) + len(r.meta or '') for r in records)
+    return QueryProfile(len(records), text_bytes, precursor_mass, charge, True, mgf)
+
+
+def profile_mgf(path: str) -> QueryProfile:
+    """
+    The profile of an MGF file from its first SAMPLE_SPECTRA spectra and the
+    number of its IONS blocks, without reading all of it into memory.
+    """
+    with contextlib.ExitStack() as stack:
+        reader = spectra_io.open_mgf(stack, path, 1, SAMPLE_BYTES)
+        records = iter(reader)
+        sample = list(itertools.islice(records, SAMPLE_SPECTRA))
+        exact = next(records, None) is None
+    if exact:
+        return profile_records(sample, mgf=True)
+    size, blocks = spectra_io.count_mgf(path)
+    precursor_mass, charge = _header_columns(sample)
+    # An IONS block with several charges gives a record per charge
+    titles = len({r.name.rsplit('.', 2)[0] for r in sample})
+    spectra = max(len(sample), round(blocks * len(sample) / max(1, titles)))
+    return QueryProfile(spectra, size, precursor_mass, charge, False, True)
+
+
+def available_memory() -> Optional[int]:
+    """
+    Memory available to a new job, bytes (None when it cannot be told).
+    """
+    try:
+        with open('/proc/meminfo') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _library_histogram(lib: dict, width: float) -> Optional[MassHistogram]:
+    # Built once per library and bin width, for all files of a batch job
+    cached = lib.get('histogram')
+    if cached is not None and cached.width == width:
+        return cached
+    background = lib.get('background')
+    if background is not None:
+        if hasattr(background, 'offsets'):
+            precursor_mass, charge = background.precursor_mass, background.charge
+        else:
+            precursor_mass = [s.precursor_mass for s in background]
+            charge = [s.charge for s in background]
+    elif lib.get('records'):
+        precursor_mass, charge = _header_columns(lib['records'].values())
+    else:
+        # The bundled .dta directory, for the msfilter binary
+        return None
+    histogram = lib['histogram'] = MassHistogram(precursor_mass, charge, width)
+    return histogram
+
+
+class Plan:
+    """
+    How one spectra file is processed, and the estimate behind it.
+    """
+
+    def __init__(self, profile: Optional[QueryProfile], pairs: Optional[float], seconds: Optional[float],
+                 memory: Optional[int], available: Optional[int], workers: int, memory_budget: Optional[float],
+                 stats: jobstats.JobStats):
+        self.profile = profile
+        self.pairs = pairs
+        self.seconds = seconds
+        self.memory = memory
+        self.available = available
+        self.workers = workers
+        # MB; None runs the file in memory
+        self.memory_budget = memory_budget
+        # The 'plan' stage, merged into the statistics of the file
+        self.stats = stats
+
+    def params(self) -> dict:
+        """
+        The job parameters the plan sets.
+        """
+        return {'workers': self.workers, 'memory_budget': self.memory_budget}
+
+    def estimate(self) -> dict:
+        profile = self.profile
+        return {'queries': profile.spectra if profile else None, 'exact': profile.exact if profile else None,
+                'pairs': round(self.pairs) if self.pairs is not None else None,
+                'scoring_s': round(self.seconds, 3) if self.seconds is not None else None,
+                'memory_bytes': self.memory, 'available_bytes': self.available}
+
+    def describe(self) -> str:
+        e = self.estimate()
+        if self.profile is None:
+            estimate = "queries not read yet"
+        else:
+            approx = '' if self.profile.exact else '~'
+            estimate = f"{approx}{e['queries']} queries"
+            if e['pairs'] is not None:
+                estimate += f", ~{e['pairs']} candidate pairs"
+            if e['scoring_s'] is not None:
+                estimate += f" (~{e['scoring_s']:.1f} s scoring)"
+            estimate += f", ~{self.memory / 2**20:.0f} MB in memory"
+            if self.available is not None:
+                estimate += f" of {self.available / 2**20:.0f} MB available"
+        processes = f"{self.workers} process{'es' if self.workers > 1 else ''}"
+        mode = f"streamed, {self.memory_budget:g} MB budget" if self.memory_budget else "in memory"
+        return f"Plan: {estimate}: {processes}, {mode}"
+
+    def report(self, stats: jobstats.JobStats, counters: dict) -> None:
+        """
+        Records the plan with the actual candidate pair count from the
+        scoring counters, and prints both.
+        """
+        actual = counters.get('window_total')
+        stats.count(plan=dict(self.estimate(), workers=self.workers, memory_budget_mb=self.memory_budget,
+                              actual_pairs=actual))
+        if actual is not None and self.pairs is not None:
+            print(f"Candidate pairs: {actual} (estimated {round(self.pairs)})")
+
+
+def plan_job(params: dict, lib: dict, profile: Optional[QueryProfile],
+             stats: jobstats.JobStats = None) -> Plan:
+    """
+    Plans a job on one spectra file from the profile of its queries (None
+    when they cannot be profiled before they are read) and the library
+    from eagleeye_cgi.load_library().
+    """
+    stats = stats or jobstats.JobStats()
+    with stats.stage('plan'):
+        engine = params.get('engine', 'python')
+        request_type = params.get('type')
+        pmt = float(params.get('pmt'))
+        workers = int(params.get('workers', 1))
+        memory_budget = float(params['memory_budget']) if params.get('memory_budget') else None
+        if params.get('plan_memory'):
+            available = int(float(params['plan_memory']) * 2**20)
+        else:
+            available = available_memory()
+        if profile is None:
+            return Plan(None, None, None, None, available, workers, memory_budget, stats)
+
+        # Bins a fraction of the tolerance wide keep the estimate within a few percent
+        width = pmt / 4 if pmt > 0 else 1.0
+        scale = profile.spectra / max(1, len(profile.precursor_mass))
+        queries = MassHistogram(profile.precursor_mass, profile.charge, width, scale)
+        library = queries if request_type == 'Nonred' else _library_histogram(lib, width)
+        pairs = queries.pairs(library, pmt) if library is not None else None
+        seconds = pairs * PAIR_SECONDS[engine] if pairs is not None and engine in PAIR_SECONDS else None
+
+        # Filter jobs keep the best rows of each query, the others every pair
+        best = request_type == 'Filter' and not params.get('all_pairs')
+        rows = profile.spectra * (int(params['top_k']) if params.get('top_k') else 1) if best else (pairs or 0)
+        memory = int(profile.text_bytes * streamfilter.BATCH_OVERHEAD + rows * ROW_BYTES)
+
+        if engine == 'python' and seconds is not None and not params.get('workers'):
+            # Daemon processes (server workers) cannot fork a pool of their own
+            cpus = 1 if multiprocessing.current_process().daemon else os.cpu_count() or 1
+            workers = max(1, min(cpus, math.floor(seconds / WORKER_SECONDS)))
+        streamable = (request_type == 'Filter' and engine in PAIR_SECONDS and not params.get('all_pairs')
+                      and not params.get('score_cache') and profile.mgf)
+        if memory_budget is None and streamable and available and memory > MEMORY_FRACTION * available:
+            # At least 1 MB: a budget of 0 would run the file in memory
+            memory_budget = max(1, round(STREAM_FRACTION * available / 2**20))
+        return Plan(profile, pairs, seconds, memory, available, workers, memory_budget, stats)
+
+
+def plan_file(params: dict, file: str, lib: dict) -> Plan:
+    """
+    Plans a job on one spectra file before it is read: MGF files are
+    profiled from a sample, other inputs are planned by plan_job() once
+    process_spectra() has read them.
+    """
+    stats = jobstats.JobStats()
+    profile = None
+    with stats.stage('plan'):
+        if spectra_io.is_mgf(os.path.basename(file).split(':')[-1]):
+            profile = profile_mgf(file)
+    return plan_job(params, lib, profile, stats)
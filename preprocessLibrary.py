@@ -1,51 +1,30 @@
 # Scaffold created by GitHub Co-pilot
 
-import os
-from glob import glob
+import numpy as np
+
+from libindex import write_dta_files
+from msfilter import SpectrumStore, max_intensities, read_directory
 
 
 def main(library_dir: str, threshold: float) -> None:
     """
-    Preprocess a user-supplied DTA library directory for EagleEye.
+    Preprocess a user-supplied DTA library directory for EagleEye: its .dta
+    files are rewritten with the peaks preprocess_store() keeps.
 
     :param library_dir: Directory containing .dta files to preprocess
     :param threshold: Threshold value for preprocessing
     """
-    dta_files = glob(os.path.join(library_dir, "*.dta"))
-    for f in dta_files:
-        if os.path.isfile(f):
-            numlines = 0
-            maxpeak = 0
-            theline = []
-            peak = []
-            # Read all lines and find max peak
-            with open(f, "r") as fin:
-                for line in fin:
-                    line = line.strip()
-                    theline.append(line)
-                    parts = line.split()
-                    if len(parts) == 2:
-                        one, two = parts
-                        try:
-                            peak_val = float(two)
-                        except ValueError:
-                            peak_val = 0.0
-                    else:
-                        peak_val = 0.0
-                    peak.append(peak_val)
-                    if numlines > 0 and peak_val > maxpeak:
-                        maxpeak = peak_val
-                    numlines += 1
-            # Prepare new file name (add 'm' at the start of the filename)
-            arr21 = f.split(os.sep)
-            arr21[-1] = 'm' + arr21[-1]
-            f1 = os.sep.join(arr21)
-            # Write filtered peaks to the new file
-            with open(f1, "w") as fout:
-                if theline:
-                    print(theline[0], file=fout)
-                for i in range(1, numlines):
-                    if peak[i] > maxpeak * threshold:
-                        print(theline[i], file=fout)
-            # Replace original file with new file
-            os.replace(f1, f)
+    write_dta_files(preprocess_store(read_directory(library_dir), threshold), library_dir)
+
+
+def preprocess_store(store: SpectrumStore, threshold: float) -> SpectrumStore:
+    """
+    Drops the peaks at or below threshold times the highest peak of each
+    spectrum of a whole SpectrumStore at once, with array operations over
+    its peak columns.
+
+    :param store: Library spectra
+    :param threshold: Threshold value for preprocessing
+    """
+    max_intensity = max_intensities(store.offsets, store.intensity)
+    return store.select_peaks(store.intensity > np.repeat(max_intensity * threshold, np.diff(store.offsets)))
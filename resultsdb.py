@@ -0,0 +1,119 @@
+"""
+Results of a Filter job as an indexed SQLite database, next to the
+fixed-width <name>-table.csv, for lookups by spectrum and aggregate
+queries without re-parsing the text table.
+
+    queries (query TEXT PRIMARY KEY, match TEXT, query_mass REAL, match_mass REAL,
+             charge INTEGER, match_charge INTEGER, dscore REAL, pvalue REAL)
+    cutoffs (cutoff REAL PRIMARY KEY)
+    results: view of queries x cutoffs with prediction 'Good' or 'Background'
+    pairs   (query TEXT, match TEXT, query_mass REAL, match_mass REAL,
+             charge INTEGER, match_charge INTEGER, dscore REAL, pvalue REAL)
+
+`queries` holds the best match of each query, the row that decides its
+prediction in the table; `match` and the library columns are NULL when
+no library spectrum was within the precursor mass tolerance. Names are
+URL-decoded as in the table; masses and DScores are those of the score
+table, printed with 6 significant digits as msfilter does. `pairs` holds
+every row of the score table, when asked for (all candidate pairs with
+--all-pairs). For example:
+
+    SELECT * FROM results WHERE query = ?
+    SELECT cutoff, prediction, COUNT(*) FROM results GROUP BY cutoff, prediction
+    SELECT match, COUNT(*) FROM queries WHERE pvalue < 0.05 GROUP BY match
+"""
+
+import os
+import sqlite3
+from typing import Iterable, Iterator, List, Union
+
+import msfilter
+from make_nonredundant import open_table
+from spectra_io import url_decode
+
+RESULTS_EXT = '-results.sqlite'
+
+_COLUMNS = ("query TEXT{}, match TEXT, query_mass REAL, match_mass REAL, charge INTEGER, match_charge INTEGER, "
+            "dscore REAL, pvalue REAL")
+
+_SCHEMA = f"""
+CREATE TABLE queries ({_COLUMNS.format(' PRIMARY KEY')});
+CREATE TABLE cutoffs (cutoff REAL PRIMARY KEY);
+CREATE VIEW results AS
+    SELECT queries.*, cutoff, CASE WHEN pvalue < cutoff THEN 'Background' ELSE 'Good' END AS prediction
+    FROM queries CROSS JOIN cutoffs;
+CREATE TABLE pairs ({_COLUMNS.format('')});
+"""
+
+# Created once the rows are in, which is faster than maintaining them row by row
+_INDEXES = """
+CREATE INDEX queries_match ON queries (match);
+CREATE INDEX queries_pvalue ON queries (pvalue);
+CREATE INDEX pairs_query ON pairs (query);
+CREATE INDEX pairs_match ON pairs (match);
+"""
+
+
+def _rows(table: Union[str, Iterable[str]], first: bool = False) -> Iterator[tuple]:
+    """
+    The rows of a score table in the columns of `queries`.
+
+    :param first: Only the first row of each query
+    """
+    # Names repeat over the rows of a table; decode each once
+    names = {}
+    with open_table(table) as fin:
+        for line in fin:
+            arr = line.split()
+            if len(arr) < 7:
+                continue
+            query = names.get(arr[0])
+            if query is None:
+                query = names[arr[0]] = url_decode(os.path.basename(arr[0]))
+            elif first:
+                continue
+            ds = float(arr[-1])
+            if arr[3] == 'not_found':
+                yield query, None, float(arr[2]), None, int(arr[4]), None, ds, msfilter.pvalue(ds)
+                continue
+            match = names.get(arr[1])
+            if match is None:
+                match = names[arr[1]] = url_decode(os.path.basename(arr[1]))
+            yield query, match, float(arr[2]), float(arr[3]), int(arr[4]), int(arr[5]), ds, msfilter.pvalue(ds)
+
+
+def write_results(path: str, table: Union[str, Iterable[str]], cutoffs: List[float], pairs: bool = False) -> int:
+    """
+    Writes the results database of a Filter job from its sorted score
+    table. The database is built under a temporary name and renamed into
+    place, replacing an existing one.
+
+    :param table: Sorted score table, a file name or the table lines
+    :param cutoffs: p-Value cutoffs of the job
+    :param pairs: Also store every row of the table in `pairs`
+    :return: Number of queries
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        with sqlite3.connect(tmp) as db:
+            db.execute("PRAGMA journal_mode = OFF")
+            db.execute("PRAGMA synchronous = OFF")
+            db.executescript(_SCHEMA)
+            db.executemany("INSERT INTO cutoffs VALUES (?)", [(c,) for c in cutoffs])
+            if pairs:
+                db.executemany("INSERT INTO pairs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", _rows(table))
+                # The first row of a query in the sorted table is its best match
+                db.execute("INSERT OR IGNORE INTO queries SELECT * FROM pairs ORDER BY rowid")
+            else:
+                db.executemany("INSERT INTO queries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", _rows(table, first=True))
+            db.executescript(_INDEXES)
+            count = db.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+        db.close()
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return count
@@ -4,22 +4,79 @@ import argparse
 import tempfile
 import os
 
-from eagleeye_cgi import main as eagleeye_cgi_main
+from eagleeye_cgi import main as eagleeye_cgi_main, parse_cutoffs, read_manifest
+
+
+def cutoff_list(value: str) -> str:
+    try:
+        return ','.join(map(str, parse_cutoffs(value)))
+    except Exception as e:
+        raise argparse.ArgumentTypeError(str(e))
 
 
 def main():
     parser = argparse.ArgumentParser(description="EagleEye CLI frontend")
-    parser.add_argument("data_file", help="Spectra data file(s) (MGF or .dta format)")
+    parser.add_argument("data_file", help="Spectra data file(s) (MGF or .dta format), or @MANIFEST: a file "
+                                          "listing one spectra file per line, optionally followed by its suffix")
     parser.add_argument("library_file", nargs="?", default=None, help="Optional background library (MGF format)")
     parser.add_argument("-s", type=int, help="Preset filtering mode")
     parser.add_argument("-p", type=float, help="Precursor mass tolerance")
     parser.add_argument("-f", type=float, help="Fragment mass tolerance")
-    parser.add_argument("-a", type=float, help="p-value cutoff")
+    parser.add_argument("-a", type=cutoff_list,
+                        help="p-value cutoff, or a comma-separated list: outputs for each, from one scoring run")
     parser.add_argument("-n", action="store_true", help="Create non-redundant background library")
     parser.add_argument("-x", type=str, default="", help="Suffix for output files")
     parser.add_argument("-d", type=str, default="", help="Description/comment")
+    parser.add_argument("-i", "--input", action="append", default=[],
+                        help="Further spectra file to run against the same library load (repeatable)")
+    parser.add_argument("-e", "--engine", choices=("python", "sparse", "msfilter"), default="python",
+                        help="Scoring engine: in-process NumPy port, its approximate sparse-matrix variant or "
+                             "external msfilter binary")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes for the in-process scoring engine (default: 1, or as --plan "
+                             "chooses)")
+    parser.add_argument("--all-pairs", action="store_true",
+                        help="Write every scored candidate pair to <data_file>-pairs.txt")
+    parser.add_argument("--top-k", type=int, default=None,
+                        help="Keep only the K best matches of each query in the --all-pairs table")
+    parser.add_argument("--prune", action="store_true",
+                        help="Filter: stop scoring the candidates of a query once none can beat its best match")
+    parser.add_argument("--dta-output", action="store_true",
+                        help="Write zipped .dta files instead of MGF for MGF input")
+    parser.add_argument("--profile", action="store_true",
+                        help="Also write a cProfile dump of each spectra file to <data_file>-profile.prof")
+    parser.add_argument("--library-cache", type=str, default=None, metavar="DIR",
+                        help="Keep preprocessed user libraries in DIR, keyed by the library file's content")
+    parser.add_argument("--score-cache", type=str, default=None, metavar="DIR",
+                        help="Reuse score tables from DIR when only the p-value cutoff changes")
+    parser.add_argument("--score-cache-size", type=float, default=1024, metavar="MB",
+                        help="Size limit of the score cache; least recently used tables are evicted")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="Filter: read, score and write queries in batches so that their memory stays "
+                             "within about MB, whatever the size of the (MGF) spectra file")
+    parser.add_argument("--results-db", action="store_true",
+                        help="Filter: also write the results as an indexed SQLite database, "
+                             "<data_file>-results.sqlite (with every pair for --all-pairs)")
+    parser.add_argument("--plan", action="store_true",
+                        help="Choose the scoring processes and whether to stream each spectra file (see "
+                             "--memory-budget) from its estimated candidate pairs and memory; an explicit --workers is kept")
+    parser.add_argument("--plan-memory", type=float, default=None, metavar="MB",
+                        help="Memory the planner may use (default: the memory available)")
     args = parser.parse_args()
 
+    # Several inputs are passed to the job as one manifest
+    manifest = None
+    if args.data_file.startswith('@') or args.input:
+        with tempfile.NamedTemporaryFile('w', delete=False, suffix=".manifest") as tmp:
+            if args.data_file.startswith('@'):
+                for file, suffix in read_manifest(args.data_file[1:], args.x):
+                    tmp.write(f"{file} {suffix}\n")
+            else:
+                tmp.write(f"{args.data_file} {args.x}\n")
+            for file in args.input:
+                tmp.write(f"{file} {args.x}\n")
+            manifest = tmp.name
+
     params = {
         "uploaded_spectra": args.data_file,
         "uploaded_background_library": args.library_file,
@@ -30,6 +87,21 @@ def main():
         "description": args.d,
         "prjpath": os.path.dirname(os.path.abspath(__file__)),
         "suffix": args.x,
+        "engine": args.engine,
+        "dta_output": args.dta_output or None,
+        "workers": args.workers,
+        "all_pairs": args.all_pairs or None,
+        "top_k": args.top_k,
+        "prune": args.prune or None,
+        "profile": args.profile or None,
+        "library_cache": os.path.abspath(args.library_cache) if args.library_cache else None,
+        "score_cache": os.path.abspath(args.score_cache) if args.score_cache else None,
+        "score_cache_size": args.score_cache_size if args.score_cache else None,
+        "memory_budget": args.memory_budget,
+        "results_db": args.results_db or None,
+        "plan": args.plan or None,
+        "plan_memory": args.plan_memory,
+        "manifest": manifest,
     }
 
     # Save parameters to a temp file (e.g., as JSON)
@@ -39,10 +111,13 @@ def main():
                 tmp.write(f"{k}={v}\n")
         tmp_name = tmp.name
 
-    eagleeye_cgi_main(qfile=tmp_name)
-
-    # Remove temp file
-    os.remove(tmp_name)
+    try:
+        eagleeye_cgi_main(qfile=tmp_name)
+    finally:
+        # Remove temp files
+        os.remove(tmp_name)
+        if manifest:
+            os.remove(manifest)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+"""
+Persistent cache of score tables, so that re-running a job with another
+p-value cutoff, or with identical inputs, skips the distance calculation.
+
+A score table depends on the query spectra, the library, the tolerances,
+the peak threshold and the engine, but not on the cutoff. Entries are
+keyed by a hash of all of these and stored as files in a directory that
+may be shared by concurrent jobs:
+
+- entries are copied to a temporary file and renamed into place, so a
+  reader never sees a partial table, nor a later rewrite of the source;
+- a reader hard-links (or copies) an entry to its own file before using
+  it, so eviction by another job cannot pull it away;
+- eviction runs under an exclusive lock on the directory and removes
+  least recently used entries until the total size is within the limit.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from typing import Iterable
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from spectra_io import SpectrumRecord
+
+# Bump when the table format or the scoring changes
+CACHE_VERSION = 1
+ENTRY_EXT = '.scores'
+LOCK_FILE = '.lock'
+
+
+def digest_records(records: Iterable[SpectrumRecord]) -> str:
+    """
+    Content hash of spectra records, independent of their order.
+    """
+    h = hashlib.sha256()
+    for r in sorted(records, key=lambda r: r.name):
+        h.update(f"{r.name}\0{r.header}\0".encode())
+        h.update(r.peaks.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ScoreCache:
+    """
+    Directory of score tables with a size limit.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(**fields) -> str:
+        """
+        Cache key of a score table: every setting the table depends on.
+        """
+        fields['version'] = CACHE_VERSION
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ENTRY_EXT)
+
+    def get(self, key: str, dest: str) -> bool:
+        """
+        Copies the table of `key` to dest.
+
+        :return: False if there is no such entry
+        """
+        path = self._path(key)
+        try:
+            if os.path.exists(dest):
+                os.remove(dest)
+            _link_or_copy(path, dest)
+        except FileNotFoundError:
+            return False
+        # Recently used entries are evicted last
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+    def put(self, key: str, src: str) -> None:
+        """
+        Stores the table file src under `key`, then evicts old entries.
+        """
+        tmp = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex}.tmp")
+        try:
+            # Not linked: the caller may write to src again
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes least recently used entries until the cache fits in max_bytes.
+        """
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for e in os.scandir(self.directory):
+                if e.name.endswith(ENTRY_EXT):
+                    try:
+                        st = e.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, e.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
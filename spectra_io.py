@@ -0,0 +1,993 @@
+"""
+In-memory spectrum records and their MGF/DTA readers and writers.
+
+A SpectrumRecord holds exactly what mgf2dta() used to write to disk for
+one spectrum and charge state: the .dta file name, its header and peak
+lines, and the local MGF parameters (.meta file). Records are parsed from
+MGF files or .dta directories and passed straight to the scorer and the
+output writers; .dta files are only written when DTA output is requested.
+"""
+
+import contextlib
+import gzip
+import io
+import itertools
+import locale
+import mmap
+import multiprocessing
+import os
+import re
+import tarfile
+import zipfile
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, TextIO, Tuple, Union
+
+import numpy as np
+
+from msfilter import Spectrum, parse_dta
+
+GLOBALS_META = 'globals.meta'
+# MGF data is parsed in chunks of about this size, by several processes when there are several chunks
+MGF_CHUNK_BYTES = 16 * 2**20
+
+
+class SpectrumRecord:
+    """
+    One spectrum at one charge state, equivalent to a .dta file plus its
+    optional .meta file.
+    """
+    __slots__ = ('name', 'header', 'peaks', 'meta', 'checked', 'arrays')
+
+    def __init__(self, name: str, header: str, peaks: str, meta: str = None, checked: bool = False,
+                 arrays: Tuple[np.ndarray, np.ndarray] = None):
+        self.name = name
+        self.header = header
+        self.peaks = peaks
+        self.meta = meta
+        # Every peak line already passed _is_peak_line() when it was parsed
+        self.checked = checked
+        # (mass, intensity) of the peak lines when the reader already converted them
+        self.arrays = arrays
+
+    @property
+    def meta_name(self) -> str:
+        return self.name[:-4] + '.meta' if self.name.endswith('.dta') else self.name + '.meta'
+
+    def dta(self) -> str:
+        return self.header + self.peaks
+
+    def spectrum(self, scan_id: str = None) -> Spectrum:
+        if self.arrays is not None:
+            precursor_mass, charge = self.header.split()
+            return Spectrum(float(precursor_mass), int(float(charge)), scan_id or self.name, *self.arrays)
+        return parse_dta(self.dta(), scan_id or self.name)
+
+
+def _is_peak_line(line: str) -> bool:
+    return bool(line) and all(
+        x.replace('.', '', 1).replace('E', '', 1).replace('+', '', 1).replace('-', '', 1).isdigit()
+        for x in line.split())
+
+
+# Peak blocks of '<mass> <intensity>' lines with a single space or tab between the two
+_SPACED_PEAKS = re.compile(r'(?:\S+ \S+\n)*')
+_TABBED_PEAKS = re.compile(r'(?:\S+\t\S+\n)*')
+
+
+def url_encode(title: str) -> str:
+    """
+    A TITLE as mgf2dta() puts it in .dta file names.
+    """
+    return ''.join(['%%%02X' % ord(ch) if not ch.isalnum() and ch not in ',._-=' else ch for ch in title])
+
+
+def url_decode(name: str) -> str:
+    """
+    The inverse of url_encode(), for names in score tables and outputs.
+    """
+    return re.sub(r'%([A-Fa-f0-9]{2})', lambda m: chr(int(m.group(1), 16)), name)
+
+
+def _ion_records(t: str, c: str, m: str, peaks: str, meta: str,
+                 arrays: Tuple[np.ndarray, np.ndarray] = None) -> List[SpectrumRecord]:
+    """
+    The records of one IONS block, one per charge state, as mgf2dta() named
+    and wrote them.
+    """
+    if c:
+        cc = [x.replace('+', '').replace('-', '').strip() for x in c.split('and')]
+    else:
+        cc = ['2', '3']
+    records = []
+    for chargevar in cc:
+        dta = t or ''
+        dta = dta.replace('.dta', '').rsplit('.', 1)[0] if '.dta' in dta else dta
+        dta = url_encode(dta)
+        # PEPMASS may carry the precursor intensity after the m/z
+        dtamass = float(m.split()[0]) if m else 0.0
+        dtamass = ((dtamass - 1.007825) * float(chargevar)) + 1.007825
+        records.append(SpectrumRecord(f"{dta}.{chargevar}.dta", f"{dtamass} {chargevar}\n", peaks, meta, True,
+                                      arrays))
+    return records
+
+
+class MgfReader:
+    """
+    Iterates over the spectra of an MGF file as SpectrumRecords, one per
+    charge state, with the same TITLE/CHARGE/PEPMASS global and local
+    semantics as mgf2dta(). Global parameter lines are collected in
+    `globals` as the file is read.
+    """
+
+    def __init__(self, fin: TextIO, name: str = ''):
+        self.fin = fin
+        self.name = name or getattr(fin, 'name', '')
+        self._gbuffer = []
+
+    @property
+    def globals(self) -> str:
+        return ''.join(self._gbuffer)
+
+    @classmethod
+    def open(cls, path: str) -> 'MgfReader':
+        return cls(open(path, 'r'), os.path.basename(path))
+
+    def __iter__(self) -> Iterator[SpectrumRecord]:
+        gtitle = gcharge = gpepmass = ''
+        title = charge = pepmass = ''
+        t = c = m = None
+        sbuffer = []
+        gbuffer = self._gbuffer
+        lbuffer = []
+        globals_flag = True
+        locals_flag = False
+        for line in self.fin:
+            line = line.rstrip('\r\n')
+            if line.startswith('TITLE='):
+                if globals_flag:
+                    gtitle = line[6:]
+                elif locals_flag:
+                    title = line[6:]
+            elif line.startswith('CHARGE='):
+                if globals_flag:
+                    gcharge = line[7:]
+                elif locals_flag:
+                    charge = line[7:]
+            elif line.startswith('PEPMASS='):
+                if globals_flag:
+                    gpepmass = line[8:]
+                elif locals_flag:
+                    pepmass = line[8:]
+            elif line.startswith('BEGIN IONS'):
+                globals_flag = False
+                locals_flag = True
+                continue
+            elif line.startswith('END IONS'):
+                yield from _ion_records(t, c, m, ''.join(sbuffer), ''.join(lbuffer) or None)
+                # Reset for next ion
+                title = charge = pepmass = t = c = m = None
+                sbuffer = []
+                lbuffer = []
+                globals_flag = True
+                locals_flag = False
+                continue
+            elif _is_peak_line(line):
+                if globals_flag:
+                    raise Exception(f"Illegal global parameter in file: {self.name}")
+                if locals_flag:
+                    t = title or gtitle
+                    c = charge or gcharge
+                    m = pepmass or gpepmass
+                    if not t or not c or not m:
+                        raise Exception("Missing precursor info in mgf2dta")
+                    locals_flag = False
+                sbuffer.append(line + '\n')
+            if globals_flag:
+                gbuffer.append(line + '\n')
+            elif locals_flag:
+                lbuffer.append(line + '\n')
+
+
+# Bytes that can occur in a peak block: _is_peak_line() characters and line breaks
+_PEAK_BYTES = np.ones(256, dtype=bool)
+_PEAK_BYTES[np.frombuffer(b'0123456789.E+- \t\n', dtype=np.uint8)] = False
+_POW10 = 10.0 ** np.arange(23)
+# The bulk peak block checks take a few tens of bytes of temporary arrays per character
+_BULK_CHARS = 2**20
+
+
+def _bulk_ranges(blocks: List[str]) -> Iterator[Tuple[int, int]]:
+    """
+    Consecutive ranges of peak blocks of about _BULK_CHARS characters in
+    total, checked and converted together.
+    """
+    lo, size = 0, 0
+    for k, b in enumerate(blocks):
+        size += len(b)
+        if size >= _BULK_CHARS:
+            yield lo, k + 1
+            lo, size = k + 1, 0
+    if lo < len(blocks):
+        yield lo, len(blocks)
+
+
+def _token_starts(a: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Byte-level tokenization of '\\n'-terminated ASCII lines.
+
+    :return: (token start flags, token number of every byte)
+    """
+    sep = a <= 32
+    prev = np.empty_like(sep)
+    prev[:1] = True
+    prev[1:] = sep[:-1]
+    start = ~sep & prev
+    return start, np.cumsum(start, dtype=np.int32) - 1
+
+
+def _check_peak_blocks(blocks: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    _is_peak_line() of every line of many peak blocks at once.
+
+    :param blocks: Blocks of '\\n'-terminated lines
+    :return: (whether all lines of a block are peak lines, and whether they
+        all hold two tokens); blocks with non-ASCII text are reported
+        invalid and are left to _is_peak_line()
+    """
+    valid = np.array([b.isascii() for b in blocks], dtype=bool)
+    paired = np.zeros(len(blocks), dtype=bool)
+    idx = np.flatnonzero(valid)
+    if not len(idx):
+        return valid, paired
+    offsets = np.cumsum([0] + [len(blocks[i]) for i in idx.tolist()])
+    a = np.frombuffer(''.join(blocks[i] for i in idx.tolist()).encode('ascii'), dtype=np.uint8)
+    bad = _PEAK_BYTES[a]
+    start, token = _token_starts(a)
+    # Each of '.', 'E', '+' and '-' at most once per token
+    for ch in b'.E+-':
+        pos = np.flatnonzero(a == ch)
+        bad[pos[1:][token[pos[1:]] == token[pos[:-1]]]] = True
+    # At least one digit per token
+    starts = np.flatnonzero(start)
+    digits = (a >= 48) & (a <= 57)
+    bad[starts[np.bincount(token[digits], minlength=len(starts)) == 0]] = True
+    # Empty lines are not peak lines
+    newline = a == 10
+    bad[1:] |= newline[1:] & newline[:-1]
+    bad[:1] |= newline[:1]
+    # Lines of two tokens
+    line = np.cumsum(newline, dtype=np.int32) - newline
+    ends = np.flatnonzero(newline)
+    odd = ends[np.bincount(line[starts], minlength=len(ends)) != 2]
+
+    valid[idx[np.unique(np.searchsorted(offsets, np.flatnonzero(bad), side='right') - 1)]] = False
+    paired[idx] = True
+    paired[idx[np.unique(np.searchsorted(offsets, odd, side='right') - 1)]] = False
+    return valid, paired & valid
+
+
+def _decimal_values(text: str) -> np.ndarray:
+    """
+    float() of every token of validated peak lines made of digits and at
+    most one '.' each, as mantissa / 10**decimals: both are exact doubles
+    for up to 15 digits, so the quotient is the correctly rounded value, as
+    float() returns.
+
+    :return: None if a token has more than 15 digits
+    """
+    a = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    start, token = _token_starts(a)
+    ntok = int(start.sum())
+    dpos = np.flatnonzero((a >= 48) & (a <= 57))
+    dtok = token[dpos]
+    ndigits = np.bincount(dtok, minlength=ntok)
+    if ntok and ndigits.max() > 15:
+        return None
+    first = np.searchsorted(dtok, np.arange(ntok))
+    exponent = ndigits[dtok] - 1 - (np.arange(len(dpos)) - first[dtok])
+    mantissa = np.bincount(dtok, weights=(a[dpos] - 48) * _POW10[exponent], minlength=ntok)
+    decimals = np.zeros(ntok, dtype=np.int64)
+    ppos = np.flatnonzero(a == 46)
+    if len(ppos):
+        ptok = token[ppos]
+        decimals[ptok] = ndigits[ptok] - (np.searchsorted(dpos, ppos) - first[ptok])
+    return mantissa / _POW10[decimals]
+
+
+def _peak_arrays(blocks: List[str]) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    (mass, intensity) of validated two-token peak blocks, as parse_dta()
+    reads them, or None where it would stop at a token float() rejects.
+    """
+    arrays = [None] * len(blocks)
+    plain = [k for k, b in enumerate(blocks) if 'E' not in b and '+' not in b and '-' not in b]
+    values = _decimal_values(''.join(blocks[k] for k in plain)) if plain else None
+    if values is None:
+        plain = []
+    lo = 0
+    for k in plain:
+        hi = lo + 2 * blocks[k].count('\n')
+        pairs = values[lo:hi].reshape(-1, 2)
+        arrays[k] = (pairs[:, 0], pairs[:, 1])
+        lo = hi
+    for k in (k for k, a in enumerate(arrays) if a is None):
+        try:
+            pairs = np.fromiter(map(float, blocks[k].split()), dtype=np.float64).reshape(-1, 2)
+        except ValueError:
+            continue
+        arrays[k] = (pairs[:, 0], pairs[:, 1])
+    return arrays
+
+
+class _PendingIon(NamedTuple):
+    """
+    An IONS block whose TITLE, CHARGE or PEPMASS (None) is a global value
+    set before its chunk.
+    """
+    title: str
+    charge: str
+    pepmass: str
+    peaks: str
+    meta: str
+    arrays: tuple
+
+
+class _PendingCheck(NamedTuple):
+    """
+    The precursor check of a peak line that is not that of a complete IONS
+    block (an unclosed one, or before a nested BEGIN IONS line), with a
+    TITLE, CHARGE or PEPMASS (None) set before its chunk.
+    """
+    title: str
+    charge: str
+    pepmass: str
+
+
+def _chunk_text(data: Union[bytes, tuple]) -> str:
+    if isinstance(data, tuple):
+        path, start, end = data
+        with open(path, 'rb') as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[start:end]
+    # Decoded and with line breaks translated as a text mode file would be
+    text = bytes(data).decode(locale.getpreferredencoding(False))
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+def _parse_mgf_chunk(job: tuple) -> tuple:
+    """
+    Parses one chunk of an MGF file with the state machine of MgfReader,
+    starting at a BEGIN IONS line that follows a complete IONS block (or at
+    the start of the file). Peak blocks are taken up to their END IONS line
+    at once and checked with _is_peak_line() semantics in bulk.
+
+    :param job: (bytes or (path, start, end), file name)
+    :return: (records, _PendingIons and _PendingChecks in file order, then
+        the exception MgfReader raises in the chunk if any, global parameter
+        lines, last global (TITLE, CHARGE, PEPMASS) set in the chunk or None)
+    """
+    data, name = job
+    text = _chunk_text(data)
+    # [t, c, m, peak lines checked one by one, block checked in bulk, meta]; t, c and m are
+    # None before the first peak line
+    ions = []
+    # (number of ions before it, _PendingCheck)
+    checks = []
+    gbuffer = []
+    # None: as set before this chunk
+    gtitle = gcharge = gpepmass = None
+    title = charge = pepmass = ''
+    t = c = m = None
+    sbuffer = []
+    block = ''
+    lbuffer = []
+    globals_flag = True
+    locals_flag = False
+    # The peak lines of this IONS block are read one by one
+    linewise = False
+    # Raised once the items before it are merged: a pending check may fail first
+    error = None
+    pos, n = 0, len(text)
+    while pos < n:
+        if not globals_flag and not locals_flag and not block and not linewise:
+            # Peak lines up to END IONS; a BEGIN IONS line among them is left to the line loop
+            end = text.find('\nEND IONS', pos - 1)
+            if end >= pos and text.find('\nBEGIN IONS', pos - 1, end + 1) < 0:
+                block = text[pos:end + 1]
+                pos = end + 1
+                continue
+            linewise = True
+        nl = text.find('\n', pos)
+        if nl < 0:
+            nl = n
+        line = text[pos:nl]
+        pos = nl + 1
+        if line.startswith('TITLE='):
+            if globals_flag:
+                gtitle = line[6:]
+            elif locals_flag:
+                title = line[6:]
+        elif line.startswith('CHARGE='):
+            if globals_flag:
+                gcharge = line[7:]
+            elif locals_flag:
+                charge = line[7:]
+        elif line.startswith('PEPMASS='):
+            if globals_flag:
+                gpepmass = line[8:]
+            elif locals_flag:
+                pepmass = line[8:]
+        elif line.startswith('BEGIN IONS'):
+            globals_flag = False
+            locals_flag = True
+            continue
+        elif line.startswith('END IONS'):
+            ions.append([t, c, m, ''.join(sbuffer), block, ''.join(lbuffer) or None])
+            title = charge = pepmass = t = c = m = None
+            sbuffer = []
+            block = ''
+            lbuffer = []
+            globals_flag = True
+            locals_flag = False
+            linewise = False
+            continue
+        elif _is_peak_line(line):
+            if globals_flag:
+                error = Exception(f"Illegal global parameter in file: {name}")
+                break
+            if locals_flag:
+                if sbuffer and None in (t, c, m):
+                    # A nested IONS block replaces the values of this check
+                    checks.append((len(ions), _PendingCheck(t, c, m)))
+                t = title or gtitle
+                c = charge or gcharge
+                m = pepmass or gpepmass
+                if any(x is not None and not x for x in (t, c, m)):
+                    error = Exception("Missing precursor info in mgf2dta")
+                    break
+                locals_flag = False
+            sbuffer.append(line + '\n')
+        if globals_flag:
+            gbuffer.append(line + '\n')
+        elif locals_flag:
+            lbuffer.append(line + '\n')
+
+    if sbuffer and None in (t, c, m) and error is None:
+        # An IONS block without END IONS yields nothing, but its check still applies
+        checks.append((len(ions), _PendingCheck(t, c, m)))
+
+    peaks = [ion[3] + ion[4] for ion in ions]
+    arrays = [None] * len(ions)
+    for lo, hi in _bulk_ranges(peaks):
+        valid, paired = _check_peak_blocks(peaks[lo:hi])
+        # Peak blocks with a line that is not a peak line are filtered line by line
+        for k in (lo + np.flatnonzero(~valid)).tolist():
+            ion = ions[k]
+            peaks[k] = ion[3] + ''.join(line + '\n' for line in ion[4].split('\n')[:-1] if _is_peak_line(line))
+        paired = (lo + np.flatnonzero(paired)).tolist()
+        for k, a in zip(paired, _peak_arrays([peaks[k] for k in paired])):
+            arrays[k] = a
+    items = []
+    checks.reverse()
+    for k, ((t, c, m, head, _, meta), p, a) in enumerate(zip(ions, peaks, arrays)):
+        while checks and checks[-1][0] == k:
+            items.append(checks.pop()[1])
+        # An IONS block with peak lines but a precursor parameter from before the chunk
+        if head and None in (t, c, m):
+            items.append(_PendingIon(t, c, m, p, meta, a))
+        else:
+            items.extend(_ion_records(t, c, m, p, meta, a))
+    items.extend(check for _, check in reversed(checks))
+    if error is not None:
+        items.append(error)
+    return items, ''.join(gbuffer), (gtitle, gcharge, gpepmass)
+
+
+def _chunk_boundary(data, start: int, target: int, end: int) -> int:
+    """
+    Offset of the first BEGIN IONS line at or after target whose preceding
+    IONS block has its END IONS line, so that parsing can restart there.
+
+    :param data: bytes, bytearray or mmap
+    :return: -1 if there is none before end
+    """
+    pos = max(target, start + 1)
+    while True:
+        b = data.find(b'\nBEGIN IONS', pos - 1, end)
+        if b < 0:
+            return -1
+        b += 1
+        lo = max(start - 1, 0)
+        if data.rfind(b'\nEND IONS', lo, b) > data.rfind(b'\nBEGIN IONS', lo, b - 1):
+            return b
+        pos = b + 1
+
+
+def _file_chunks(path: str, name: str, chunk_bytes: int) -> Iterator[tuple]:
+    size = os.path.getsize(path)
+    if not size:
+        return
+    with open(path, 'rb') as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            b = _chunk_boundary(mm, start, start + chunk_bytes, size) if size - start > chunk_bytes else -1
+            end = size if b < 0 else b
+            yield (path, start, end), name
+            start = end
+
+
+def _stream_chunks(fileobj: BinaryIO, name: str, chunk_bytes: int) -> Iterator[tuple]:
+    buffer = bytearray()
+    while True:
+        data = fileobj.read(chunk_bytes)
+        if not data:
+            break
+        buffer += data
+        if len(buffer) > chunk_bytes:
+            b = _chunk_boundary(buffer, 0, chunk_bytes, len(buffer))
+            if b > 0:
+                yield bytes(buffer[:b]), name
+                del buffer[:b]
+    if buffer:
+        yield bytes(buffer), name
+
+
+class ChunkedMgfReader:
+    """
+    Iterates over the records of an MGF file in file order, parsed in
+    chunks by up to `workers` processes, with at most two chunks per
+    process in memory at a time. Global TITLE, CHARGE and PEPMASS of each
+    chunk are resolved from the chunks before it; global parameter lines
+    are collected in `globals` as the file is read.
+    """
+
+    def __init__(self, jobs: Iterable[tuple], workers: int = None):
+        self.jobs = jobs
+        self.workers = workers or os.cpu_count() or 1
+        self._gbuffer = []
+
+    @property
+    def globals(self) -> str:
+        return ''.join(self._gbuffer)
+
+    def __iter__(self) -> Iterator[SpectrumRecord]:
+        jobs = iter(self.jobs)
+        window = 2 * self.workers if self.workers > 1 and not multiprocessing.current_process().daemon else 1
+        state = ('', '', '')
+        with contextlib.ExitStack() as stack:
+            pool = None
+            while True:
+                group = list(itertools.islice(jobs, window))
+                if not group:
+                    break
+                if pool is None and len(group) > 1:
+                    methods = multiprocessing.get_all_start_methods()
+                    ctx = multiprocessing.get_context('fork' if 'fork' in methods else None)
+                    pool = stack.enter_context(ctx.Pool(self.workers))
+                results = pool.imap(_parse_mgf_chunk, group) if pool is not None else map(_parse_mgf_chunk, group)
+                for items, gtext, final in results:
+                    for item in items:
+                        if isinstance(item, Exception):
+                            raise item
+                        if isinstance(item, (_PendingIon, _PendingCheck)):
+                            t, c, m = (x if x is not None else g for x, g in zip(item[:3], state))
+                            if not t or not c or not m:
+                                raise Exception("Missing precursor info in mgf2dta")
+                            if isinstance(item, _PendingIon):
+                                yield from _ion_records(t, c, m, item.peaks, item.meta, item.arrays)
+                        else:
+                            yield item
+                    self._gbuffer.append(gtext)
+                    state = tuple(x if x is not None else g for x, g in zip(final, state))
+
+
+def read_mgf(path: str, workers: int = None) -> Tuple[List[SpectrumRecord], str]:
+    """
+    Reads all records of an MGF file, memory-mapped and split into chunks
+    at BEGIN IONS lines that are parsed in parallel. The records are those
+    of MgfReader, in file order.
+
+    :param workers: Parser processes (default: one per CPU)
+    :return: (records, global parameters block)
+    """
+    reader = ChunkedMgfReader(_file_chunks(path, os.path.basename(path), MGF_CHUNK_BYTES), workers)
+    return list(reader), reader.globals
+
+
+def _dta_records(names: Iterable[str], open_text: Callable[[str], TextIO]) -> Tuple[List[SpectrumRecord], str]:
+    """
+    Records of the .dta files among `names`, with their .meta files and
+    globals.meta, each opened by open_text().
+    """
+    names = set(names)
+    records = []
+    for name in sorted(names):
+        if len(name) < 4 or name[-4:].lower() != '.dta':
+            continue
+        with open_text(name) as fin:
+            header = fin.readline()
+            peaks = fin.read()
+        record = SpectrumRecord(name, header, peaks)
+        if record.meta_name in names:
+            with open_text(record.meta_name) as fin:
+                record.meta = fin.read()
+        records.append(record)
+    globals_meta = ''
+    if GLOBALS_META in names:
+        with open_text(GLOBALS_META) as fin:
+            globals_meta = fin.read()
+    return records, globals_meta
+
+
+def read_dta_records(directory: str) -> Tuple[List[SpectrumRecord], str]:
+    """
+    Reads a directory of .dta files, with their .meta files and
+    globals.meta, as records.
+
+    :return: (records, global parameters block)
+    """
+    names = [e.name for e in os.scandir(directory) if e.is_file()]
+    return _dta_records(names, lambda name: open(os.path.join(directory, name), 'r'))
+
+
+def _basename(name: str) -> str:
+    return name.rstrip('/').rsplit('/', 1)[-1]
+
+
+def _is_archive(name: str, exts: Tuple[str, ...]) -> bool:
+    return name.lower().endswith(exts)
+
+
+def _archive_files(fileobj: BinaryIO, name: str) -> Iterator[Tuple[str, Callable[[], BinaryIO]]]:
+    """
+    The regular files of a .zip or .tar(.gz) archive, in archive order, as
+    (base name, opener) pairs. Paths inside the archive are dropped, as
+    'unzip -j' and the tar path transform did.
+    """
+    if _is_archive(name, ('.zip',)):
+        with zipfile.ZipFile(fileobj) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield _basename(info.filename), lambda info=info: zf.open(info)
+    elif _is_archive(name, ('.tar', '.tar.gz', '.tgz')):
+        # Streamed: members are read in order, without seeking back
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+            for info in tf:
+                if info.isfile():
+                    yield _basename(info.name), lambda info=info: tf.extractfile(info)
+    else:
+        raise Exception(f"Unsupported archive type: {name}")
+
+
+def read_dta_archive(fileobj: BinaryIO, name: str) -> Tuple[List[SpectrumRecord], str]:
+    """
+    Reads the .dta, .meta and globals.meta files of a .zip or .tar(.gz)
+    archive as records, without extracting it. As when extracting with
+    paths dropped, a later file replaces an earlier one of the same name.
+
+    :param name: Archive file name, for its type
+    :return: (records, global parameters block)
+    """
+    files = {}
+    for base, opener in _archive_files(fileobj, name):
+        if base == GLOBALS_META or base[-4:].lower() == '.dta' or base.endswith('.meta'):
+            with opener() as fin:
+                files[base] = fin.read()
+    return _dta_records(files, lambda base: io.TextIOWrapper(io.BytesIO(files[base])))
+
+
+def _zip_member(zf: zipfile.ZipFile, member: str) -> zipfile.ZipInfo:
+    found = [info for info in zf.infolist() if not info.is_dir() and _basename(info.filename) == member]
+    return found[-1] if found else None
+
+
+def archive_member(stack: contextlib.ExitStack, archive: str, member: str) -> BinaryIO:
+    """
+    Opens a member of a .zip or .tar(.gz) archive by its base name, at any
+    depth in the archive; the last one wins if the name occurs more than once.
+    The archive stays open until `stack` is closed.
+    """
+    fileobj = stack.enter_context(open(archive, 'rb'))
+    if _is_archive(archive, ('.zip',)):
+        zf = stack.enter_context(zipfile.ZipFile(fileobj))
+        info = _zip_member(zf, member)
+        if info is not None:
+            return stack.enter_context(zf.open(info))
+    elif _is_archive(archive, ('.tar', '.tar.gz', '.tgz')):
+        tf = stack.enter_context(tarfile.open(fileobj=fileobj, mode='r:*'))
+        found = [info for info in tf.getmembers() if info.isfile() and _basename(info.name) == member]
+        if found:
+            return stack.enter_context(tf.extractfile(found[-1]))
+    else:
+        raise Exception(f"Unsupported archive type: {archive}")
+    raise Exception(f"Failed to extract file '{member}' from archive: {archive}")
+
+
+def read_mgf_stream(fileobj: BinaryIO, name: str, workers: int = None) -> Tuple[List[SpectrumRecord], str]:
+    """
+    Reads all records of an MGF file from a binary stream, e.g. a gzip or
+    archive member stream, in chunks as read_mgf() does.
+
+    :return: (records, global parameters block)
+    """
+    reader = ChunkedMgfReader(_stream_chunks(fileobj, name, MGF_CHUNK_BYTES), workers)
+    return list(reader), reader.globals
+
+
+def is_mgf(name: str) -> bool:
+    """
+    Whether a spectra file name (or archive member) is read as MGF.
+    """
+    return name.lower().endswith(('.mgf', '.mgf.gz', '.mgf.zip'))
+
+
+def _mgf_source(stack: contextlib.ExitStack, path: str) -> Tuple[Optional[BinaryIO], str]:
+    """
+    The decompressed byte stream of an MGF file as read_spectra() accepts
+    it and the name of the MGF file; no stream for a plain .mgf file.
+    """
+    directory, spectra = os.path.split(path)
+    member = ':' in spectra
+    if member:
+        archive, spectra = spectra.split(':', 1)
+    if not is_mgf(spectra):
+        raise Exception(f"Not an MGF file: {spectra}")
+    lower = spectra.lower()
+    if lower.endswith('.mgf') and not member:
+        return None, spectra
+    if member:
+        fileobj = archive_member(stack, os.path.join(directory, archive), spectra)
+    else:
+        fileobj = stack.enter_context(open(path, 'rb'))
+    if lower.endswith('.mgf.gz'):
+        fileobj, spectra = stack.enter_context(gzip.GzipFile(fileobj=fileobj)), spectra[:-3]
+    elif lower.endswith('.mgf.zip'):
+        mgfile = spectra[:-4]
+        zf = stack.enter_context(zipfile.ZipFile(fileobj))
+        info = _zip_member(zf, mgfile)
+        if info is None:
+            raise Exception(f"Failed to extract file '{mgfile}' from archive: {spectra}")
+        fileobj, spectra = stack.enter_context(zf.open(info)), mgfile
+    return fileobj, spectra
+
+
+def open_mgf(stack: contextlib.ExitStack, path: str, workers: int = None,
+             chunk_bytes: int = None) -> ChunkedMgfReader:
+    """
+    Opens an MGF spectra file as read_spectra() accepts it (.mgf, .mgf.gz,
+    .mgf.zip, or `archive:member` of one of those) for reading record by
+    record, decompressed as it is parsed. The file stays open until
+    `stack` is closed.
+
+    :param chunk_bytes: Size of the parsed chunks (default: MGF_CHUNK_BYTES)
+    """
+    chunk_bytes = chunk_bytes or MGF_CHUNK_BYTES
+    fileobj, spectra = _mgf_source(stack, path)
+    if fileobj is None:
+        # A plain file is memory-mapped
+        return ChunkedMgfReader(_file_chunks(path, spectra, chunk_bytes), workers)
+    return ChunkedMgfReader(_stream_chunks(fileobj, spectra, chunk_bytes), workers)
+
+
+def count_mgf(path: str) -> Tuple[int, int]:
+    """
+    Size and number of IONS blocks of an MGF file that open_mgf() accepts,
+    read as bytes (decompressed if need be) without parsing it.
+
+    :return: (bytes, BEGIN IONS lines)
+    """
+    with contextlib.ExitStack() as stack:
+        fileobj, _ = _mgf_source(stack, path)
+        if fileobj is None:
+            fileobj = stack.enter_context(open(path, 'rb'))
+        size = blocks = 0
+        tail = b''
+        while True:
+            data = fileobj.read(MGF_CHUNK_BYTES)
+            if not data:
+                return size, blocks
+            size += len(data)
+            # A line split between two reads is found in the bytes around the boundary
+            data = tail + data
+            blocks += data.count(b'BEGIN IONS')
+            tail = data[-9:]
+
+
+def read_spectra(path: str) -> Tuple[List[SpectrumRecord], str, bool]:
+    """
+    Reads an uploaded spectra file: MGF (.mgf, .mgf.gz, .mgf.zip) or .dta
+    files archived as .zip or .tar.gz/.tgz. `archive:member` selects one
+    file of a .zip or .tar(.gz) archive. Compressed data is decompressed as
+    it is parsed, never to disk.
+
+    :return: (records, global parameters block, whether the input is MGF)
+    """
+    directory, spectra = os.path.split(path)
+    with contextlib.ExitStack() as stack:
+        member = ':' in spectra
+        if member:
+            archive, spectra = spectra.split(':', 1)
+        if is_mgf(spectra):
+            reader = open_mgf(stack, path)
+            return list(reader), reader.globals, True
+        if member:
+            fileobj = archive_member(stack, os.path.join(directory, archive), spectra)
+        else:
+            fileobj = stack.enter_context(open(path, 'rb'))
+        if spectra.lower().endswith(('.tar.gz', '.tgz', '.zip')):
+            return (*read_dta_archive(fileobj, spectra), False)
+        else:
+            raise Exception(f"Unsupported file type uploaded: {spectra}")
+
+
+def read_library(path: str) -> List[SpectrumRecord]:
+    """
+    Reads a user-supplied library: MGF (.mgf, .mgf.gz, or a .zip holding a
+    single .mgf file) or .dta files archived as <name>.dta.zip/.tar/.tgz.
+    """
+    libname, libext = os.path.splitext(os.path.basename(path))
+    libext = libext.lower()
+    with open(path, 'rb') as fileobj:
+        if libname.lower().endswith('.dta'):
+            if not libext:
+                raise Exception(f"Library in DTA format should be archived: {path}")
+            if libext not in ('.tar', '.tar.gz', '.tgz', '.zip'):
+                raise Exception(f"Unsupported library archive format: {path}")
+            return read_dta_archive(fileobj, path)[0]
+        if not libext:
+            if not libname.lower().endswith('.mgf'):
+                raise Exception(f"Unspecified or unsupported library format: {path}")
+            return read_mgf_stream(fileobj, libname)[0]
+        elif libext == '.zip':
+            with zipfile.ZipFile(fileobj) as zf:
+                members = [info for info in zf.infolist() if not info.is_dir() and info.file_size > 0]
+                if not members:
+                    raise Exception(f"No files found in library archive: {path}")
+                if len(members) > 1:
+                    raise Exception(f"Multiple files found in library archive: {path}")
+                mgfile = _basename(members[0].filename)
+                if not mgfile.lower().endswith('.mgf'):
+                    raise Exception(f"Unspecified or unsupported library format: {path}:{mgfile}")
+                with zf.open(members[0]) as fin:
+                    return read_mgf_stream(fin, mgfile)[0]
+        elif libext == '.gz':
+            if not libname.lower().endswith('.mgf'):
+                raise Exception(f"Unspecified or unsupported library format: {path}")
+            with gzip.GzipFile(fileobj=fileobj) as fin:
+                return read_mgf_stream(fin, libname)[0]
+        else:
+            raise Exception(f"Unsupported library archive format: {path}")
+
+
+def by_name(records: Iterable[SpectrumRecord]) -> Dict[str, SpectrumRecord]:
+    """
+    Records keyed by .dta file name. As with files in a directory, a later
+    record replaces an earlier one of the same name.
+    """
+    return {r.name: r for r in records}
+
+
+def write_dta_directory(records: Iterable[SpectrumRecord], globals_meta: str, dtapath: str) -> None:
+    """
+    Writes records as .dta/.meta files, as mgf2dta() does.
+    """
+    os.makedirs(dtapath, exist_ok=True)
+    for r in records:
+        with open(os.path.join(dtapath, r.name), 'w') as fout:
+            fout.write(r.dta())
+        if r.meta:
+            with open(os.path.join(dtapath, r.meta_name), 'w') as fout:
+                fout.write(r.meta)
+    if globals_meta:
+        with open(os.path.join(dtapath, GLOBALS_META), 'w') as fout:
+            fout.write(globals_meta)
+
+
+def write_dta_zip(records: Iterable[SpectrumRecord], globals_meta: str, zipname: str,
+                  presorted: bool = False) -> None:
+    """
+    Writes records as .dta/.meta members of a ZIP archive, in file name
+    order.
+
+    :param presorted: The records are unique and already in file name
+        order, and are written as they come instead of being collected first
+    """
+    if not presorted:
+        records = sorted(by_name(records).values(), key=lambda r: r.name)
+    with zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for r in records:
+            zf.writestr(r.name, r.dta())
+            if r.meta:
+                zf.writestr(r.meta_name, r.meta)
+        if globals_meta:
+            zf.writestr(GLOBALS_META, globals_meta)
+
+
+def _mgf_peaks(r: SpectrumRecord) -> str:
+    """
+    The peak lines of a record as written to MGF: mass and intensity
+    separated by a tab.
+    """
+    if r.checked:
+        # Already validated by the reader, at most the separator changes
+        if _SPACED_PEAKS.fullmatch(r.peaks):
+            return r.peaks.replace(' ', '\t')
+        if _TABBED_PEAKS.fullmatch(r.peaks):
+            return r.peaks
+    lines = []
+    for line in r.peaks.splitlines():
+        line = line.strip()
+        if _is_peak_line(line):
+            one, two = line.split()
+            lines.append(f"{one}\t{two}\n")
+        else:
+            raise Exception(f"Invalid data format in file {r.name}: {line}")
+    return ''.join(lines)
+
+
+def _ions(r: SpectrumRecord) -> str:
+    """
+    One IONS block, as dta2mgf() wrote it for a .dta file.
+    """
+    header = r.header.strip()
+    if not header:
+        return ''
+    MH, Z = header.split()
+    MH = float(MH)
+    Z = int(Z)
+    block = ["BEGIN IONS\n"]
+    MoverZ = (MH + (Z - 1) * 1.007825) / Z
+    title = url_decode(r.name)
+    intensity = None
+    extras = ''
+    if r.meta is not None:
+        for line in r.meta.splitlines(keepends=True):
+            if line.strip().startswith('TITLE='):
+                block.append(f"TITLE={title}\n")
+                title = ''
+            elif line.strip().startswith('CHARGE='):
+                block.append(f"CHARGE={Z}+\n")
+                Z = ''
+            elif line.strip().startswith('PEPMASS='):
+                parts = line.strip().split('=')
+                if len(parts) > 1:
+                    vals = parts[1].split()
+                    if len(vals) > 1:
+                        intensity = vals[1]
+                if intensity:
+                    block.append(f"PEPMASS={MoverZ} {intensity}\n")
+                else:
+                    block.append(f"PEPMASS={MoverZ}\n")
+                MoverZ = ''
+            else:
+                extras += line
+    if title:
+        block.append(f"TITLE={title}\n")
+    if Z:
+        block.append(f"CHARGE={Z}+\n")
+    if MoverZ != '':
+        block.append(f"PEPMASS={MoverZ}\n")
+    if extras:
+        block.append(extras)
+    block.append(_mgf_peaks(r))
+    block.append("END IONS\n\n")
+    return ''.join(block)
+
+
+def write_mgf(records: Iterable[SpectrumRecord], globals_meta: str, mgfname: str, presorted: bool = False) -> None:
+    """
+    Writes records as an MGF file, one IONS block per record in file name
+    order, with the same normalization of TITLE/CHARGE/PEPMASS as dta2mgf().
+
+    :param presorted: As for write_dta_zip()
+    """
+    if not presorted:
+        records = sorted(by_name(records).values(), key=lambda r: r.name)
+    with open(mgfname, 'w') as fout:
+        if globals_meta:
+            fout.write(globals_meta)
+        for r in records:
+            # dta2mgf() globbed '*.dta', which skips hidden files
+            if r.name.startswith('.') or not r.name.endswith('.dta'):
+                continue
+            fout.write(_ions(r))
@@ -5,6 +5,9 @@
 #include <dirent.h>
 #include <stdlib.h>
 #include <cstring>
+#include <algorithm>
+#include <string>
+#include <vector>
 
 using std::cerr;
 using std::cout;
@@ -14,10 +17,6 @@ using std::endl;
 
 using namespace std;
 
-#define MAX_SPEC_GOOD 20000
-#define MAX_SPEC 267000
-#define N_SPECTRUM_MASSES 10000
-
 //#define precursor_mass_tolerance 2.5
 //#define fragment_mass_tolerance 0.5
 
@@ -25,7 +24,9 @@ double precursor_mass_tolerance, fragment_mass_tolerance;
 
 #define max_intens_factor 0.01
 
-int read_directory(char *directory_name, spectrum **spe)
+// Spectra and peak lists grow as they are read; there is no fixed limit on
+// the number of spectra, peaks per spectrum or file name length.
+int read_directory(char *directory_name, vector<spectrum *> &spe)
 {
 
   double a, b;
@@ -35,15 +36,12 @@ int read_directory(char *directory_name, spectrum **spe)
   struct dirent *pentspec;
   ifstream good_spectrum;
 
-  double *mass = new double[N_SPECTRUM_MASSES];
-  double *intensity = new double[N_SPECTRUM_MASSES];
-
-  int num_spec = -1;
+  vector<double> mass, intensity;
 
-  char str1[MAX_IDLEN];
-  strcpy(str1, directory_name);  strcat(str1, "/");
+  string str1(directory_name);
+  str1 += "/";
 
-  char str2[MAX_IDLEN];
+  string str2;
   int fname_len, ext_pos;
 
   pdirspec=opendir(directory_name);
@@ -67,28 +65,22 @@ int read_directory(char *directory_name, spectrum **spe)
     // Only process .dta files
     if (strncasecmp(&pentspec->d_name[ext_pos], ".dta", 4) == 0) {
 
-      num_spec++;
-
       double precursor_mass;
       int charge;
-      strcpy(str2, str1);
-      strcat(str2, pentspec->d_name);
-      // Check that full spectrum filename is not too long
-      if (strlen(str2) >= MAX_IDLEN) {
-        cerr << "Fatal error: spectrum file name too long: " << str2 << endl;
-        exit(1);
-      }
-      good_spectrum.open(str2);
+      str2 = str1 + pentspec->d_name;
+      good_spectrum.open(str2.c_str());
       if(!good_spectrum) {
         cerr << "open() failure: could not open file: " << str2 << endl;
         exit(1);
       }
       i = 0;
+      mass.clear();
+      intensity.clear();
       while(good_spectrum >> a >> b) {
         if (i == 0) { precursor_mass = a; charge = int(b); }
         else {
-          mass[i-1] = a;
-          intensity[i-1] = b;
+          mass.push_back(a);
+          intensity.push_back(b);
         }
         i++;
       }
@@ -96,7 +88,7 @@ int read_directory(char *directory_name, spectrum **spe)
 
       // create a class spectrum object
 
-      spe[num_spec] = new spectrum(precursor_mass, charge, str2, i-1, mass, intensity);
+      spe.push_back(new spectrum(precursor_mass, charge, str2.c_str(), i-1, mass.data(), intensity.data()));
 
     }
 
@@ -108,17 +100,17 @@ int read_directory(char *directory_name, spectrum **spe)
 
   closedir(pdirspec);
 
-  return(num_spec+1);
+  return(spe.size());
 
 }
 
-int read_mgf(char *file_name, spectrum **spe)
+int read_mgf(char *file_name, vector<spectrum *> &spe)
 {
   double a, b;  int i;
 
   double precursor_mass;  int charge;  string spectrum_name;
 
-  double *mass, *intensity;
+  vector<double> mass, intensity;
 
   int num_spec = 0;
 
@@ -130,8 +122,8 @@ int read_mgf(char *file_name, spectrum **spe)
   string line;
   while(getline(fin,line)) {
     if (line.find("TITLE") < string::npos) {
-      mass = new double[N_SPECTRUM_MASSES];
-      intensity = new double[N_SPECTRUM_MASSES];
+      mass.clear();
+      intensity.clear();
       i = 0;
       string pm(line,line.find("=")+1,line.length());
       spectrum_name = pm;
@@ -146,16 +138,14 @@ int read_mgf(char *file_name, spectrum **spe)
     }
     if (line.find(" ") < string::npos && line.find("IONS")==string::npos) {
       string pm(line,0,line.find(" "));
-      mass[i] = atof(pm.c_str());
+      mass.push_back(atof(pm.c_str()));
       string pm1(line,line.find(" "),line.length());
-      intensity[i] = atof(pm1.c_str());
+      intensity.push_back(atof(pm1.c_str()));
       i++;
     }
     if (line.find("END") < string::npos) {
-      spe[num_spec] = new spectrum(precursor_mass, charge, spectrum_name.c_str(), i, mass, intensity);
+      spe.push_back(new spectrum(precursor_mass, charge, spectrum_name.c_str(), i, mass.data(), intensity.data()));
       num_spec++;
-      delete [] mass;
-      delete [] intensity;
     }
   }
 
@@ -244,108 +234,59 @@ double spearman_rank(double *inte1, double *inte2, int length)
 
 }
 
-void eagles_eye(spectrum *s1, spectrum *s2, double eye_catching_height, double &nesovpal, double &total_intens)
+// s1 and s2 must have been prepare()d with the same eye_catching_height.
+// Only eye-catching peaks are visited; the unmatched and total intensities
+// are accumulated in the same order as with the full peak lists.
+void eagles_eye(spectrum *s1, spectrum *s2, double &nesovpal, double &total_intens)
 {
-  // get the number of coinciding peaks
-  int n=0, lastj=0, high_good_peaks=0, high_bckgr_peaks=0;
-  double smallest_mass=10000.0, largest_mass=0.0;
-  double sum_intensity_total_bin1 = 0.0, sum_intensity_total_sq = 0.0, sum_intensity_total_log = 0.0;
-  double sum_intensity_sovpal_bin1 = 0.0, sum_intensity_sovpal_sq = 0.0, sum_intensity_sovpal_log = 0.0;
-  double sum_intensity_total_bin2 = 0.0;
-  double sum_intensity_sovpal_bin2 = 0.0;
-  double sum_intensity_total_bin3 = 0.0;
-  double sum_intensity_sovpal_bin3 = 0.0;
-
-  int high_unmatched_peak = 0;
-
-  for (int i = 0; i<s1->spectrum_length; i++) {
-    if(s1->intensity[i]>s1->max_intensity*eye_catching_height
-       && s1->mass[i]<0.900001*s1->precursor_mass/s1->charge ) {
-      high_good_peaks++;
-      sum_intensity_total_bin1 += s1->intensity[i]/s1->max_intensity;
-
-      if (s1->intensity[i]>s1->max_intensity*0.5) high_unmatched_peak = 1;
-
-      double m2, i2 = 0., m1 = s1->mass[i], i1 = s1->intensity[i];
-      for (int j = lastj; s2->mass[j] < m1+fragment_mass_tolerance, s2->mass[j]>0.01, j<s2->spectrum_length; j++) {
-	if (s2->intensity[j] > s2->max_intensity*eye_catching_height) {
-	  if (s2->mass[j] > m1 - fragment_mass_tolerance && s2->mass[j] < m1 + fragment_mass_tolerance) {
-	    lastj = j;
-	    n++;
-	    sum_intensity_sovpal_bin1 += s1->intensity[i]/s1->max_intensity;
-
-	    if (s2->intensity[j] > s2->max_intensity*eye_catching_height*2) high_unmatched_peak = 0;
-
-	    break;
-	  }
-	}
+  int lastj = 0, len2 = s2->peak_mass.size();
+  const double *m2 = len2 ? &s2->peak_mass[0] : 0;
+  double sovpal[3] = { 0.0, 0.0, 0.0 };
+
+  for (int b = 0; b < 3; b++) {
+    const vector<double> &mass1 = s1->bin_mass[b], &norm1 = s1->bin_norm[b];
+    for (size_t i = 0; i < mass1.size(); i++) {
+      double m1 = mass1[i];
+      for (int j = lastj; j < len2; j++) {
+        if (m2[j] > m1 - fragment_mass_tolerance && m2[j] < m1 + fragment_mass_tolerance) {
+          lastj = j;
+          sovpal[b] += norm1[i];
+          break;
+        }
       }
     }
   }
 
-  for (int i = 0; i < s1->spectrum_length; i++) {
-    if(s1->intensity[i]>s1->max_intensity*eye_catching_height
-       &&s1->mass[i]>0.9*s1->precursor_mass/s1->charge
-       && s1->mass[i]<1.000001*s1->precursor_mass/s1->charge) {
-      high_good_peaks++;
+  nesovpal = 2.*(s1->bin_total[0] - sovpal[0])+1.*(s1->bin_total[1] - sovpal[1])
+    +4.*(s1->bin_total[2] - sovpal[2]);
+  total_intens = 2*s1->bin_total[0] + s1->bin_total[1] + 4.*s1->bin_total[2];
 
-      sum_intensity_total_bin2 += s1->intensity[i]/s1->max_intensity;
-
-      if (s1->intensity[i]>s1->max_intensity*0.5) high_unmatched_peak = 1;
-
-      double m2, i2 = 0., m1 = s1->mass[i], i1 = s1->intensity[i];
-      for (int j = lastj; s2->mass[j] < m1+fragment_mass_tolerance, s2->mass[j]>0.01, j<s2->spectrum_length; j++) {
-	if (s2->intensity[j] > s2->max_intensity*eye_catching_height) {
-	  if (s2->mass[j] > m1 - fragment_mass_tolerance && s2->mass[j] < m1 + fragment_mass_tolerance) {
-	    lastj = j;
-	    n++;
-	    sum_intensity_sovpal_bin2 += s1->intensity[i]/s1->max_intensity;
+}
 
-	    if (s2->intensity[j] > s2->max_intensity*eye_catching_height*2) high_unmatched_peak = 0;
+struct mass_key
+{
+  int charge;
+  double precursor_mass;
+};
 
-	    break;
-	  }
-	}
-      }
-    }
+// orders background spectrum indices by charge, then precursor mass
+struct mass_order
+{
+  spectrum **spe;
+  bool operator()(int a, int b) const {
+    if (spe[a]->charge != spe[b]->charge) return spe[a]->charge < spe[b]->charge;
+    return spe[a]->precursor_mass < spe[b]->precursor_mass;
   }
-
-  for (int i = 0; i < s1->spectrum_length; i++) {
-    if(s1->intensity[i]>s1->max_intensity*eye_catching_height && s1->mass[i]>(s1->precursor_mass/s1->charge)) {
-      high_good_peaks++;
-
-      sum_intensity_total_bin3 += s1->intensity[i]/s1->max_intensity;
-
-      if (s1->intensity[i]>s1->max_intensity*0.5) high_unmatched_peak = 1;
-
-      double m2, i2 = 0., m1 = s1->mass[i], i1 = s1->intensity[i];
-      for (int j = lastj; s2->mass[j] < m1+fragment_mass_tolerance, s2->mass[j]>0.01, j<s2->spectrum_length; j++) {
-	if (s2->intensity[j] > s2->max_intensity*eye_catching_height) {
-	  if (s2->mass[j] > m1 - fragment_mass_tolerance && s2->mass[j] < m1 + fragment_mass_tolerance) {
-	    lastj = j;
-	    n++;
-	    sum_intensity_sovpal_bin3 += s1->intensity[i]/s1->max_intensity;
-
-	    if (s2->intensity[j] > s2->max_intensity*eye_catching_height*2) high_unmatched_peak = 0;
-
-	    break;
-	  }
-	}
-      }
-    }
+  bool operator()(int a, const mass_key &k) const {
+    if (spe[a]->charge != k.charge) return spe[a]->charge < k.charge;
+    return spe[a]->precursor_mass < k.precursor_mass;
   }
-
-  nesovpal = 2.*(sum_intensity_total_bin1 - sum_intensity_sovpal_bin1)+1.*(sum_intensity_total_bin2 - sum_intensity_sovpal_bin2)
-    +4.*(sum_intensity_total_bin3 - sum_intensity_sovpal_bin3);
-  total_intens = 2*sum_intensity_total_bin1 + sum_intensity_total_bin2 + 4.*sum_intensity_total_bin3;
-
-}
+};
 
 int main(int argc, char *argv[])
 {
 
-  spectrum **spe_good = new(spectrum *[MAX_SPEC_GOOD]);
-  spectrum **spe_bckg = new(spectrum *[MAX_SPEC]);
+  vector<spectrum *> spe_good, spe_bckg;
 
   int num_good_spec, num_bckg_spec;
   string madrebuena(argv[1]);
@@ -368,18 +309,42 @@ int main(int argc, char *argv[])
   precursor_mass_tolerance = atof(argv[4]);
   fragment_mass_tolerance = atof(argv[5]);
 
+  // threshold, normalize and bin every spectrum once instead of per pair
+  for (size_t i = 0; i < spe_good.size(); i++) spe_good[i]->prepare(eye_catching_height);
+  for (size_t j = 0; j < spe_bckg.size(); j++) spe_bckg[j]->prepare(eye_catching_height);
+
+  // index background spectra by (charge, precursor mass)
+  int *by_mass = new int[num_bckg_spec];
+  int *window = new int[num_bckg_spec];
+  for (int j = 0; j < num_bckg_spec; j++) by_mass[j] = j;
+  mass_order order = { spe_bckg.data() };
+  sort(by_mass, by_mass + num_bckg_spec, order);
+
   int found_match, tot_matches = 0;
   for (int i = 0; i < num_good_spec; i++) {
     found_match = 0;
 
     double tot_intens1, nesovpal1, tot_intens2, nesovpal2;
 
-    for (int j = 0; j < num_bckg_spec; j++) {
+    // candidate window: same charge, precursor mass within tolerance (widened
+    // by a few ulps, the exact test below decides), in original library order
+    double slack = 1e-9 * (fabs(spe_good[i]->precursor_mass) + precursor_mass_tolerance);
+    mass_key key = { spe_good[i]->charge, spe_good[i]->precursor_mass - precursor_mass_tolerance - slack };
+    int lo = lower_bound(by_mass, by_mass + num_bckg_spec, key, order) - by_mass;
+    int num_window = 0;
+    for (int k = lo; k < num_bckg_spec
+           && spe_bckg[by_mass[k]]->charge == spe_good[i]->charge
+           && spe_bckg[by_mass[k]]->precursor_mass <= spe_good[i]->precursor_mass + precursor_mass_tolerance + slack; k++)
+      window[num_window++] = by_mass[k];
+    sort(window, window + num_window);
+
+    for (int k = 0; k < num_window; k++) {
+      int j = window[k];
       if (fabs(spe_good[i]->precursor_mass-spe_bckg[j]->precursor_mass)<precursor_mass_tolerance
           && spe_good[i]->charge == spe_bckg[j]->charge) {
 
-	eagles_eye(spe_good[i],spe_bckg[j],eye_catching_height, nesovpal1, tot_intens1);
-	eagles_eye(spe_bckg[j],spe_good[i],eye_catching_height, nesovpal2, tot_intens2);
+	eagles_eye(spe_good[i],spe_bckg[j], nesovpal1, tot_intens1);
+	eagles_eye(spe_bckg[j],spe_good[i], nesovpal2, tot_intens2);
 
 	//printf("%-s\t%-s\t", spe_good[i]->scan_id, spe_bckg[j]->scan_id);
 	cout << spe_good[i]->scan_id << "\t" << spe_bckg[j]->scan_id << "\t";
@@ -399,6 +364,9 @@ int main(int argc, char *argv[])
     }
   }
 
+  delete [] by_mass;
+  delete [] window;
+
   return EXIT_SUCCESS;
 
 }
@@ -13,7 +13,7 @@ spectrum::spectrum(double pm, int ch, char *si,
   mass = new double[spectrum_length];
   intensity = new double[spectrum_length];
   sorted = 0;
-  for ( int i = 0; i < MAX_IDLEN; i++ ) { scan_id[i] = si[i]; }
+  scan_id = si;
   for ( int i = 0; i < sl; i++ ) {
     mass[i] = m[i];
     intensity[i] = ints[i];
@@ -31,7 +31,7 @@ spectrum::spectrum(double pm, int ch, const char *si,
   mass = new double[spectrum_length];
   intensity = new double[spectrum_length];
   sorted = 0;
-  for ( int i = 0; i < MAX_IDLEN; i++ ) { scan_id[i] = si[i]; }
+  scan_id = si;
   for ( int i = 0; i < sl; i++ ) {
     mass[i] = m[i];
     intensity[i] = ints[i];
@@ -49,6 +49,31 @@ spectrum::~spectrum()
   }
 }
 
+void spectrum::prepare(double eye_catching_height)
+{
+  double pmz = precursor_mass/charge;
+  for (int b = 0; b < 3; b++) {
+    bin_mass[b].clear();
+    bin_norm[b].clear();
+    bin_total[b] = 0.0;
+  }
+  peak_mass.clear();
+  for (int b = 0; b < 3; b++) {
+    for (int i = 0; i < spectrum_length; i++) {
+      if (intensity[i] <= max_intensity*eye_catching_height) continue;
+      // the bins overlap at their edges, as in eagles_eye()
+      if ((b == 0 && mass[i] < 0.900001*precursor_mass/charge)
+          || (b == 1 && mass[i] > 0.9*precursor_mass/charge && mass[i] < 1.000001*precursor_mass/charge)
+          || (b == 2 && mass[i] > pmz)) {
+        bin_mass[b].push_back(mass[i]);
+        bin_norm[b].push_back(intensity[i]/max_intensity);
+        bin_total[b] += intensity[i]/max_intensity;
+      }
+      if (b == 0) peak_mass.push_back(mass[i]);
+    }
+  }
+}
+
 void spectrum::sort_intensities()
 {
   int *dummy_rank = new int[spectrum_length];
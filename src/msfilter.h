@@ -1,8 +1,9 @@
-#define MAX_IDLEN 2048
-
 #ifndef SPECTRUM_H
 #define SPECTRUM_H
 
+#include <string>
+#include <vector>
+
 class spectrum
 {
 
@@ -14,11 +15,18 @@ class spectrum
 
   double precursor_mass, max_intensity;
   int charge, spectrum_length, sorted;
-  char scan_id[MAX_IDLEN];
+  std::string scan_id;
 
   double *mass, *intensity, *sorted_intensity;
   int *rank_by_intensity;
 
+  // eye-catching peaks, set by prepare(): masses and max-normalized
+  // intensities per precursor bin, their bin totals, and all of their
+  // masses in file order
+  std::vector<double> bin_mass[3], bin_norm[3], peak_mass;
+  double bin_total[3];
+
+  void prepare(double eye_catching_height);
   void sort_intensities();
   void quicksort(double *, int *, int lo, int hi);
 
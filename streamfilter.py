@@ -0,0 +1,172 @@
+"""
+Sorted runs of a Filter job scored batch by batch, for spectra files that
+do not fit in memory (see eagleeye_cgi.stream_spectra()).
+
+Every batch of queries leaves three files in a run directory:
+
+- <k>.table: the first score row of each query, in table order, as
+  `sort -b -g -k 7,7` orders it (printed DScore, ties by the whole line);
+- <k>.names: the query names in file name order, with the lowest and
+  highest p-value of all their rows;
+- <k>.records: the query records in file name order, with the p-value of
+  their first row.
+
+Merging the runs of all batches gives the first row of every query in the
+order of a table sorted at once, and the records in the file name order
+the output writers use, with one entry per run in memory. As when a whole
+file is read, a query replaces an earlier one of the same name; merging
+the names runs finds those replaced by a later batch.
+"""
+
+import heapq
+import math
+import os
+import pickle
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import msfilter
+from spectra_io import SpectrumRecord
+
+# Memory a batch takes while it is scored, as a multiple of its .dta text:
+# records, parsed peak arrays, SpectrumStore, peak lists and score rows
+# (benchmarks.bench_stream measured about 4.5 for a whole file in memory)
+BATCH_OVERHEAD = 5
+
+
+def batches(records: Iterable[SpectrumRecord], batch_bytes: int) -> Iterator[List[SpectrumRecord]]:
+    """
+    Groups records, in order, into batches of about batch_bytes of .dta
+    and .meta text each.
+    """
+    batch, size = [], 0
+    for r in records:
+        batch.append(r)
+        size += len(r.header) + len(r.peaks) + len(r.meta or '')
+        if size >= batch_bytes:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def _table_key(entry: Tuple[int, str]) -> tuple:
+    line = entry[1]
+    return msfilter.sort_key(float(line.split()[-1])), line
+
+
+def _lines(path: str, k: int) -> Iterator[Tuple[int, str]]:
+    with open(path) as fin:
+        for line in fin:
+            yield k, line
+
+
+def _names(path: str, k: int) -> Iterator[tuple]:
+    with open(path) as fin:
+        for line in fin:
+            name, lowest, highest = line.split('\t')
+            yield name, k, float(lowest), float(highest)
+
+
+def _records(path: str, k: int) -> Iterator[tuple]:
+    with open(path, 'rb') as fin:
+        while True:
+            try:
+                name, pvalue, header, peaks, meta, checked = pickle.load(fin)
+            except EOFError:
+                return
+            yield name, k, pvalue, SpectrumRecord(name, header, peaks, meta, checked)
+
+
+class BatchRuns:
+    """
+    The runs of the batches of one spectra file, in a directory. Batches
+    are added in file order with add(); close() once all are added, then
+    table() and records() can be merged as often as needed.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.count = 0
+        # (batch, name) of queries replaced by a later batch, set by close()
+        self.superseded = None
+        self.lowest, self.highest = math.inf, -math.inf
+
+    def _path(self, k: int, ext: str) -> str:
+        return os.path.join(self.directory, f"{k:06d}{ext}")
+
+    def add(self, queries: List[msfilter.Spectrum], library: List[msfilter.Spectrum], table: msfilter.ScoreTable,
+            records: Dict[str, SpectrumRecord]) -> None:
+        """
+        Writes the runs of the next batch.
+
+        :param table: Score rows of the batch, ordered with msfilter.sort_table()
+        :param records: The queries of the batch, by name (their scan ids)
+        """
+        k = self.count
+        first, lowest, highest = {}, {}, {}
+        with open(self._path(k, '.table'), 'w') as fout:
+            for line in msfilter.table_lines(queries, library, table):
+                name, pvalue = line.split('\t', 1)[0], msfilter.pvalue(float(line.split()[-1]))
+                if name not in first:
+                    first[name] = pvalue
+                    fout.write(line)
+                lowest[name] = min(lowest.get(name, pvalue), pvalue)
+                highest[name] = max(highest.get(name, pvalue), pvalue)
+        names = sorted(records)
+        with open(self._path(k, '.names'), 'w') as fout:
+            fout.writelines(f"{n}\t{lowest[n]!r}\t{highest[n]!r}\n" for n in names)
+        with open(self._path(k, '.records'), 'wb') as fout:
+            for n in names:
+                r = records[n]
+                # Parsed peak arrays are not kept, the outputs are written from the text
+                pickle.dump((n, first[n], r.header, r.peaks, r.meta, r.checked), fout, pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def close(self) -> None:
+        """
+        Merges the names runs: finds the queries replaced by a later batch,
+        and the lowest and highest p-value of the rows of all others.
+        """
+        self.superseded = set()
+        previous = None
+        for entry in heapq.merge(*(_names(self._path(k, '.names'), k) for k in range(self.count))):
+            if previous is not None and previous[0] == entry[0]:
+                self.superseded.add((previous[1], previous[0]))
+            elif previous is not None:
+                self.lowest, self.highest = min(self.lowest, previous[2]), max(self.highest, previous[3])
+            previous = entry
+        if previous is not None:
+            self.lowest, self.highest = min(self.lowest, previous[2]), max(self.highest, previous[3])
+
+    def table(self) -> Iterator[str]:
+        """
+        The first score row of every query, in table order.
+        """
+        runs = (_lines(self._path(k, '.table'), k) for k in range(self.count))
+        for k, line in heapq.merge(*runs, key=_table_key):
+            if (k, line.split('\t', 1)[0]) not in self.superseded:
+                yield line
+
+    def records(self) -> Iterator[Tuple[float, SpectrumRecord]]:
+        """
+        (p-value of the first row, record) of every query, in file name order.
+        """
+        runs = (_records(self._path(k, '.records'), k) for k in range(self.count))
+        for name, k, pvalue, r in heapq.merge(*runs, key=lambda entry: entry[:2]):
+            if (k, name) not in self.superseded:
+                yield pvalue, r
+
+
+def add_counters(totals: dict, counters: dict) -> None:
+    """
+    Adds the scoring counters of one batch to those of the batches before.
+    """
+    for key, value in counters.items():
+        if key == 'window_max':
+            totals[key] = max(totals.get(key, 0), value)
+        elif key in ('library_spectra', 'library_peaks', 'library_peaks_retained'):
+            totals[key] = value
+        elif key != 'window_mean':
+            totals[key] = totals.get(key, 0) + value
+    if totals.get('queries'):
+        totals['window_mean'] = totals['window_total'] / totals['queries']
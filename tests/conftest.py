@@ -0,0 +1,36 @@
+"""
+Shared fixtures. The tests import the top-level modules of the repository
+and the benchmarks' synthetic data generators.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def msfilter_binary(tmp_path_factory) -> str:
+    """
+    The msfilter binary: $MSFILTER, msfilter on the PATH, or built from
+    src/ with g++. Skips the test when none of these is available.
+    """
+    binary = os.environ.get('MSFILTER') or shutil.which('msfilter')
+    if binary:
+        return binary
+    gxx = shutil.which('g++')
+    if gxx is None:
+        pytest.skip("no msfilter binary and no g++ to build one")
+    binary = str(tmp_path_factory.mktemp('bin') / 'msfilter')
+    src = os.path.join(ROOT, 'src')
+    build = subprocess.run([gxx, '-O2', '-o', binary, os.path.join(src, 'msfilter.cc'),
+                            os.path.join(src, 'correlations_eagle_eye_bins_6norms.cc')], capture_output=True)
+    if build.returncode != 0:
+        pytest.skip(f"msfilter does not build: {build.stderr.decode(errors='replace')[-500:]}")
+    return binary
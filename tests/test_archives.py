@@ -0,0 +1,82 @@
+"""
+Compressed inputs streamed by spectra_io.read_spectra() and read_library()
+against the plain files: the same records from .mgf.gz, .mgf.zip, a
+.tar.gz member and .dta files archived as .zip or .tgz, the same library
+from .mgf.gz, .dta.zip and .dta.tgz libraries, and the same outputs for a
+job on a .mgf.gz spectra file and a job on the plain one.
+"""
+
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import zipfile
+
+import pytest
+
+from benchmarks.bench_archives import same_records
+from benchmarks.bench_stream import compare
+from benchmarks.synthetic import LIBRARY_FORMATS, dataset, write_library, write_mgf
+from conftest import ROOT
+from spectra_io import read_dta_records, read_library, read_mgf, read_spectra, write_dta_directory
+
+CONTAINERS = ['spectra.mgf.gz', 'spectra.mgf.zip', 'bundle.tar.gz:spectra.mgf', 'spectra.zip', 'spectra.tgz']
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory) -> tuple:
+    tmp = tmp_path_factory.mktemp('archives')
+    queries, library = dataset(60, 300, seed=111, background=0.5, mass_range=(1000.0, 1300.0))
+    plain = str(tmp / 'spectra.mgf')
+    write_mgf(queries, plain)
+    with open(plain, 'rb') as fin, gzip.open(str(tmp / 'spectra.mgf.gz'), 'wb') as fout:
+        shutil.copyfileobj(fin, fout)
+    with zipfile.ZipFile(tmp / 'spectra.mgf.zip', 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.write(plain, 'spectra.mgf')
+    with tarfile.open(tmp / 'bundle.tar.gz', 'w:gz') as tf:
+        tf.add(plain, 'run/spectra.mgf')
+    records, globals_meta = read_mgf(plain)
+    dta = str(tmp / 'dta')
+    write_dta_directory(records, globals_meta, dta)
+    names = sorted(os.listdir(dta))
+    with zipfile.ZipFile(tmp / 'spectra.zip', 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in names:
+            zf.write(os.path.join(dta, name), name)
+    with tarfile.open(tmp / 'spectra.tgz', 'w:gz') as tf:
+        for name in names:
+            tf.add(os.path.join(dta, name), name)
+    libraries = {fmt: write_library(library, str(tmp / fmt), fmt) for fmt in LIBRARY_FORMATS}
+    return tmp, plain, dta, libraries
+
+
+@pytest.mark.parametrize('container', CONTAINERS)
+def test_spectra(files, container):
+    tmp, plain, dta, _ = files
+    records, globals_meta, mgf = read_spectra(str(tmp / container))
+    expected, expected_globals = read_mgf(plain) if mgf else read_dta_records(dta)
+    assert mgf == ('.mgf' in container)
+    assert len(records) == 60
+    assert same_records(records, expected)
+    assert globals_meta == expected_globals
+
+
+@pytest.mark.parametrize('fmt', ['mgf.gz', 'dta.zip', 'dta.tgz'])
+def test_library(files, fmt):
+    _, _, _, libraries = files
+    records = read_library(libraries[fmt])
+    expected, _ = read_mgf(libraries['mgf']) if fmt.startswith('mgf') else read_dta_records(libraries['dir'])
+    assert len(records) == 300
+    assert same_records(records, expected)
+
+
+def test_job(files):
+    tmp, plain, _, libraries = files
+    for name, spectra in (('plain', plain), ('compressed', str(tmp / 'spectra.mgf.gz'))):
+        os.makedirs(tmp / 'jobs' / name)
+        subprocess.run([sys.executable, os.path.join(ROOT, 'run_eagleeye.py'), spectra, libraries['dta.tgz'],
+                        '-p', '2', '-f', '0.6', '-a', '0.05'], cwd=tmp / 'jobs' / name, check=True,
+                       stdout=subprocess.DEVNULL)
+    names = compare(str(tmp / 'jobs' / 'plain'), str(tmp / 'jobs' / 'compressed'))
+    assert 'spectra-table.csv' in names
@@ -0,0 +1,137 @@
+"""
+The chunked MGF reader (read_mgf / read_mgf_stream) against the line by
+line MgfReader, with chunks of one byte up to the default size: the same
+records, global blocks and spectra for small files covering global and
+local TITLE/CHARGE/PEPMASS, multiple charges, CRLF line breaks, IONS
+blocks without peaks or END IONS and lines that are not peak lines, and
+the same exception for files MgfReader rejects.
+"""
+
+import io
+
+import numpy as np
+import pytest
+
+import spectra_io
+from spectra_io import MgfReader, read_mgf, read_mgf_stream
+
+EDGE_CASES = {
+    'globals': "COM=test\nCHARGE=2+\nPEPMASS=500.5\n\nBEGIN IONS\nTITLE=a.1.1.2.dta\n100.5 20\n200 30.25\nEND IONS\n"
+               "TITLE=global title\nBEGIN IONS\nPEPMASS=600.25 1000\n101 1E3\n102.5\t7\nEND IONS\n\n"
+               "CHARGE=3+\nBEGIN IONS\nTITLE=b c/d\nCHARGE=2+ and 3+\nRTINSECONDS=12\n10 1\n11 2\nEND IONS\n",
+    'odd_lines': "BEGIN IONS\nTITLE=x\nCHARGE=2\nPEPMASS=400\n100 1\n\n101 2 3\n102\n  \nTITLE=late\n1-2 5\n"
+                 "-1.5E-3 4\n+1E+5 3\n.5 2.\n5E 1\n0123.4500 007\nEND IONS\n",
+    'no_peaks': "BEGIN IONS\nTITLE=empty\nPEPMASS=300\nEND IONS\nBEGIN IONS\nTITLE=y\nCHARGE=1+\nPEPMASS=300\n"
+                "1 2\nEND IONS\nEND IONS\n",
+    'crlf': "CHARGE=2+\r\nBEGIN IONS\r\nTITLE=z\r\nPEPMASS=700\r\n50.1 3\r\n60.2 4\r\nEND IONS\r\n"
+            "BEGIN IONS\r\nTITLE=w\r\nPEPMASS=701\r\n70 5\r\nEND IONS\r\n",
+    'unclosed': "BEGIN IONS\nTITLE=u\nCHARGE=2\nPEPMASS=400\n100 1\nBEGIN IONS\nTITLE=v\n101 2\nEND IONS\n"
+                "BEGIN IONS\nTITLE=last\nCHARGE=2\nPEPMASS=401\n1 1\n",
+    'long_digits': "BEGIN IONS\nTITLE=d\nCHARGE=2\nPEPMASS=400\n100.12345678901234 1\n3.141592653589793 2\n"
+                   "END IONS\n",
+    # Precursor parameters of nested and unclosed blocks from globals of an earlier chunk
+    'nested_globals': "CHARGE=2+\nPEPMASS=500\nBEGIN IONS\nTITLE=a\n1 1\nEND IONS\nBEGIN IONS\nTITLE=b\n2 2\n"
+                      "BEGIN IONS\nTITLE=c\n3 3\nEND IONS\n",
+    'unclosed_globals': "CHARGE=2+\nBEGIN IONS\nTITLE=a\nPEPMASS=400\n1 1\nEND IONS\nBEGIN IONS\nTITLE=b\n"
+                        "PEPMASS=401\n2 2\n",
+}
+
+# Files MgfReader rejects
+INVALID = {
+    'missing': "BEGIN IONS\nTITLE=a\nCHARGE=2\nPEPMASS=400\n1 1\nEND IONS\nBEGIN IONS\nTITLE=b\n2 2\nEND IONS\n",
+    'unclosed_missing': "BEGIN IONS\nTITLE=a\nCHARGE=2\nPEPMASS=400\n1 1\nEND IONS\nBEGIN IONS\nTITLE=b\n"
+                        "PEPMASS=401\n2 2\n",
+    'nested_missing': "BEGIN IONS\nTITLE=a\nCHARGE=2\nPEPMASS=400\n1 1\nEND IONS\nBEGIN IONS\nTITLE=b\n2 2\n"
+                      "BEGIN IONS\nCHARGE=2\nPEPMASS=401\n3 3\nEND IONS\n",
+    'global_peaks': "BEGIN IONS\nTITLE=a\nCHARGE=2\nPEPMASS=400\n1 1\nEND IONS\n2 2\n",
+}
+
+CHUNK_SIZES = [1, 16, 64, spectra_io.MGF_CHUNK_BYTES]
+
+
+def records_key(records: list) -> list:
+    return [(r.name, r.header, r.peaks, r.meta, r.checked) for r in records]
+
+
+def assert_same_spectra(expected: list, actual: list) -> None:
+    for a, b in zip(expected, actual):
+        try:
+            s = a.spectrum()
+        except Exception:
+            continue
+        t = b.spectrum()
+        assert (s.precursor_mass, s.charge) == (t.precursor_mass, t.charge)
+        assert np.array_equal(s.mass, t.mass) and np.array_equal(s.intensity, t.intensity)
+
+
+def sequential(path: str) -> tuple:
+    reader = MgfReader.open(path)
+    with reader.fin:
+        records = list(reader)
+    return records, reader.globals
+
+
+def write(tmp_path, name: str, text: str) -> str:
+    path = str(tmp_path / (name + '.mgf'))
+    with open(path, 'w', newline='') as fout:
+        fout.write(text)
+    return path
+
+
+@pytest.mark.parametrize('name', sorted(EDGE_CASES))
+@pytest.mark.parametrize('chunk', CHUNK_SIZES)
+@pytest.mark.parametrize('workers', [1, 2])
+def test_edge_cases(tmp_path, monkeypatch, name, chunk, workers):
+    text = EDGE_CASES[name] * 3
+    path = write(tmp_path, name, text)
+    expected, gexpected = sequential(path)
+    monkeypatch.setattr(spectra_io, 'MGF_CHUNK_BYTES', chunk)
+    for records, gtext in (read_mgf(path, workers=workers),
+                           read_mgf_stream(io.BytesIO(text.encode()), name, workers=workers)):
+        assert records_key(records) == records_key(expected)
+        assert gtext == gexpected
+        assert_same_spectra(expected, records)
+
+
+@pytest.mark.parametrize('name', sorted(INVALID))
+@pytest.mark.parametrize('chunk', CHUNK_SIZES)
+def test_invalid(tmp_path, monkeypatch, name, chunk):
+    text = INVALID[name]
+    path = write(tmp_path, name, text)
+    with pytest.raises(Exception) as expected:
+        sequential(path)
+    monkeypatch.setattr(spectra_io, 'MGF_CHUNK_BYTES', chunk)
+    with pytest.raises(Exception) as actual:
+        read_mgf(path, workers=1)
+    assert str(actual.value) == str(expected.value)
+    with pytest.raises(Exception) as actual:
+        read_mgf_stream(io.BytesIO(text.encode()), name + '.mgf', workers=1)
+    assert str(actual.value) == str(expected.value)
+
+
+def test_random_lines(monkeypatch):
+    """
+    Files of random lines, valid or not: the same records or exception.
+    """
+    lines = ["BEGIN IONS", "END IONS", "TITLE=t", "TITLE=", "CHARGE=2+", "CHARGE=", "PEPMASS=500", "PEPMASS=",
+             "1 1", "2.5 3", "x y", "", "COM=c"]
+
+    def outcome(read) -> tuple:
+        try:
+            records, gtext = read()
+        except Exception as e:
+            return 'error', str(e)
+        return records_key(records), gtext
+
+    def sequential_text(text: str) -> tuple:
+        reader = MgfReader(io.StringIO(text), 'random.mgf')
+        return list(reader), reader.globals
+
+    rng = np.random.default_rng(81)
+    for _ in range(500):
+        text = ''.join(lines[k] + '\n' for k in rng.integers(len(lines), size=rng.integers(1, 25)))
+        expected = outcome(lambda: sequential_text(text))
+        for chunk in (1, 7, 30):
+            monkeypatch.setattr(spectra_io, 'MGF_CHUNK_BYTES', chunk)
+            assert outcome(lambda: read_mgf_stream(io.BytesIO(text.encode()), 'random.mgf', workers=1)) == \
+                expected, text
@@ -0,0 +1,116 @@
+"""
+Parity of the in-process engine (msfilter.msfilter()) with the msfilter
+binary built from src/: DScores of every (query, library) pair, queries
+without candidates, and the order of the table that `sort -b -g -k 7,7`
+gives and msfilter.sort_table() reproduces.
+"""
+
+import math
+import os
+import subprocess
+
+import numpy as np
+import pytest
+
+import msfilter
+from benchmarks.synthetic import perturbed, random_spectra, write_dta_directory
+from msfilter import Spectrum
+
+EYE_CATCHING_HEIGHT = 0.05
+TOLERANCES = ((2.0, 0.6), (0.5, 0.5), (10.0, 0.2))
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory) -> tuple:
+    """
+    Query and library .dta directories. The library holds exact copies of
+    some spectra under other names, so that queries have tied DScores;
+    queries are near-duplicates, unrelated spectra, copies of library
+    spectra, spectra with unsorted or duplicate peaks, and spectra no
+    library spectrum is within any tolerance of.
+    """
+    library = random_spectra(150, seed=11, prefix='lib')
+    library += [Spectrum(s.precursor_mass, s.charge, f"copy{k:03d}", s.mass, s.intensity)
+                for k, s in enumerate(library[:5])]
+    queries = perturbed(library[:30], seed=12) + random_spectra(20, seed=13, prefix='rnd')
+    queries += [Spectrum(s.precursor_mass, s.charge, f"same{k:03d}", s.mass, s.intensity)
+                for k, s in enumerate(library[:5])]
+    rng = np.random.default_rng(14)
+    for k in range(0, len(queries), 7):
+        s = queries[k]
+        order = rng.permutation(len(s.mass))
+        queries[k] = Spectrum(s.precursor_mass, s.charge, s.scan_id, s.mass[order], s.intensity[order])
+    for k in range(3, len(queries), 11):
+        s = queries[k]
+        repeat = rng.integers(0, len(s.mass), 5)
+        queries[k] = Spectrum(s.precursor_mass, s.charge, s.scan_id, np.concatenate((s.mass, s.mass[repeat])),
+                              np.concatenate((s.intensity, s.intensity[repeat] * 0.5)))
+    queries += [Spectrum(9000.0 + k, 2, f"far{k:03d}", q.mass, q.intensity) for k, q in enumerate(queries[:2])]
+    queries += [Spectrum(q.precursor_mass, 5, f"charge5_{k:03d}", q.mass, q.intensity)
+                for k, q in enumerate(queries[:2])]
+    tmp = tmp_path_factory.mktemp('parity')
+    qdir, ldir = str(tmp / 'queries'), str(tmp / 'library')
+    write_dta_directory(queries, qdir)
+    write_dta_directory(library, ldir)
+    return qdir, ldir
+
+
+def run_binary(binary: str, qdir: str, ldir: str, pmt: float, fmt: float) -> list:
+    out = subprocess.run([binary, qdir, ldir, str(EYE_CATCHING_HEIGHT), str(pmt), str(fmt)],
+                         check=True, capture_output=True, text=True).stdout
+    return out.splitlines(keepends=True)
+
+
+def scores(lines: list) -> dict:
+    result = {}
+    for line in lines:
+        arr = line.split()
+        if len(arr) >= 7:
+            result[(os.path.basename(arr[0]), os.path.basename(arr[1]))] = float(arr[-1])
+    return result
+
+
+@pytest.mark.parametrize('pmt,fmt', TOLERANCES)
+def test_dscores(msfilter_binary, dataset, pmt, fmt):
+    qdir, ldir = dataset
+    expected = scores(run_binary(msfilter_binary, qdir, ldir, pmt, fmt))
+    queries, library = msfilter.read_directory(qdir), msfilter.read_directory(ldir)
+    table = msfilter.msfilter(queries, library, EYE_CATCHING_HEIGHT, pmt, fmt)
+    actual = scores(msfilter.table_lines(queries, library, table))
+
+    assert set(actual) == set(expected)
+    for key, a in expected.items():
+        b = actual[key]
+        if math.isnan(a):
+            assert math.isnan(b), key
+        else:
+            # The binary prints 6 significant digits
+            assert b == pytest.approx(a, rel=1e-5, abs=1e-12), key
+
+
+def test_not_found(msfilter_binary, dataset):
+    qdir, ldir = dataset
+    expected = [line for line in run_binary(msfilter_binary, qdir, ldir, 2.0, 0.6) if 'not_found' in line]
+    queries, library = msfilter.read_directory(qdir), msfilter.read_directory(ldir)
+    table = msfilter.msfilter(queries, library, EYE_CATCHING_HEIGHT, 2.0, 0.6)
+    actual = [line for line in msfilter.table_lines(queries, library, table) if 'not_found' in line]
+
+    names = {os.path.basename(line.split('\t', 1)[0]) for line in expected}
+    assert {'far000.2.dta', 'far001.2.dta', 'charge5_000.5.dta', 'charge5_001.5.dta'} <= names
+    assert sorted(actual) == sorted(expected)
+
+
+@pytest.mark.parametrize('pmt,fmt', TOLERANCES)
+def test_sort_order(msfilter_binary, dataset, pmt, fmt):
+    qdir, ldir = dataset
+    out = ''.join(run_binary(msfilter_binary, qdir, ldir, pmt, fmt))
+    expected = subprocess.run(['sort', '-b', '-g', '-k', '7,7'], input=out, capture_output=True, text=True,
+                              check=True, env=dict(os.environ, LC_ALL='C')).stdout.splitlines(keepends=True)
+    queries, library = msfilter.read_directory(qdir), msfilter.read_directory(ldir)
+    table = msfilter.msfilter(queries, library, EYE_CATCHING_HEIGHT, pmt, fmt)
+    actual = list(msfilter.table_lines(queries, library, msfilter.sort_table(queries, library, table)))
+
+    # Copies of library spectra tie on DScore; the whole line breaks the tie
+    printed = [line.split()[-1] for line in expected]
+    assert len(printed) > len(set(printed))
+    assert actual == expected
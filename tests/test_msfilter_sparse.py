@@ -0,0 +1,82 @@
+"""
+The sparse engine (msfilter_sparse.msfilter_sparse()) against the exact
+one: its DScores deviate by at most MAX_DEVIATION and never upwards, and
+with the job's cutoffs its Good/Background calls are the exact engine's.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy')
+
+import msfilter
+import msfilter_sparse
+from benchmarks.synthetic import dataset
+
+EYE_CATCHING_HEIGHT = 0.05
+CUTOFFS = (0.01, 0.05, 0.2)
+
+
+def calls(table: msfilter.ScoreTable, cutoff: float) -> list:
+    # processtable() classifies the printed DScore of each query's first row
+    return [msfilter.pvalue(float(f"{ds:g}")) < cutoff for ds in table.dscore.tolist()]
+
+
+def approx_best(queries, library, fmt: float, cutoffs, stats: dict = None) -> msfilter.ScoreTable:
+    return msfilter_sparse.msfilter_sparse(queries, library, EYE_CATCHING_HEIGHT, 2.0, fmt, top_k=1,
+                                           cutoffs=cutoffs, stats=stats)
+
+
+@pytest.mark.parametrize('seed,fmt', [(1, 0.6), (2, 0.3), (3, 1.0)])
+def test_deviation(seed, fmt):
+    queries, library = dataset(200, 1000, seed=seed, background=0.6, jitter=fmt / 2, mass_range=(1000.0, 1500.0))
+    exact = msfilter.msfilter(queries, library, EYE_CATCHING_HEIGHT, 2.0, fmt)
+    approx = msfilter_sparse.msfilter_sparse(queries, library, EYE_CATCHING_HEIGHT, 2.0, fmt)
+
+    assert np.array_equal(exact.query, approx.query) and np.array_equal(exact.match, approx.match)
+    scored = ~np.isnan(exact.dscore)
+    assert np.array_equal(scored, ~np.isnan(approx.dscore))
+    deviation = exact.dscore[scored] - approx.dscore[scored]
+    assert deviation.max() <= msfilter_sparse.MAX_DEVIATION
+    assert deviation.min() >= -1e-9
+    best = msfilter.msfilter(queries, library, EYE_CATCHING_HEIGHT, 2.0, fmt, top_k=1)
+    rescored = approx_best(queries, library, fmt, CUTOFFS)
+    for cutoff in CUTOFFS:
+        assert calls(rescored, cutoff) == calls(best, cutoff)
+
+
+@pytest.mark.parametrize('peaks', [6, 10, 20])
+def test_calls(peaks):
+    # Few peaks shifted by more than the fragment tolerance: the approximate
+    # DScores deviate well beyond MAX_DEVIATION and move queries to Background
+    queries, library = dataset(300, 600, seed=5, background=0.7, jitter=0.75, peaks=peaks,
+                               mass_range=(1000.0, 1300.0))
+    exact = msfilter.msfilter(queries, library, EYE_CATCHING_HEIGHT, 2.0, 0.6, top_k=1)
+    stats = {}
+    rescored = approx_best(queries, library, 0.6, CUTOFFS, stats)
+    unchecked = approx_best(queries, library, 0.6, None)
+
+    assert any(calls(unchecked, c) != calls(exact, c) for c in CUTOFFS)
+    for cutoff in CUTOFFS:
+        assert calls(rescored, cutoff) == calls(exact, cutoff)
+    assert 0 < stats['pairs_rescored'] < stats['pairs_scored']
+    # Background rows report msfilter's best match and DScore
+    background = np.array(calls(exact, max(CUTOFFS)))
+    assert np.array_equal(rescored.match[background], exact.match[background])
+    assert np.array_equal(rescored.dscore[background], exact.dscore[background])
+
+
+def test_dscore_cutoff():
+    for cutoff in CUTOFFS:
+        d = msfilter.dscore_cutoff(cutoff)
+        assert msfilter.pvalue(d * (1 - 1e-9)) < cutoff <= msfilter.pvalue(d * (1 + 1e-9))
+
+
+def test_slabs(monkeypatch):
+    # A wide tolerance: blocks span many library rows, multiplied a few at a time
+    queries, library = dataset(100, 1000, seed=6, mass_range=(1000.0, 1050.0))
+    whole = msfilter_sparse.msfilter_sparse(queries, library, EYE_CATCHING_HEIGHT, 20.0, 0.6)
+    monkeypatch.setattr(msfilter_sparse, 'SLAB_ROWS', 16)
+    slabs = msfilter_sparse.msfilter_sparse(queries, library, EYE_CATCHING_HEIGHT, 20.0, 0.6)
+    for column in ('query', 'match', 'dscore'):
+        assert np.array_equal(getattr(whole, column), getattr(slabs, column), equal_nan=True)
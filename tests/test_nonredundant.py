@@ -0,0 +1,90 @@
+"""
+The redundancy graph of Nonred jobs (make_nonredundant.read_graph() and
+select_nonredundant()) against the pairwise p-value dict it replaced, on
+random score tables, and Nonred jobs streaming the table into the graph
+against jobs that read it back from a sorted file.
+"""
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from benchmarks.bench_stream import compare
+from benchmarks.synthetic import perturbed, random_spectra, write_mgf
+from conftest import ROOT
+from make_nonredundant import compute_pvalue, read_graph, select_nonredundant
+
+CUTOFFS = [0.01, 0.05, 0.2, 0.9]
+
+
+def pairwise_selection(lines: list, names: list, smj: float) -> list:
+    """
+    The selection of parse_table() and select_nonredundant_files() before
+    the graph: p-values of both orders of each pair in a dict, the last row
+    of a pair deciding, and every name compared with all selected ones.
+    """
+    pv = {}
+    for line in lines:
+        arr = line.strip().split()
+        a, b = os.path.basename(arr[0]), os.path.basename(arr[1])
+        try:
+            score = float(arr[-1])
+        except Exception:
+            score = -1.0
+        pv[f"{a} {b}"] = pv[f"{b} {a}"] = compute_pvalue(score) if a != b else 1.0
+    selected = []
+    for f1 in names:
+        if not any(0 < pv.get(f"{f1} {f2}", 0) < smj for f2 in selected):
+            selected.append(f1)
+    return selected
+
+
+def random_table(seed: int) -> tuple:
+    rng = np.random.default_rng(seed)
+    names = [f"s{k:02d}.2.dta" for k in range(40)]
+    lines = []
+    for _ in range(300):
+        a, b = rng.integers(len(names), size=2)
+        # Self pairs, repeated pairs with other scores, unparseable and negative scores
+        score = rng.choice([f"{rng.uniform(0, 1):g}", f"{rng.uniform(0.2, 0.5):g}", 'nan', '-1', 'x'],
+                           p=[0.5, 0.3, 0.05, 0.05, 0.1])
+        lines.append(f"dir/{names[a]}\tlib/{names[b]}\t{score}\n")
+    order = rng.permutation(len(names))
+    return lines, [names[k] for k in order]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_tables(seed):
+    lines, names = random_table(seed)
+    top = read_graph(lines, CUTOFFS[-1])
+    for smj in CUTOFFS:
+        expected = pairwise_selection(lines, names, smj)
+        assert select_nonredundant(names, read_graph(lines, smj)) == expected
+        # Pruned from the graph of the highest cutoff, as a cutoff sweep does
+        assert select_nonredundant(names, top.with_cutoff(smj)) == expected
+    assert len(pairwise_selection(lines, names, CUTOFFS[-1])) < len(names)
+
+
+def test_jobs(tmp_path):
+    """
+    The in-process table streamed into the graph, and the --all-pairs table
+    sorted into a file and read back, select the same spectra.
+    """
+    spectra = random_spectra(80, seed=101, mass_range=(1000.0, 1100.0), prefix='orig')
+    spectra += perturbed(spectra[:30], seed=102, jitter=0.05, prefix='dup')
+    spectra_file = str(tmp_path / 'queries.mgf')
+    write_mgf(spectra, spectra_file)
+    cutoffs = ','.join(map(str, CUTOFFS[1:3]))
+    for name, options in (('streamed', []), ('file', ['--all-pairs'])):
+        os.makedirs(tmp_path / name)
+        subprocess.run([sys.executable, os.path.join(ROOT, 'run_eagleeye.py'), spectra_file, '-n', '-p', '2',
+                        '-f', '0.6', '-a', cutoffs] + options, cwd=tmp_path / name, check=True,
+                       stdout=subprocess.DEVNULL)
+    os.remove(tmp_path / 'file' / 'queries-pairs.txt')
+    names = compare(str(tmp_path / 'streamed'), str(tmp_path / 'file'))
+    assert 'queries-a0.2-nonredundant.mgf' in names
+    with open(tmp_path / 'streamed' / 'queries-a0.2-nonredundant.mgf') as fin:
+        assert 80 <= fin.read().count('BEGIN IONS') < len(spectra)
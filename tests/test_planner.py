@@ -0,0 +1,147 @@
+"""
+The execution planner (planner.plan_job()): its candidate pair estimate
+against a brute-force count, and the number of processes and streaming
+decisions at the edges of their thresholds.
+"""
+
+import math
+
+import numpy as np
+import pytest
+
+import planner
+import streamfilter
+from benchmarks.synthetic import random_spectra, write_mgf
+
+PMT = 2.0
+
+
+def brute_force_pairs(qmass, qcharge, lmass, lcharge, tolerance: float) -> int:
+    return int(sum(np.count_nonzero((lcharge == c) & (np.abs(lmass - m) <= tolerance))
+                   for m, c in zip(qmass.tolist(), qcharge.tolist())))
+
+
+@pytest.mark.parametrize('tolerance', [0.5, 2.0, 10.0])
+@pytest.mark.parametrize('precursor', ['uniform', 'normal'])
+def test_pairs(tolerance, precursor):
+    rng = np.random.default_rng(51)
+    qmass, lmass = rng.uniform(800, 3500, 3000), rng.uniform(800, 3500, 20000)
+    if precursor == 'normal':
+        qmass, lmass = rng.normal(2000, 400, 3000), rng.normal(2000, 400, 20000)
+    qcharge, lcharge = rng.choice([1, 2, 3], 3000), rng.choice([2, 3, 4], 20000)
+    width = tolerance / 4
+    estimate = planner.MassHistogram(qmass, qcharge, width).pairs(planner.MassHistogram(lmass, lcharge, width),
+                                                                   tolerance)
+    expected = brute_force_pairs(qmass, qcharge, lmass, lcharge, tolerance)
+    assert estimate == pytest.approx(expected, rel=0.05)
+
+
+def test_pairs_scaled():
+    # A sample of a tenth of the queries, scaled up, estimates all of them
+    rng = np.random.default_rng(52)
+    qmass, lmass = rng.uniform(800, 3500, 20000), rng.uniform(800, 3500, 20000)
+    qcharge, lcharge = rng.choice([2, 3], 20000), rng.choice([2, 3], 20000)
+    library = planner.MassHistogram(lmass, lcharge, PMT / 4)
+    sample = planner.MassHistogram(qmass[::10], qcharge[::10], PMT / 4, scale=10.0)
+    assert sample.pairs(library, PMT) == pytest.approx(brute_force_pairs(qmass, qcharge, lmass, lcharge, PMT),
+                                                       rel=0.05)
+    # No library spectrum of a charge
+    assert planner.MassHistogram(qmass, np.full(len(qmass), 5), PMT / 4).pairs(library, PMT) == 0
+
+
+@pytest.fixture(scope='module')
+def library() -> dict:
+    """
+    A library as eagleeye_cgi.load_library() returns it, for the planner.
+    """
+    return {'background': random_spectra(2000, seed=53, prefix='lib'), 'records': None}
+
+
+@pytest.fixture(scope='module')
+def profile(tmp_path_factory) -> planner.QueryProfile:
+    path = str(tmp_path_factory.mktemp('plan') / 'queries.mgf')
+    write_mgf(random_spectra(500, seed=54, prefix='q'), path)
+    return planner.profile_mgf(path)
+
+
+def params(**kwargs) -> dict:
+    return dict({'type': 'Filter', 'pmt': PMT, 'engine': 'python'}, **kwargs)
+
+
+def memory(profile: planner.QueryProfile) -> int:
+    # A Filter job keeps the best row of each query
+    return int(profile.text_bytes * streamfilter.BATCH_OVERHEAD + profile.spectra * planner.ROW_BYTES)
+
+
+def test_profile(profile):
+    assert (profile.spectra, profile.exact, profile.mgf) == (500, True, True)
+    assert len(profile.precursor_mass) == len(profile.charge) == 500
+
+
+def test_stream_threshold(library, profile):
+    need = memory(profile)
+    # Exactly MEMORY_FRACTION of the available memory still runs in memory
+    at = planner.plan_job(params(plan_memory=need / planner.MEMORY_FRACTION / 2**20), library, profile)
+    assert at.memory == need and at.available == int(need / planner.MEMORY_FRACTION)
+    assert at.memory_budget is None
+    below = planner.plan_job(params(plan_memory=(need - 1) / planner.MEMORY_FRACTION / 2**20), library, profile)
+    assert below.memory_budget == round(planner.STREAM_FRACTION * below.available / 2**20)
+    assert below.params() == {'workers': below.workers, 'memory_budget': below.memory_budget}
+
+
+def test_small_budget(library, profile):
+    # Streamed with at least 1 MB, however little memory is available
+    plan = planner.plan_job(params(plan_memory=1e-3), library, profile)
+    assert plan.memory > planner.MEMORY_FRACTION * plan.available
+    assert plan.memory_budget == 1
+
+
+@pytest.mark.parametrize('options', [{'all_pairs': True}, {'score_cache': '/tmp/cache'}, {'engine': 'msfilter'},
+                                     {'type': 'Nonred'}, {'memory_budget': 7}])
+def test_not_streamed(library, profile, options):
+    plan = planner.plan_job(params(plan_memory=1e-3, **options), library, profile)
+    # An explicit budget is kept, otherwise these jobs cannot be streamed
+    assert plan.memory_budget == options.get('memory_budget')
+
+
+def test_not_mgf(library, profile):
+    plan = planner.plan_job(params(plan_memory=1e-3), library, profile._replace(mgf=False))
+    assert plan.memory_budget is None
+
+
+@pytest.mark.parametrize('cpus,processes,expected', [(8, 3, 3), (8, 1, 1), (8, 0.5, 1), (2, 3, 2), (8, 100, 8)])
+def test_workers(library, profile, monkeypatch, cpus, processes, expected):
+    """
+    A process per WORKER_SECONDS of estimated scoring time, at most one per
+    CPU and at least one.
+    """
+    seconds = planner.plan_job(params(), library, profile).seconds
+    assert seconds > 0
+    monkeypatch.setattr(planner.os, 'cpu_count', lambda: cpus)
+    # Just over the threshold of `processes`, and just under it
+    monkeypatch.setattr(planner, 'WORKER_SECONDS', seconds / processes * (1 - 1e-9))
+    assert planner.plan_job(params(), library, profile).workers == expected
+    monkeypatch.setattr(planner, 'WORKER_SECONDS', seconds / processes * (1 + 1e-9))
+    below = max(1, min(cpus, math.ceil(processes) - 1))
+    assert planner.plan_job(params(), library, profile).workers == below
+
+
+def test_workers_kept(library, profile, monkeypatch):
+    monkeypatch.setattr(planner, 'WORKER_SECONDS', 1e-9)
+    monkeypatch.setattr(planner.os, 'cpu_count', lambda: 8)
+    assert planner.plan_job(params(), library, profile).workers == 8
+    # Explicit workers are kept, and only the python engine gets planned ones
+    assert planner.plan_job(params(workers=3), library, profile).workers == 3
+    assert planner.plan_job(params(engine='sparse', workers=3), library, profile).workers == 3
+    assert planner.plan_job(params(engine='msfilter', workers=2), library, profile).workers == 2
+
+
+def test_estimate(library, profile):
+    plan = planner.plan_job(params(), library, profile)
+    background = library['background']
+    expected = brute_force_pairs(profile.precursor_mass, profile.charge,
+                                 np.array([s.precursor_mass for s in background]),
+                                 np.array([s.charge for s in background]), PMT)
+    assert plan.pairs == pytest.approx(expected, rel=0.1)
+    assert plan.seconds == pytest.approx(plan.pairs * planner.PAIR_SECONDS['python'])
+    assert planner.plan_job(params(), {'background': None, 'records': None}, profile).pairs is None
@@ -0,0 +1,79 @@
+"""
+--prune (msfilter.msfilter() with prune=True) reports the same best
+match of each query as a normal top_k=1 run, in the score table and in
+the table CSV and results database of a job, with fewer pairs scored.
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import msfilter
+from benchmarks.synthetic import perturbed, random_spectra, write_library, write_mgf
+from conftest import ROOT
+from msfilter import Spectrum
+
+EYE_CATCHING_HEIGHT = 0.05
+
+
+@pytest.fixture(scope='module')
+def spectra() -> tuple:
+    """
+    Queries whose closest candidate by precursor mass is a rougher copy of
+    their library spectrum: it is background already, but not the best
+    match. Exact copies under other names tie on DScore.
+    """
+    library = random_spectra(120, seed=21, prefix='lib')
+    rough = perturbed(library[:40], seed=22, jitter=0.5, prefix='rough')
+    queries = perturbed(library[:40], seed=23, jitter=0.05)
+    queries = [Spectrum(q.precursor_mass + 0.5, q.charge, q.scan_id, q.mass, q.intensity) for q in queries]
+    library += [Spectrum(q.precursor_mass, r.charge, r.scan_id, r.mass, r.intensity) for q, r in zip(queries, rough)]
+    library += [Spectrum(s.precursor_mass, s.charge, f"copy{k:03d}", s.mass, s.intensity)
+                for k, s in enumerate(library[:10])]
+    queries += random_spectra(30, seed=24, prefix='rnd')
+    return queries, library
+
+
+@pytest.mark.parametrize('prune_peaks', [1, 8, msfilter.PRUNE_PEAKS, 1000])
+def test_best_matches(spectra, monkeypatch, prune_peaks):
+    queries, library = spectra
+    expected = msfilter.msfilter(queries, library, EYE_CATCHING_HEIGHT, 2.0, 0.6, top_k=1)
+    monkeypatch.setattr(msfilter, 'PRUNE_PEAKS', prune_peaks)
+    stats = {}
+    actual = msfilter.msfilter(queries, library, EYE_CATCHING_HEIGHT, 2.0, 0.6, top_k=1, prune=True, stats=stats)
+
+    assert list(msfilter.table_lines(queries, library, actual)) == \
+        list(msfilter.table_lines(queries, library, expected))
+    # Candidates whose bound cannot beat the best match, the rough copies among them, are not scored
+    assert stats['pairs_scored'] < stats['window_total']
+
+
+def run_job(spectra_file: str, library_file: str, cwd: str, cutoffs: list, *options) -> tuple:
+    os.makedirs(cwd)
+    subprocess.run([sys.executable, os.path.join(ROOT, 'run_eagleeye.py'), spectra_file, library_file,
+                    '-p', '2', '-f', '0.6', '-a', ','.join(cutoffs), '--results-db', *options],
+                   cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    tables = []
+    for cutoff in cutoffs:
+        name = f'queries-a{cutoff}-table.csv' if len(cutoffs) > 1 else 'queries-table.csv'
+        with open(os.path.join(cwd, name)) as fin:
+            tables.append(fin.read())
+    db = sqlite3.connect(os.path.join(cwd, 'queries-results.sqlite'))
+    rows = db.execute("SELECT * FROM results ORDER BY query, cutoff").fetchall()
+    db.close()
+    return tables, rows
+
+
+@pytest.mark.parametrize('cutoffs', [['0.05'], ['0.01', '0.05', '0.5']])
+def test_job_outputs(spectra, tmp_path, cutoffs):
+    queries, library = spectra
+    spectra_file = str(tmp_path / 'queries.mgf')
+    write_mgf(queries, spectra_file)
+    library_file = write_library(library, str(tmp_path / 'lib'))
+    tables, rows = run_job(spectra_file, library_file, str(tmp_path / 'normal'), cutoffs)
+
+    assert run_job(spectra_file, library_file, str(tmp_path / 'prune'), cutoffs, '--prune') == (tables, rows)
+    assert 'Background' in tables[0] and 'Good' in tables[0]
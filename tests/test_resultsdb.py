@@ -0,0 +1,135 @@
+"""
+The --results-db database (resultsdb.write_results()) against the score
+table it is written from and the <name>-table.csv of the same job.
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import msfilter
+import resultsdb
+from benchmarks.synthetic import dataset, write_library, write_mgf
+from conftest import ROOT
+from eagleeye_cgi import best_matches
+from msfilter import Spectrum
+from spectra_io import url_encode
+
+CUTOFFS = [0.01, 0.05, 0.2]
+
+
+def titled(spectra: list, prefix: str) -> list:
+    # Titles with characters that are URL-encoded in .dta names
+    return [Spectrum(s.precursor_mass, s.charge, f"{prefix} {k} (run.raw)", s.mass, s.intensity)
+            for k, s in enumerate(spectra)]
+
+
+@pytest.fixture(scope='module')
+def spectra() -> tuple:
+    queries, library = dataset(80, 300, seed=41, background=0.5, mass_range=(1000.0, 1300.0))
+    queries = titled(queries, 'Scan')
+    # No library spectrum within the precursor mass tolerance
+    queries += [Spectrum(5000.0 + k, s.charge, f"Far {k} (run.raw)", s.mass, s.intensity)
+                for k, s in enumerate(queries[:3])]
+    return queries, titled(library, 'Lib')
+
+
+@pytest.fixture(scope='module')
+def table(spectra) -> list:
+    """
+    Sorted score table with every candidate pair, .dta file names as a job
+    writes them.
+    """
+    queries, library = spectra
+    named = [Spectrum(s.precursor_mass, s.charge, url_encode(s.scan_id) + f".{s.charge}.dta", s.mass, s.intensity)
+             for s in queries]
+    libnamed = [Spectrum(s.precursor_mass, s.charge, url_encode(s.scan_id) + f".{s.charge}.dta", s.mass,
+                         s.intensity) for s in library]
+    scores = msfilter.msfilter(named, libnamed, 0.05, 2.0, 0.6)
+    return list(msfilter.table_lines(named, libnamed, msfilter.sort_table(named, libnamed, scores)))
+
+
+def fetch(path: str, sql: str, *args) -> list:
+    db = sqlite3.connect(path)
+    try:
+        return db.execute(sql, args).fetchall()
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize('pairs', [False, True])
+def test_best_rows(table, tmp_path, pairs):
+    path = str(tmp_path / ('spectra' + resultsdb.RESULTS_EXT))
+    count = resultsdb.write_results(path, table, CUTOFFS, pairs=pairs)
+    matches, _, _ = best_matches(table)
+    rows = {row[0]: row for row in fetch(path, "SELECT * FROM queries")}
+
+    assert count == len(rows) == len(matches)
+    for _, sname, lname, ds, pvalue in matches:
+        query, match, _, _, _, _, dscore, p = rows[sname]
+        assert (match or 'no_bckgr_spectra_with_same_precursor_mass', dscore, p) == (lname, ds, pvalue)
+    stored = fetch(path, "SELECT COUNT(*) FROM pairs")[0][0]
+    assert stored == (len(table) if pairs else 0)
+    if pairs:
+        assert {row[0] for row in fetch(path, "SELECT DISTINCT query FROM pairs")} == set(rows)
+
+
+def test_masses(table, spectra, tmp_path):
+    queries, library = spectra
+    path = str(tmp_path / ('spectra' + resultsdb.RESULTS_EXT))
+    resultsdb.write_results(path, table, CUTOFFS)
+    mass = {f"{s.scan_id}.{s.charge}.dta": (float(f"{s.precursor_mass:g}"), s.charge) for s in queries + library}
+    for query, match, query_mass, match_mass, charge, match_charge, _, _ in fetch(path, "SELECT * FROM queries"):
+        assert (query_mass, charge) == mass[query]
+        if match is not None:
+            assert (match_mass, match_charge) == mass[match]
+
+
+def test_not_found(table, tmp_path):
+    path = str(tmp_path / ('spectra' + resultsdb.RESULTS_EXT))
+    resultsdb.write_results(path, table, CUTOFFS, pairs=True)
+    for name in ("queries", "pairs"):
+        rows = fetch(path, f"SELECT query, match, match_mass, match_charge, query_mass, charge, dscore, pvalue "
+                           f"FROM {name} WHERE match IS NULL")
+        assert {r[0].rsplit('.', 2)[0] for r in rows} >= {f"Far {k} (run.raw)" for k in range(3)}
+        for row in rows:
+            assert row[1:4] == (None, None, None)
+            assert row[4] is not None and row[5] is not None
+            assert row[6:] == (1.0, 1.0)
+
+
+@pytest.mark.parametrize('all_pairs', [False, True])
+def test_predictions(spectra, tmp_path, all_pairs):
+    """
+    The `results` view classifies every query at every cutoff of a sweep as
+    the <name>-a<cutoff>-table.csv of the job does.
+    """
+    queries, library = spectra
+    spectra_file = str(tmp_path / 'queries.mgf')
+    write_mgf(queries, spectra_file)
+    library_file = write_library(library, str(tmp_path / 'lib'))
+    cwd = tmp_path / 'job'
+    cwd.mkdir()
+    subprocess.run([sys.executable, os.path.join(ROOT, 'run_eagleeye.py'), spectra_file, library_file, '-p', '2',
+                    '-f', '0.6', '-a', ','.join(map(str, CUTOFFS)), '--results-db'] +
+                   (['--all-pairs'] if all_pairs else []), cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    path = str(cwd / ('queries' + resultsdb.RESULTS_EXT))
+    stored = fetch(path, "SELECT COUNT(*) FROM pairs")[0][0]
+    assert stored > len(queries) if all_pairs else stored == 0
+
+    for cutoff in CUTOFFS:
+        with open(cwd / f'queries-a{cutoff}-table.csv') as fin:
+            next(fin)
+            expected = {}
+            for line in fin:
+                query, match, ds, pvalue, prediction = (field.strip() for field in line.split('\t'))
+                expected[query] = (match, round(float(ds), 4), prediction)
+        actual = {query: (match or 'no_bckgr_spectra_with_same_precursor_mass', round(ds, 4), prediction)
+                  for query, match, ds, prediction in
+                  fetch(path, "SELECT query, match, dscore, prediction FROM results WHERE cutoff = ?", cutoff)}
+        assert actual == expected
+        predictions = {p for _, _, p in expected.values()}
+        assert predictions == {'Good', 'Background'}
@@ -0,0 +1,93 @@
+"""
+The score cache (scorecache.ScoreCache) shared by concurrent jobs: with a
+size limit that evicts entries on every store, readers only ever see
+complete tables, and jobs give the outputs of an uncached run.
+"""
+
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+import scorecache
+from benchmarks.synthetic import dataset, write_library, write_mgf
+from conftest import ROOT
+
+PROCESSES = 4
+ROUNDS = 60
+KEYS = 8
+
+
+def table(key: int) -> str:
+    # Tables of different sizes, so that partial ones are detectable
+    return ''.join(f"{key}\t{line}\n" for line in range(200 + 50 * key))
+
+
+def use_cache(directory: str, seed: int, max_bytes: int) -> int:
+    cache = scorecache.ScoreCache(directory, max_bytes)
+    rng = random.Random(seed)
+    src = os.path.join(directory, f"src{seed}")
+    dest = os.path.join(directory, f"dest{seed}")
+    hits = 0
+    for _ in range(ROUNDS):
+        key = rng.randrange(KEYS)
+        if cache.get(scorecache.ScoreCache.key(table=key), dest):
+            with open(dest) as fin:
+                assert fin.read() == table(key)
+            hits += 1
+        else:
+            with open(src, 'w') as fout:
+                fout.write(table(key))
+            cache.put(scorecache.ScoreCache.key(table=key), src)
+    return hits
+
+
+@pytest.mark.skipif(scorecache.fcntl is None, reason="no flock")
+def test_concurrent(tmp_path):
+    directory = str(tmp_path / 'cache')
+    # About three tables fit
+    max_bytes = 3 * len(table(KEYS // 2))
+    scorecache.ScoreCache(directory, max_bytes)
+    with multiprocessing.get_context('fork').Pool(PROCESSES) as pool:
+        hits = pool.starmap(use_cache, [(directory, seed, max_bytes) for seed in range(PROCESSES)])
+    assert 0 < sum(hits) < PROCESSES * ROUNDS
+
+    entries = [e for e in os.scandir(directory) if e.name.endswith(scorecache.ENTRY_EXT)]
+    assert 0 < len(entries) < KEYS
+    assert sum(e.stat().st_size for e in entries) <= max_bytes
+    assert not [e for e in os.scandir(directory) if e.name.endswith('.tmp')]
+
+
+@pytest.mark.skipif(scorecache.fcntl is None, reason="no flock")
+def test_jobs(tmp_path):
+    """
+    Jobs at several cutoffs, with and without --prune, on one cache at once:
+    the same score table serves them all, and one fits in the cache.
+    """
+    queries, library = dataset(60, 300, seed=61, background=0.5, mass_range=(1000.0, 1300.0))
+    spectra_file = str(tmp_path / 'queries.mgf')
+    write_mgf(queries, spectra_file)
+    library_file = write_library(library, str(tmp_path / 'lib'))
+    cache = str(tmp_path / 'cache')
+    jobs = [('0.01', []), ('0.05', ['--prune']), ('0.2', []), ('0.05', [])]
+
+    def run(cwd: str, cutoff: str, options: list) -> subprocess.Popen:
+        os.makedirs(cwd)
+        return subprocess.Popen([sys.executable, os.path.join(ROOT, 'run_eagleeye.py'), spectra_file, library_file,
+                                 '-p', '2', '-f', '0.6', '-a', cutoff] + options, cwd=cwd, stdout=subprocess.DEVNULL)
+
+    uncached = [run(str(tmp_path / f'uncached{k}'), cutoff, options) for k, (cutoff, options) in enumerate(jobs)]
+    cached = [run(str(tmp_path / f'cached{k}'), cutoff, options + ['--score-cache', cache,
+                                                                  '--score-cache-size', '0.05'])
+              for k, (cutoff, options) in enumerate(jobs)]
+    assert not any(p.wait() for p in uncached + cached)
+
+    for k in range(len(jobs)):
+        for name in ('queries-table.csv', 'queries-good.mgf', 'queries-background.mgf'):
+            with open(tmp_path / f'uncached{k}' / name) as expected, open(tmp_path / f'cached{k}' / name) as actual:
+                assert actual.read() == expected.read()
+    entries = [e for e in os.scandir(cache) if e.name.endswith(scorecache.ENTRY_EXT)]
+    assert len(entries) == 1
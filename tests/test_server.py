@@ -0,0 +1,100 @@
+"""
+eagleeye_server.py on a Unix socket: a job gives the outputs of
+run_eagleeye.py, parameters that are not numbers are refused, and a
+worker killed between jobs is replaced.
+"""
+
+import glob
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from benchmarks.load_test import post_job
+from benchmarks.synthetic import perturbed, random_spectra, write_library, write_mgf
+from conftest import ROOT
+from eagleeye_server import UnixHTTPConnection
+
+OUTPUTS = ['queries-table.csv', 'queries-good.mgf', 'queries-background.mgf']
+
+
+def request(sock: str, method: str, path: str, body: str = None) -> tuple:
+    conn = UnixHTTPConnection(sock, timeout=60)
+    try:
+        conn.request(method, path, body, {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory) -> tuple:
+    tmp = tmp_path_factory.mktemp('server')
+    library = random_spectra(300, seed=71, prefix='lib')
+    queries = perturbed(library[:30], seed=72) + random_spectra(30, seed=73, prefix='rnd')
+    spectra_file = str(tmp / 'queries.mgf')
+    write_mgf(queries, spectra_file)
+    library_file = write_library(library, str(tmp / 'lib'))
+    sock = str(tmp / 'eagleeye.sock')
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'eagleeye_server.py'), '--socket', sock,
+                             '--preload', library_file, '--workers', '1', '--workdir', str(tmp / 'jobs')],
+                            cwd=tmp, stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 60
+        while not os.path.exists(sock):
+            assert proc.poll() is None and time.time() < deadline
+            time.sleep(0.1)
+        single = tmp / 'single'
+        single.mkdir()
+        subprocess.run([sys.executable, os.path.join(ROOT, 'run_eagleeye.py'), spectra_file, library_file,
+                        '-p', '2', '-f', '0.6', '-a', '0.05'], cwd=single, check=True, stdout=subprocess.DEVNULL)
+        params = {'type': 'Filter', 'uploaded_spectra': spectra_file, 'uploaded_background_library': library_file,
+                  'pmt': 2, 'fmt': 0.6, 'smj': 0.05}
+        yield proc, sock, params, str(single)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(60)
+
+
+def run_job(sock: str, params: dict, single: str) -> None:
+    _, result = post_job(None, sock, params)
+    assert result['status'] == 'done', result
+    assert set(OUTPUTS) <= set(result['files'])
+    for name in OUTPUTS:
+        status, body = request(sock, 'GET', f"/jobs/{result['job']}/{name}")
+        assert status == 200
+        with open(os.path.join(single, name), 'rb') as fin:
+            assert body == fin.read()
+
+
+def test_job(server):
+    _, sock, params, single = server
+    run_job(sock, params, single)
+
+
+@pytest.mark.parametrize('key,value', [('pmt', '2; touch injected'), ('fmt', '$(touch injected)'),
+                                       ('workers', '1.5'), ('smj', '0.05 `touch injected`')])
+def test_invalid(server, key, value):
+    _, sock, params, _ = server
+    status, body = request(sock, 'POST', '/jobs', json.dumps(dict(params, **{key: value})))
+    assert status == 400
+    assert 'Invalid' in json.loads(body)['error']
+    assert not glob.glob(os.path.join(os.path.dirname(sock), '**', 'injected'), recursive=True)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/task'), reason="no /proc")
+def test_worker_killed(server):
+    proc, sock, params, single = server
+    with open(f"/proc/{proc.pid}/task/{proc.pid}/children") as fin:
+        workers = [int(pid) for pid in fin.read().split()]
+    assert workers
+    for pid in workers:
+        os.kill(pid, signal.SIGKILL)
+    # Until the pool has seen its worker die
+    time.sleep(1)
+    run_job(sock, params, single)
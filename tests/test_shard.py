@@ -0,0 +1,91 @@
+"""
+Sharded Filter jobs (eagleeye_shard.py): several workers on one job
+directory at once, then merge, give the outputs of a single-node
+run_eagleeye.py run, and each unit is claimed by exactly one worker.
+"""
+
+import filecmp
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks.synthetic import perturbed, random_spectra, write_library, write_mgf
+from conftest import ROOT
+
+PMT = 0.5
+WORKERS = 3
+UNITS = 16
+
+
+@pytest.fixture(scope='module')
+def job(tmp_path_factory) -> tuple:
+    """
+    A dense precursor mass range and a tight tolerance: the library spectra
+    within PMT of one unit's mass range are also within PMT of the next.
+    """
+    tmp = tmp_path_factory.mktemp('shard')
+    library = random_spectra(400, seed=31, mass_range=(1000.0, 1100.0), prefix='lib')
+    queries = perturbed(library[::5], seed=32, jitter=0.3) + \
+        random_spectra(60, seed=33, mass_range=(1000.0, 1100.0), prefix='rnd')
+    spectra_file = str(tmp / 'queries.mgf')
+    write_mgf(queries, spectra_file)
+    library_file = write_library(library, str(tmp / 'lib'))
+    options = ['-p', str(PMT), '-f', '0.6', '-a', '0.05']
+
+    single = tmp / 'single'
+    single.mkdir()
+    subprocess.run([sys.executable, os.path.join(ROOT, 'run_eagleeye.py'), spectra_file, library_file] + options,
+                   cwd=single, check=True, stdout=subprocess.DEVNULL)
+
+    shared = str(tmp / 'shared')
+    shard = os.path.join(ROOT, 'eagleeye_shard.py')
+    subprocess.run([sys.executable, shard, 'shard', spectra_file, library_file] + options +
+                   ['--units', str(UNITS), '-o', shared], check=True, stdout=subprocess.DEVNULL)
+    nodes = [subprocess.Popen([sys.executable, shard, 'worker', shared], stdout=subprocess.PIPE, text=True)
+             for _ in range(WORKERS)]
+    logs = [p.communicate()[0] for p in nodes]
+    assert not any(p.returncode for p in nodes)
+    merged = tmp / 'merged'
+    merged.mkdir()
+    subprocess.run([sys.executable, shard, 'merge', shared], cwd=merged, check=True, stdout=subprocess.DEVNULL)
+    return library, shared, logs, str(single), str(merged)
+
+
+def test_overlap(job):
+    library, shared, _, _, _ = job
+    with open(os.path.join(shared, 'job.json')) as fin:
+        units = json.load(fin)['units']
+    assert len(units) > WORKERS
+    # Library spectra that are candidates of queries in more than one unit
+    shared_spectra = [s for s in library
+                      if sum(u['charge'] == s.charge and u['mass_range'][0] - PMT <= s.precursor_mass
+                             <= u['mass_range'][1] + PMT for u in units) > 1]
+    assert len(shared_spectra) > 10
+
+
+def test_claims(job):
+    _, shared, logs, _, _ = job
+    with open(os.path.join(shared, 'job.json')) as fin:
+        names = [u['name'] for u in json.load(fin)['units']]
+    claimed = [line.split(':')[0] for log in logs for line in log.splitlines() if line.startswith('u')]
+    assert sorted(claimed) == sorted(names)
+    assert [int(log.splitlines()[-1].split()[1]) for log in logs] == \
+        [sum(line.startswith('u') for line in log.splitlines()) for log in logs]
+    # Every unit has the lock of the one worker that processed it
+    units = os.path.join(shared, 'units')
+    locks = sorted(n for n in os.listdir(units) if n.endswith('.lock'))
+    assert locks == sorted(f"{name}.lock" for name in names)
+    assert not [n for n in os.listdir(units) if n.endswith('.tmp')]
+
+
+def test_outputs(job):
+    _, _, _, single, merged = job
+    names = ['queries-table.csv', 'queries-good.mgf', 'queries-background.mgf']
+    match, mismatch, errors = filecmp.cmpfiles(single, merged, names, shallow=False)
+    assert match == names, (mismatch, errors)
+    with open(os.path.join(single, 'queries-table.csv')) as fin:
+        table = fin.read()
+    assert 'Background' in table and 'Good' in table
@@ -0,0 +1,60 @@
+"""
+Filter jobs with --memory-budget (eagleeye_cgi.process_stream()): with a
+budget small enough for dozens of batches, the sorted runs merge into the
+outputs of an in-memory run, for each option set of
+benchmarks.bench_stream and for a .mgf.gz spectra file.
+"""
+
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks.bench_stream import VARIANTS, compare
+from benchmarks.synthetic import dataset, perturbed, write_library, write_mgf
+from conftest import ROOT
+from msfilter import Spectrum
+
+BUDGET = '0.02'
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory) -> tuple:
+    tmp = tmp_path_factory.mktemp('stream')
+    queries, library = dataset(150, 600, seed=91, background=0.5, mass_range=(1000.0, 1300.0))
+    # Later IONS blocks with the TITLE of earlier ones replace them, also across batches
+    repeated = [Spectrum(s.precursor_mass, s.charge, q.scan_id, s.mass, s.intensity)
+                for q, s in zip(queries, perturbed(queries[:10], seed=92))]
+    spectra_file = str(tmp / 'queries.mgf')
+    write_mgf(queries + repeated, spectra_file)
+    with open(spectra_file, 'rb') as fin, gzip.open(spectra_file + '.gz', 'wb') as fout:
+        shutil.copyfileobj(fin, fout)
+    return tmp, spectra_file, write_library(library, str(tmp / 'lib'))
+
+
+def run(cwd: str, args: list) -> dict:
+    os.makedirs(cwd)
+    subprocess.run([sys.executable, os.path.join(ROOT, 'run_eagleeye.py')] + args, cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL)
+    with open(os.path.join(cwd, next(f for f in os.listdir(cwd) if f.endswith('-stats.json')))) as fin:
+        return json.load(fin)['counters']
+
+
+@pytest.mark.parametrize('name', list(VARIANTS) + ['mgf.gz'])
+def test_outputs(files, name):
+    if name == 'sparse':
+        pytest.importorskip('scipy')
+    tmp, spectra_file, library_file = files
+    spectra = spectra_file + '.gz' if name == 'mgf.gz' else spectra_file
+    args = [spectra, library_file, '-p', '2', '-f', '0.6', '-a', '0.05'] + VARIANTS.get(name, [])
+    whole, streamed = str(tmp / name / 'whole'), str(tmp / name / 'stream')
+    run(whole, args)
+    counters = run(streamed, args + ['--memory-budget', BUDGET])
+
+    assert counters['batches'] > 10
+    names = compare(whole, streamed)
+    assert any(n.endswith('-table.csv') for n in names)